@@ -20,4 +20,10 @@ class Base:
         metadata={
             "Field Definition":"Metadata field describing how many times this record has been revised. Starting counter is 1."
         }
-    )
\ No newline at end of file
+    )
+    _hash: int=field(
+        default=None, 
+        metadata={
+            "Field Definition":"Metadata field holding the hash of the content of this record, used to detect changes without comparing every column."
+        }
+    )
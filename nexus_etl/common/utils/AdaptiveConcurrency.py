@@ -0,0 +1,125 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of requests in flight to one class of endpoint and adjusts the limit
+    with additive increase / multiplicative decrease (AIMD).
+
+    Every request that answers within latency_target seconds without being throttled
+    raises the limit by increase / limit, i.e. by about `increase` per round of `limit`
+    requests.  A request that is slower than the target, or that was answered (or retried)
+    with 429 or 5xx, multiplies the limit by decrease_factor.  Only one decrease is applied
+    per round trip, so a burst of failures of requests that were sent together does not
+    collapse the limit to min_limit.
+    """
+
+    def __init__(self, name: str, initial_limit: int=4, min_limit: int=1, max_limit: int=16, latency_target: float=5.0, increase: float=1.0, decrease_factor: float=0.5, throughput_window: float=60.0):
+
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.throughput_window = throughput_window
+
+        self.in_flight = 0
+        self.completed = 0
+        self.overloaded = 0
+        self.last_decrease = 0.0
+        self.created = time.monotonic()
+        self.completion_times = deque()
+        self.condition = threading.Condition()
+
+    def acquire(self) -> float:
+        """
+        Waits until a request may be sent.
+
+        Returns:
+        float: The time the request was allowed to start.
+        """
+
+        with self.condition:
+
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+
+            self.in_flight += 1
+
+        return time.monotonic()
+
+    def release(self, start_time: float, overloaded: bool=False) -> None:
+        """
+        Records the outcome of a request and adjusts the limit.
+
+        Args:
+        start_time (float): The value returned by acquire().
+        overloaded (bool): True if XNAT throttled the request or answered it with a server error.
+        """
+
+        now = time.monotonic()
+        latency = now - start_time
+
+        with self.condition:
+
+            self.in_flight -= 1
+            self.completed += 1
+            self.completion_times.append(now)
+
+            if overloaded or latency > self.latency_target:
+
+                self.overloaded += 1
+
+                # requests sent before the last decrease do not decrease the limit again
+                if start_time >= self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+
+            else:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds one of the request slots for the duration of a with block.  The caller marks
+        the request as overloaded by setting the 'overloaded' key of the yielded dict.
+        """
+
+        outcome = {'overloaded': False}
+        start_time = self.acquire()
+
+        try:
+            yield outcome
+        except Exception:
+            outcome['overloaded'] = True
+            raise
+        finally:
+            self.release(start_time, outcome['overloaded'])
+
+    def metrics(self) -> dict:
+        """
+        Returns the current limit, the requests in flight and the throughput over the last
+        throughput_window seconds.
+        """
+
+        now = time.monotonic()
+
+        with self.condition:
+
+            while self.completion_times and now - self.completion_times[0] > self.throughput_window:
+                self.completion_times.popleft()
+
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'overloaded': self.overloaded,
+                'throughput_per_second': round(len(self.completion_times) / max(min(self.throughput_window, now - self.created), 1e-3), 2)
+            }
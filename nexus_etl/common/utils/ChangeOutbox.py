@@ -0,0 +1,234 @@
+import os
+import uuid
+import datetime
+import sqlite3 as sl
+from LoadInitialization import get_env_variables
+
+# Load the environment variables
+config = get_env_variables()
+
+# The change outbox: apply_delta records every record it actually inserts, updates or
+# deletes in change_outbox, in the transaction that writes it.  The dw_to_nexus scripts
+# publish (INSERT/UPDATE) and deprecate (DELETE) the resources of the pending changes and
+# then mark them drained, instead of scanning whole tables for "_updatedat" or reconciling
+# against Nexus with SPARQL.  Drained changes are purged after nexus.change_retention_days.
+
+outbox_table_name = 'change_outbox'
+
+publish_action_list = ['INSERT', 'UPDATE']
+deprecate_action_list = ['DELETE']
+
+run_id_variable = 'NEXUS_ETL_RUN_ID'
+
+retention_days = config.get('nexus', {}).get('change_retention_days', 30)
+
+# how the dw_to_nexus scripts find the records to publish and deprecate, see get_change_filter
+change_source = config.get('nexus', {}).get('change_source', 'updatedat')
+
+
+def new_run_id() -> str:
+
+    return f"{datetime.datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+def get_run_id() -> str:
+    """
+    The id the changes of this run are recorded with.  run_src_to_dw.py sets it in the
+    environment, so all of its loader processes share one; a loader started on its own
+    (e.g. by the makefile) gets its own.
+    """
+
+    if not os.environ.get(run_id_variable):
+        os.environ[run_id_variable] = new_run_id()
+
+    return os.environ[run_id_variable]
+
+
+def create_outbox_table(con: sl.Connection) -> None:
+    """
+    Creates the change_outbox table for databases that were initialized before it existed.
+    """
+
+    con.execute(f"""
+        create table if not exists {outbox_table_name}
+        (
+            change_id integer primary key autoincrement,
+            run_id text not null,
+            table_name text not null,
+            resource_uri text not null,
+            delta_action text not null,
+            _rev integer null,
+            changed_at datetime not null,
+            drained_at datetime null
+        )
+    """)
+    con.execute(f"""
+        create index if not exists ix_{outbox_table_name}__pending
+        on {outbox_table_name} (table_name, resource_uri, change_id)
+    """)
+    con.commit()
+
+
+def record_changes(cursor: sl.Cursor, table_name: str, change_list: list) -> None:
+    """
+    Description:
+    Adds changes to the outbox.  Nothing is committed: the cursor is the one the records
+    are written with, so the changes are committed or rolled back with them.
+
+    Keyword Arguments:
+    cursor -- the cursor of the write transaction
+    table_name -- the table the records were written to
+    change_list -- (resource_uri, delta_action, _rev) tuples; changes without a URI are skipped
+    """
+
+    changed_at = datetime.datetime.now()
+    run_id = get_run_id()
+
+    cursor.executemany(
+        f"""
+            insert into {outbox_table_name} (run_id, table_name, resource_uri, delta_action, _rev, changed_at)
+            values (?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (run_id, table_name, resource_uri, delta_action, rev, changed_at)
+            for resource_uri, delta_action, rev in change_list
+            if resource_uri is not None
+        ]
+    )
+
+
+def get_last_change_id(con: sl.Connection, table_name: str) -> int:
+    """
+    The id of the last change of a table.  A consumer reads and drains the changes up to
+    it, so changes recorded while it publishes are left for its next run.
+    """
+
+    create_outbox_table(con)
+
+    return con.execute(
+        f"select coalesce(max(change_id), 0) from {outbox_table_name} where table_name = ?",
+        (table_name,)
+    ).fetchone()[0]
+
+
+def get_pending_uri_query(table_name: str, action_list: list, last_change_id: int) -> str:
+    """
+    Description:
+    Builds the query of the URIs of a table with pending changes.  Only the last change of
+    a URI counts, so e.g. a record inserted and deleted again is deprecated, not published.
+
+    Keyword Arguments:
+    table_name -- the table the records were written to
+    action_list -- the actions the consumer handles, publish_action_list or deprecate_action_list
+    last_change_id -- the result of get_last_change_id
+
+    Returns:
+    The query, selecting resource_uri.
+    """
+
+    action_sql = ', '.join(f"'{action}'" for action in action_list)
+
+    return f"""
+        select o.resource_uri
+        from {outbox_table_name} o
+        where o.table_name = '{table_name}'
+        and o.drained_at is null
+        and o.delta_action in ({action_sql})
+        and o.change_id = (
+            select max(l.change_id) from {outbox_table_name} l
+            where l.table_name = o.table_name
+            and l.resource_uri = o.resource_uri
+            and l.change_id <= {int(last_change_id)}
+        )
+    """
+
+
+def get_change_filter(con: sl.Connection, table_name: str, uri_field_name: str, resource_type: str, last_processed_date: str='1990-01-01 00:00:00') -> tuple:
+    """
+    Description:
+    Builds the condition selecting the records of a table a dw_to_nexus script publishes.
+    With change_source 'outbox' these are the records with pending INSERT/UPDATE changes;
+    with 'updatedat' the records whose "_updatedat" is later than the last load of the
+    resource type in nexus_etl_log.
+
+    Keyword Arguments:
+    con -- the database connection
+    table_name -- the table the records are read from
+    uri_field_name -- the column with the URI of the resource, e.g. 'session_uri'
+    resource_type -- the Nexus resource type, as logged in nexus_etl_log
+    last_processed_date -- the date used if the resource type was never loaded
+
+    Returns:
+    A (change_filter, last_change_id) tuple; last_change_id is passed to mark_changes_drained
+    once the records are published.
+    """
+
+    last_change_id = get_last_change_id(con, table_name)
+
+    if change_source == 'outbox':
+        return f"{uri_field_name} in ({get_pending_uri_query(table_name, publish_action_list, last_change_id)})", last_change_id
+
+    change_filter = f"""
+        "_updatedat" > coalesce (
+            (select max(last_success_load_ts) from nexus_etl_log
+            where resource_type = '{resource_type}'),
+            '{last_processed_date}'
+        )
+    """
+
+    return change_filter, last_change_id
+
+
+def mark_changes_drained(con: sl.Connection, table_name: str, resource_uri_list: list, last_change_id: int) -> int:
+    """
+    Description:
+    Marks the changes of the given URIs up to last_change_id as drained, including the ones a
+    later change of the same URI superseded, and purges the changes drained long ago.  Only the
+    URIs the consumer handled are passed, so the others stay pending for its next run.
+
+    Keyword Arguments:
+    con -- the database connection
+    table_name -- the table the records were written to
+    resource_uri_list -- the URIs of the resources the consumer published or deprecated
+    last_change_id -- the result of get_last_change_id, read before the records
+
+    Returns:
+    int: The number of changes marked.
+    """
+
+    drained_at = datetime.datetime.now()
+
+    cursor = con.executemany(
+        f"""
+            update {outbox_table_name}
+            set drained_at = ?
+            where table_name = ?
+            and resource_uri = ?
+            and drained_at is null
+            and change_id <= ?
+        """,
+        [(drained_at, table_name, resource_uri, last_change_id) for resource_uri in set(resource_uri_list)]
+    )
+    con.commit()
+
+    purge_drained_changes(con, table_name)
+
+    return cursor.rowcount
+
+
+def purge_drained_changes(con: sl.Connection, table_name: str, keep_days: int=retention_days) -> int:
+    """
+    Deletes the changes of a table drained more than keep_days ago, so the outbox only grows
+    with the changes that are still pending.
+
+    Returns:
+    int: The number of changes deleted.
+    """
+
+    cursor = con.execute(
+        f"delete from {outbox_table_name} where table_name = ? and drained_at < ?",
+        (table_name, datetime.datetime.now() - datetime.timedelta(days=keep_days))
+    )
+    con.commit()
+
+    return cursor.rowcount
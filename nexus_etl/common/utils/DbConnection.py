@@ -6,6 +6,56 @@ import os
 # Load environment variables
 config = get_env_variables()
 
+# the tables whose records DeltaCalcUtils and WriteToDb hash
+hashed_table_list = [
+    'research_study',
+    'research_subject',
+    'device',
+    'session',
+    'acquisition',
+    'acquisition_object',
+    'questionnaire_list',
+    'questionnaire_item_list',
+    'questionnaire',
+    'questionnaire_response_list',
+    'questionnaire_response'
+]
+
+# the user_version of databases whose tables have the "_hash" column, set by schema.sql
+hash_schema_version = 1
+
+
+def add_hash_columns(con: sl.Connection) -> None:
+    """
+    Adds the "_hash" column (see DeltaCalcUtils.add_content_hash) and its index to the
+    tables of databases that were created before the column was part of schema.sql.
+    This runs once per database; afterwards its user_version records that it is done.
+    """
+
+    if con.execute('pragma user_version').fetchone()[0] >= hash_schema_version:
+        return
+
+    for table_name in hashed_table_list:
+
+        column_list = [row[1] for row in con.execute(f'pragma table_info("{table_name}")')]
+
+        if not column_list:
+            continue
+
+        if '_hash' not in column_list:
+            try:
+                con.execute(f'alter table "{table_name}" add column "_hash" integer null')
+            except sl.OperationalError as error:
+                # another process added it in the meantime
+                if 'duplicate column' not in str(error):
+                    raise error
+
+        con.execute(f'create index if not exists "ix_{table_name}__hash" on "{table_name}" ("_hash")')
+
+    con.execute(f'pragma user_version = {hash_schema_version}')
+    con.commit()
+
+
 def connect_to_db() -> Engine:
     """
     This function establishes a connection to the SQLite database and returns an SQLAlchemy engine object.
@@ -24,9 +74,14 @@ def connect_to_db() -> Engine:
     os.chdir(this_dir)
 
     # Connect to the SQLite database located at the specified relative path
-    con = sl.connect('../../database/mpg_eln.db')
+    # run_src_to_dw.py stages the next project from a background thread while the loaders
+    # write, so the connection is not bound to the thread that opened it and a writer may
+    # have to wait for the other one to commit
+    con = sl.connect('../../database/mpg_eln.db', timeout=60, check_same_thread=False)
 
     # Reset the working directory to its original state
     os.chdir(caller_dir)
+
+    add_hash_columns(con)
         
     return con
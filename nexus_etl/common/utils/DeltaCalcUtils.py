@@ -6,21 +6,60 @@ from DatatypeConverter import convert_datatypes_ignorena
 from NexusUriGenerator import generate_uri, generate_uri_column
 
 
+# The hash of a missing value, whatever the type of its column, so None, NaN and NaT
+# compare equal between the frame read from the database and the one built from XNAT.
+null_hash = np.uint64(0x9E3779B97F4A7C15)
+
+numeric_kind_set = {'integer', 'floating', 'mixed-integer-float', 'decimal', 'boolean'}
+datetime_kind_set = {'datetime64', 'datetime', 'date'}
+
+
+def hash_column(series: pd.Series) -> np.ndarray:
+    # This function hashes the values of a column to uint64 without a Python-level loop.
+    # Columns read from the database and columns built from XNAT do not always end up with
+    # the same dtype (an integer column becomes float, or object once np.nan is replaced by
+    # None), so the values are brought to one representation per kind first: numbers to
+    # float64, timestamps to nanoseconds and everything else to strings.
+
+    null_mask = series.isna().values
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+
+    if kind in numeric_kind_set:
+        # 3, 3.0 and True hash the same
+        values = pd.to_numeric(series, errors='coerce').astype('float64').values
+    elif kind in datetime_kind_set:
+        values = pd.to_datetime(series, errors='coerce').values.view('int64')
+    elif kind in ('string', 'empty'):
+        values = series.fillna('').values.astype(object)
+    else:
+        # mixed content, e.g. dicts or lists, is hashed on its string form
+        values = series.astype(str).values.astype(object)
+
+    column_hash = pd.util.hash_array(values)
+    column_hash[null_mask] = null_hash
+
+    return column_hash
+
+
 def hash_pk_fields(df: pd.DataFrame, duplicate_columns_to_consider: list) -> pd.DataFrame:
     # This function receives a dataframe and a list of columns to consider for hashing. 
     # It returns the original dataframe with an additional column "hash". This column 
-    # contains a unique hash value generated from the values of the columns 
+    # contains a hash value generated from the values of the columns 
     # specified in "duplicate_columns_to_consider".
 
     # If the length of dataframe is greater than 0, i.e., if the dataframe is not empty.
     if len(df) > 0:
-        # A new column 'hash' is created in the dataframe. Each row's hash value is calculated 
-        # by applying the Python built-in 'hash' function to a tuple of the values from the columns 
-        # specified in "duplicate_columns_to_consider". 
-        # The 'apply' function applies a function along an axis of the DataFrame, in this case, each row (axis=1).
-        # The 'lambda' function takes a row of data ('x'), converts it into a tuple and then 
-        # converts it into a string to pass to the 'hash' function.
-        df['hash'] = df[duplicate_columns_to_consider].apply(lambda x: hash(str(tuple(x))), axis = 1)
+        # The column hashes (see hash_column) are combined column by column.  hash_array
+        # uses a fixed key, so unlike the built-in 'hash' the values are the same in every
+        # process and on every machine.  The columns are sorted, as the list is usually built
+        # from a set whose order changes between processes.
+        row_hash = np.zeros(len(df), dtype='uint64')
+
+        for column in sorted(duplicate_columns_to_consider):
+            row_hash = (row_hash * np.uint64(1000003)) ^ hash_column(df[column])
+
+        # The uint64 hashes are stored as int64 so they fit an SQLite integer.
+        df['hash'] = row_hash.view('int64')
     else:
         # If the dataframe is empty, the 'hash' column is filled with 'None'.
         df['hash'] = None
@@ -30,6 +69,54 @@ def hash_pk_fields(df: pd.DataFrame, duplicate_columns_to_consider: list) -> pd.
 
 
 
+def get_content_columns(columns, uri_field_name: str) -> list:
+    # This function returns the columns whose values make up the content of a record, i.e.
+    # every column but the uri and the metadata fields.  The same columns are hashed when a
+    # record is written (add_content_hash) and when it is compared (calculate_delta).
+
+    nexus_fields = [uri_field_name, '_createdat', '_updatedat', '_rev', '_hash']
+
+    return [column for column in columns if column not in nexus_fields]
+
+
+def add_content_hash(load_df: pd.DataFrame, uri_field_name: str) -> pd.DataFrame:
+    """
+    Sets the "_hash" column of the records about to be written to the hash of their
+    content (see hash_pk_fields).  calculate_delta compares the incoming records against
+    the stored hashes instead of hashing the existing records again on every run.  It has
+    to be called on the final dataframe right before it is written, after any columns have
+    been filled in from the generated uris.
+
+    Args:
+    load_df (pd.DataFrame): The dataframe that is written to the table.
+    uri_field_name (str): The field name used for the URI.
+
+    Returns:
+    pd.DataFrame: load_df with the "_hash" column set.
+    """
+
+    load_df = hash_pk_fields(load_df, get_content_columns(load_df.columns, uri_field_name))
+    load_df['_hash'] = load_df['hash']
+
+    return load_df.drop(columns=['hash'])
+
+
+
+def get_existing_hash(existing_df: pd.DataFrame, duplicate_columns_to_consider: list) -> np.ndarray:
+    # This function returns the content hashes of the existing records.  The records carry the
+    # hash of their content from when they were written ("_hash").  pandas reads an integer
+    # column holding nulls as float, which cannot hold a 64 bit hash exactly (and the datatype
+    # conversion turns it back into wrong integers), so the stored hashes are only used when
+    # every record has one.  Otherwise, e.g. for records written before the column existed,
+    # all records are hashed here.
+
+    if '_hash' in existing_df.columns and existing_df['_hash'].notna().all():
+        return existing_df['_hash'].values.astype('int64')
+
+    return hash_pk_fields(existing_df.copy(), duplicate_columns_to_consider)['hash'].values
+
+
+
 def calculate_delta(existing_df, new_df, uri_field_name, pk_fields) -> pd.DataFrame:
     # This function is used to calculate the delta, or changes, between two dataframes, 
     # existing_df and new_df, based on the specified primary key fields (pk_fields). It returns a new
@@ -42,67 +129,69 @@ def calculate_delta(existing_df, new_df, uri_field_name, pk_fields) -> pd.DataFr
         
     # If the existing_df is not empty, then the function proceeds with the following steps.
     elif len(existing_df) > 0:
+        pk_fields = list(pk_fields)
+
         # Replacing np.nan values with None in both dataframes to avoid issues due to datatype mismatch
         existing_df = existing_df.replace({np.nan: None})
         new_df = new_df.replace({np.nan: None})
 
         # Specifying certain columns to consider for duplicate checking and non primary key columns
-        nexus_fields = [uri_field_name, '_createdat', '_updatedat', '_rev']
-        duplicate_columns_to_consider = list(set(list(existing_df.columns)) - set(nexus_fields))
-        non_pk_fields = set(list(existing_df.columns)) - set(pk_fields) - set(nexus_fields)
-
-        # Hashing primary key fields to check for duplicates
-        existing_df = hash_pk_fields(existing_df, duplicate_columns_to_consider)
-        new_df = hash_pk_fields(new_df, duplicate_columns_to_consider)
-
-        # Merging both dataframes into one
-        data_dict = {"Prev": existing_df,"Curr": new_df}
-        df_merged = pd.concat(data_dict, sort = True)
-        
-        # Dropping duplicates based on the 'hash' value and also keeping track of existing unchanged rows
-        df_dedup = df_merged.drop_duplicates(subset='hash', keep=False)
-        df_existing = df_merged[df_merged.duplicated(subset='hash', keep=False)]
-        df_dedup = df_dedup.drop(columns=['hash'])
-        df_existing = df_existing.drop(columns=['hash'])
-
-        # For existing unchanged rows, marking them as 'NOCHANGE'
-        if len(df_existing) > 0:
-            df_existing = df_existing[df_existing['_rev'].notna()]
-            df_existing['delta_action'] = 'NOCHANGE'
-
-        # Checking the remaining rows for insertions, updates and deletions
-        df_join = pd.DataFrame()
-        if len(df_dedup) > 0:
-            # Separating previous and current deduplicated dataframes
-            try:
-                df_dedup_curr = df_dedup.loc["Curr"]
-            except:
-                df_dedup_curr = pd.DataFrame(columns = df_dedup.columns)
-
-            try:
-                df_dedup_prev = df_dedup.loc["Prev"]
-            except:
-                df_dedup_prev = pd.DataFrame(columns = df_dedup.columns)
-
-            # Dropping unnecessary columns
-            df_dedup_prev = df_dedup_prev.drop(list(non_pk_fields), axis=1)
-            df_dedup_curr = df_dedup_curr.drop(nexus_fields, axis=1)
-
-            # Merging previous and current dataframes to find insertions, updates and deletions
-            df_join = df_dedup_curr.merge(df_dedup_prev, on=list(pk_fields),
-                                how='outer', indicator=True)
-            df_join.insert(loc = len(df_join.columns),
-                            column = 'delta_action',
-                            value = None)
-
-            # Labeling rows based on their status: UPDATE, INSERT or DELETE
-            df_join.loc[df_join['_merge'] == 'both', 'delta_action'] = 'UPDATE'
-            df_join.loc[df_join['_merge'] == 'left_only', 'delta_action'] = 'INSERT'
-            df_join.loc[df_join['_merge'] == 'right_only', 'delta_action'] = 'DELETE'
-            df_join = df_join.drop('_merge', axis=1)
-
-        # Appending the existing unchanged rows to the joined dataframe
-        df_join = df_join.append(df_existing)
+        nexus_fields = [uri_field_name, '_createdat', '_updatedat', '_rev', '_hash']
+        duplicate_columns_to_consider = get_content_columns(existing_df.columns, uri_field_name)
+
+        # Hashing the content of the existing and the incoming records
+        existing_hash = get_existing_hash(existing_df, duplicate_columns_to_consider)
+        new_hash = hash_pk_fields(new_df, duplicate_columns_to_consider).pop('hash').values
+
+        # A record whose content hash occurs more than once across both dataframes is unchanged.
+        # The existing copies are kept as 'NOCHANGE', the incoming copies are dropped.
+        hash_duplicated = pd.Series(np.concatenate([existing_hash, new_hash])).duplicated(keep=False).values
+        existing_unchanged_mask = hash_duplicated[:len(existing_df)]
+        new_unchanged_mask = hash_duplicated[len(existing_df):]
+
+        df_existing = existing_df[existing_unchanged_mask]
+        df_existing = df_existing[df_existing['_rev'].notna()].assign(delta_action='NOCHANGE')
+
+        df_prev = existing_df[~existing_unchanged_mask]
+        df_curr = new_df[~new_unchanged_mask]
+
+        # The remaining records are matched on their primary key through one index on the
+        # existing records: a match is an update, an incoming record without one an insert and
+        # an existing record without one a delete
+        prev_key_index = pd.Index(hash_pk_fields(df_prev[pk_fields].copy(), pk_fields)['hash'].values)
+        curr_key = hash_pk_fields(df_curr[pk_fields].copy(), pk_fields)['hash'].values
+
+        if not prev_key_index.is_unique:
+            duplicate_df = df_prev[prev_key_index.duplicated(keep=False)]
+            print(pd.concat(g for _, g in duplicate_df.groupby(pk_fields, dropna=False) if len(g) > 1))
+            raise ValueError("Duplicates found in dataframe after delta check.  Dataframe will not be inserted.")
+
+        prev_position = prev_key_index.get_indexer(curr_key)
+        curr_matched_mask = prev_position >= 0
+        prev_matched_mask = np.zeros(len(df_prev), dtype=bool)
+        prev_matched_mask[prev_position[curr_matched_mask]] = True
+
+        # The incoming records carry the content, the existing records the nexus fields
+        content_columns = [
+            column for column in sorted(set(existing_df.columns) | set(new_df.columns))
+            if column not in nexus_fields
+        ]
+        prev_nexus_columns = [column for column in sorted(existing_df.columns) if column in nexus_fields]
+
+        df_update = df_curr[curr_matched_mask].reindex(columns=content_columns)
+        matched_prev = df_prev.iloc[prev_position[curr_matched_mask]]
+        for column in prev_nexus_columns:
+            df_update[column] = matched_prev[column].values
+        df_update['delta_action'] = 'UPDATE'
+
+        df_insert = df_curr[~curr_matched_mask].reindex(columns=content_columns + prev_nexus_columns)
+        df_insert['delta_action'] = 'INSERT'
+
+        df_delete = df_prev[~prev_matched_mask].reindex(columns=pk_fields + prev_nexus_columns)
+        df_delete = df_delete.reindex(columns=content_columns + prev_nexus_columns)
+        df_delete['delta_action'] = 'DELETE'
+
+        df_join = pd.concat([df_update, df_insert, df_delete, df_existing], ignore_index=True)
 
     # If there are any duplicate rows in the dataframe after all operations, raise a ValueError
     if df_join.duplicated(subset=pk_fields).any():
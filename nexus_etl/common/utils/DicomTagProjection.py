@@ -0,0 +1,105 @@
+def normalize_tag(tag: str) -> str:
+    """
+    Reduces a DICOM tag such as '(0008,103E)' or '0008,103e' to '0008103E'.
+    """
+
+    return ''.join(char for char in str(tag or '') if char.isalnum()).upper()
+
+
+def is_private_tag(tag: str) -> bool:
+    """
+    True for a normalized tag of an odd-numbered (private) group.
+    """
+
+    try:
+        return len(tag) == 8 and int(tag[:4], 16) % 2 == 1
+    except ValueError:
+        return False
+
+
+class DicomTagProjection:
+    """
+    Selects the rows of an XNAT dicomdump (dicts with tag1, tag2, desc and value) that are
+    stored in acquisition_object.dicom_header.
+
+    A rule set is a dict with any of:
+        tags: ['(0018,0080)', ...]       -- exact tags
+        groups: ['0028', ...]            -- every tag of a group
+        keywords: ['Manufacturer', ...]  -- case-insensitive part of the tag description
+        private: true                    -- tags of odd (private) groups
+    A row is kept if it matches the allow rules (or there are none) and does not match the
+    deny rules.  Rows of a sequence item match on the sequence tag (tag1) or the item tag (tag2).
+    """
+
+    def __init__(self, allow: dict=None, deny: dict=None):
+
+        self.allow = self.prepare_rules(allow)
+        self.deny = self.prepare_rules(deny)
+
+    @staticmethod
+    def prepare_rules(rules: dict) -> dict:
+
+        if not rules:
+            return None
+
+        return {
+            'tags': {normalize_tag(tag) for tag in rules.get('tags', [])},
+            'groups': {normalize_tag(group) for group in rules.get('groups', [])},
+            'keywords': [keyword.lower() for keyword in rules.get('keywords', [])],
+            'private': bool(rules.get('private', False))
+        }
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """
+        Builds the projection selected by xnat.dicom_projection.profile.  Returns None when
+        the projection is disabled, i.e. the whole dump is stored.
+        """
+
+        projection_config = config.get('xnat', {}).get('dicom_projection', {})
+
+        if not projection_config.get('enabled', False):
+            return None
+
+        profile_name = projection_config.get('profile', 'default')
+        profile = projection_config.get('profiles', {}).get(profile_name)
+
+        if profile is None:
+            raise ValueError(f"DICOM projection profile {profile_name} is not defined.")
+
+        return cls(profile.get('allow'), profile.get('deny'))
+
+    @staticmethod
+    def matches(row: dict, rules: dict) -> bool:
+
+        for tag in (normalize_tag(row.get('tag1')), normalize_tag(row.get('tag2'))):
+
+            if not tag:
+                continue
+
+            if tag in rules['tags'] or tag[:4] in rules['groups']:
+                return True
+
+            if rules['private'] and is_private_tag(tag):
+                return True
+
+        description = str(row.get('desc') or '').lower()
+
+        return any(keyword in description for keyword in rules['keywords'])
+
+    def keep(self, row: dict) -> bool:
+
+        if self.deny and self.matches(row, self.deny):
+            return False
+
+        return self.allow is None or self.matches(row, self.allow)
+
+    def apply(self, row_list: list) -> list:
+        """
+        Returns the rows of a DICOM dump that pass the projection.
+        """
+
+        if row_list is None:
+            return None
+
+        return [row for row in row_list if self.keep(row)]
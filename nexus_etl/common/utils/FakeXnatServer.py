@@ -0,0 +1,524 @@
+import io
+import os
+import csv
+import json
+import time
+import random
+import zipfile
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from XnatSnapshot import generate_snapshot_key
+
+
+dicom_session_type = 'xnat:mrSessionData'
+non_dicom_session_type = 'fif:megEegSessionData'
+session_form_key = 'a1b2c3d4-0000-4000-8000-000000000001'
+
+
+class SyntheticXnat:
+    """
+    A small, deterministic XNAT project: subjects with DICOM (MR) and non-DICOM (MEG)
+    sessions and scans, a session form and the responses of all endpoints read by
+    src_to_dw/get_xnat_data.py.
+    """
+
+    def __init__(self, project_id: str='nexus1', subject_count: int=10, sessions_per_subject: int=2, scans_per_session: int=5, seed: int=0):
+
+        generator = random.Random(seed)
+
+        self.project_id = project_id
+        self.subject_list = []
+        self.session_list = []
+        self.scan_list = []
+
+        for subject_number in range(1, subject_count + 1):
+
+            subject = {
+                'ID': f'XNAT_S{subject_number:05d}',
+                'label': f'SUB{subject_number:03d}',
+                'project': project_id,
+                'xnat:subjectdata/custom_fields': json.dumps({'handedness': generator.choice(['left', 'right'])})
+            }
+            self.subject_list.append(subject)
+
+            for session_number in range(1, sessions_per_subject + 1):
+
+                session_type = dicom_session_type if session_number % 2 else non_dicom_session_type
+                session = {
+                    'ID': f'XNAT_E{len(self.session_list) + 1:05d}',
+                    'label': f"{subject['label']}_{'MR' if session_type == dicom_session_type else 'MEG'}{session_number}",
+                    'subject_label': subject['label'],
+                    'xsiType': session_type,
+                    'date': f'2023-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}',
+                    'time': f'{generator.randint(8, 18):02d}:{generator.choice(["00", "30"])}:00',
+                    'custom_fields': ''
+                }
+
+                # the MR sessions answer the session form (see form_schema)
+                if session_type == dicom_session_type:
+                    session['custom_fields'] = json.dumps({
+                        session_form_key: {
+                            'sleepiness': 'sleepy' if len(self.session_list) % 3 == 0 else 'awake',
+                            'notes': f"Session {session['label']}"
+                        }
+                    })
+
+                self.session_list.append(session)
+
+                for scan_number in range(1, scans_per_session + 1):
+                    self.scan_list.append({
+                        'session': session,
+                        'ID': str(scan_number),
+                        'type': generator.choice(['T1w', 'T2w', 'bold', 'dwi']) if session_type == dicom_session_type else 'meg',
+                        'modality': 'MR' if session_type == dicom_session_type else 'MEG',
+                        'last_modified': f"{session['date']} 12:00:00.0",
+                        'manufacturer': 'SIEMENS' if session_type == dicom_session_type else 'Elekta',
+                        'model': generator.choice(['Prisma', 'Skyra']) if session_type == dicom_session_type else 'TRIUX'
+                    })
+
+    def project_xml(self) -> str:
+
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<xnat:Project ID="{self.project_id}" active="active" xmlns:xnat="http://nrg.wustl.edu/xnat">'
+            f'<xnat:name>Synthetic project {self.project_id}</xnat:name>'
+            '<xnat:description>Synthetic project served by FakeXnatServer.py</xnat:description>'
+            '<xnat:acquisition_site>Local</xnat:acquisition_site>'
+            '</xnat:Project>'
+        )
+
+    def subject_xml(self, subject_label: str) -> str:
+
+        subject = next((subject for subject in self.subject_list if subject_label in (subject['ID'], subject['label'])), None)
+
+        if subject is None:
+            return None
+
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<xnat:Subject ID="{subject["ID"]}" project="{self.project_id}" label="{subject["label"]}" xmlns:xnat="http://nrg.wustl.edu/xnat">'
+            f'<xnat:custom_fields>{subject["xnat:subjectdata/custom_fields"]}</xnat:custom_fields>'
+            '</xnat:Subject>'
+        )
+
+    def experiment_rows(self, params: dict) -> list:
+        """
+        Answers the experiment and scan searches of pyxnat's array interface.
+        """
+
+        experiment_type = params.get('xsiType', 'xnat:subjectAssessorData')
+        column_list = params.get('columns', '').split(',')
+        scan_search = any(column.lower().startswith('xnat:imagescandata/') for column in column_list)
+        type_prefix = experiment_type.lower()
+
+        row_list = []
+
+        for session in self.session_list:
+
+            if experiment_type != 'xnat:subjectAssessorData' and session['xsiType'] != experiment_type:
+                continue
+            if params.get('xnat:subjectData/label') not in (None, session['subject_label']):
+                continue
+            if params.get('label') not in (None, session['label']) or params.get('ID') not in (None, session['ID']):
+                continue
+
+            session_row = {
+                'ID': session['ID'],
+                'project': self.project_id,
+                'subject_label': session['subject_label'],
+                f'{type_prefix}/label': session['label'],
+                f'{type_prefix}/date': session['date'],
+                f'{type_prefix}/time': session['time'],
+                f'{type_prefix}/custom_fields': session['custom_fields']
+            }
+
+            if not scan_search:
+                row_list.append(session_row)
+                continue
+
+            for scan in self.scan_list:
+
+                if scan['session'] is not session:
+                    continue
+
+                row_list.append(dict(session_row, **{
+                    'xnat:imagescandata/id': scan['ID'],
+                    'xnat:imagescandata/type': scan['type'],
+                    'xnat:imagescandata/meta/insert_date': scan['last_modified'],
+                    'xnat:imagescandata/meta/last_modified': scan['last_modified'],
+                    'xnat:imagescandata/quality': 'usable',
+                    'xnat:imagescandata/modality': scan['modality'],
+                    'xnat:imagescandata/scanner/model': scan['model'],
+                    'xnat:imagescandata/scanner/manufacturer': scan['manufacturer'],
+                    'xnat:imagescandata/series_description': scan['type'],
+                    'xnat:imagescandata/starttime': session['time'],
+                    'xnat:imagescandata/start_date': session['date']
+                }))
+
+        return row_list
+
+    def project_experiment_rows(self) -> list:
+
+        return [{'ID': session['ID'], 'xsiType': session['xsiType']} for session in self.session_list]
+
+    def dicom_tags(self, scan: dict) -> list:
+        """
+        Returns the (tag, vr, description, value) tuples of the header of a DICOM scan.
+        """
+
+        return [
+            ('(0008,0020)', 'DA', 'Study Date', scan['session']['date'].replace('-', '')),
+            ('(0008,0060)', 'CS', 'Modality', scan['modality']),
+            ('(0008,0070)', 'LO', 'Manufacturer', scan['manufacturer']),
+            ('(0008,103E)', 'LO', 'Series Description', scan['type']),
+            ('(0008,1090)', 'LO', "Manufacturer's Model Name", scan['model']),
+            ('(0010,0010)', 'PN', "Patient's Name", scan['session']['subject_label']),
+            ('(0018,0080)', 'DS', 'Repetition Time', '2000'),
+            ('(0018,0081)', 'DS', 'Echo Time', '30'),
+            ('(0020,000E)', 'UI', 'Series Instance UID', f"1.2.826.0.1.{int(scan['session']['ID'][6:])}.{scan['ID']}")
+        ]
+
+    def dicom_dump(self, experiment_id: str, scan_id: str) -> dict:
+
+        scan = next((scan for scan in self.scan_list if experiment_id in (scan['session']['ID'], scan['session']['label']) and scan['ID'] == scan_id), None)
+
+        if scan is None:
+            return None
+
+        return {
+            'ResultSet': {
+                'Result': [
+                    {'tag1': tag, 'tag2': '', 'vr': vr, 'desc': desc, 'value': value}
+                    for tag, vr, desc, value in self.dicom_tags(scan)
+                ]
+            }
+        }
+
+    def write_archive(self, archive_root: str, files_per_scan: int=2, missing_fraction: float=0.0, seed: int=0) -> int:
+        """
+        Description:
+        Writes the DICOM scans as files in the layout of the XNAT archive
+        ({project}/arc001/{session}/SCANS/{scan}/DICOM), with the same header as dicomdump
+        answers and a few KB of pixel data, for DicomArchiveReader.  Needs pydicom.
+
+        Keyword Arguments:
+        archive_root -- the directory the archive is written to
+        files_per_scan -- the number of DICOM files written per scan
+        missing_fraction -- the fraction of scans left out, which are read through dicomdump
+
+        Returns:
+        The number of scans written.
+        """
+
+        try:
+            import pydicom
+            from pydicom.dataset import Dataset, FileMetaDataset
+            from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+        except ImportError:
+            raise ValueError("pydicom is needed to write a synthetic DICOM archive.")
+
+        generator = random.Random(seed)
+        scan_count = 0
+
+        for scan in self.scan_list:
+
+            if scan['session']['xsiType'] != dicom_session_type or generator.random() < missing_fraction:
+                continue
+
+            scan_directory = os.path.join(archive_root, self.project_id, 'arc001', scan['session']['label'], 'SCANS', scan['ID'], 'DICOM')
+            os.makedirs(scan_directory, exist_ok=True)
+
+            # XNAT keeps a catalog next to the files
+            with open(os.path.join(scan_directory, 'scan_catalog.xml'), 'w') as catalog_file:
+                catalog_file.write('<?xml version="1.0" encoding="UTF-8"?><cat:DCMCatalog xmlns:cat="http://nrg.wustl.edu/catalog"/>')
+
+            for file_number in range(1, files_per_scan + 1):
+
+                dataset = Dataset()
+
+                for tag, vr, desc, value in self.dicom_tags(scan):
+                    dataset.add_new(int(tag.strip('()').replace(',', ''), 16), vr, value)
+
+                dataset.InstanceNumber = file_number
+                dataset.SOPInstanceUID = generate_uid()
+                dataset.Rows = 32
+                dataset.Columns = 32
+                dataset.BitsAllocated = 16
+                dataset.add_new(0x7FE00010, 'OW', bytes(32 * 32 * 2))
+
+                dataset.file_meta = FileMetaDataset()
+                dataset.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+                dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+                dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                dataset.preamble = b'\x00' * 128
+
+                pydicom.dcmwrite(os.path.join(scan_directory, f"{scan['ID']}-{file_number}.dcm"), dataset)
+
+            scan_count += 1
+
+        return scan_count
+
+    def scan_json(self, experiment_id: str, scan_id: str) -> dict:
+
+        scan = next(
+            (scan for scan in self.scan_list if experiment_id in (scan['session']['ID'], scan['session']['label']) and scan['ID'] == scan_id),
+            None
+        )
+
+        if scan is None:
+            return None
+
+        return {
+            'items': [{
+                'data_fields': {
+                    'ID': scan['ID'],
+                    'type': scan['type'],
+                    'parameters/bids_TaskName': 'rest',
+                    'parameters/bids_SamplingFrequency': '1000',
+                    'parameters/gnmd_PowerLineFrequency': '50',
+                    'parameters/comments': 'not exported'
+                }
+            }]
+        }
+
+    def form_schema(self, datatype: str) -> dict:
+
+        if datatype != dicom_session_type:
+            return {'components': []}
+
+        return {
+            'components': [{
+                'title': 'Session notes',
+                'components': [{
+                    'key': session_form_key,
+                    'label': 'Session notes',
+                    'type': 'panel',
+                    'components': [
+                        {'key': 'sleepiness', 'label': 'Sleepiness', 'type': 'select', 'values': [
+                            {'label': 'Awake', 'value': 'awake'},
+                            {'label': 'Sleepy', 'value': 'sleepy'}
+                        ]},
+                        {'key': 'notes', 'label': 'Notes', 'type': 'textarea'}
+                    ]
+                }]
+            }]
+        }
+
+    def session_datatypes(self) -> list:
+
+        return ['xnat:subjectData', 'xnat:imageSessionData', dicom_session_type, non_dicom_session_type, 'xnat:petSessionData']
+
+
+class FakeXnatRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the XNAT endpoints used by this project from the server's synthetic project
+    or snapshot, after the configured latency and with the configured error rate.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def answer(self, method: str) -> None:
+
+        # drain the request body so the connection can be kept alive
+        self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+
+        self.server.count_request()
+
+        latency = self.server.latency + random.uniform(-self.server.jitter, self.server.jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+        if random.random() < self.server.error_rate:
+            return self.send_body(self.server.error_status, 'text/plain', b'Injected error')
+
+        split_url = urlsplit(self.path)
+        path = '/' + '/'.join(part for part in split_url.path.split('/') if part)
+        params = {key: value_list[-1] for key, value_list in parse_qs(split_url.query, keep_blank_values=True).items()}
+
+        if path.endswith('/data/JSESSION'):
+            return self.send_body(200, 'text/plain', b'FAKEXNATSESSION')
+
+        if self.server.snapshot is not None:
+            return self.answer_from_snapshot(method)
+
+        return self.answer_synthetic(path, params)
+
+    def answer_from_snapshot(self, method: str) -> None:
+
+        snapshot_key = generate_snapshot_key(method, self.path)
+
+        try:
+            with self.server.snapshot_lock:
+                metadata = json.loads(self.server.snapshot.read(f"{snapshot_key}.json"))
+                content = self.server.snapshot.read(f"{snapshot_key}.body")
+        except KeyError:
+            return self.send_body(404, 'text/plain', b'Not in snapshot')
+
+        self.send_body(metadata['status_code'], metadata['headers'].get('Content-Type', 'text/plain'), content)
+
+    def answer_synthetic(self, path: str, params: dict) -> None:
+
+        xnat = self.server.xnat
+        part_list = path.strip('/').split('/')
+
+        if part_list[0] == 'REST' and part_list[1:3] == ['services', 'dicomdump']:
+            src_part_list = params.get('src', '').strip('/').split('/')
+            # /archive/projects/{project}/experiments/{experiment}/scans/{scan}
+            return self.send_json(xnat.dicom_dump(src_part_list[4], src_part_list[6]) if len(src_part_list) > 6 else None)
+
+        if path == '/xapi/customforms/element':
+            return self.send_json(xnat.form_schema(params.get('xsiType')))
+
+        if path == '/xapi/schemas/datatypes':
+            return self.send_json(xnat.session_datatypes())
+
+        if path == '/data/experiments':
+            return self.send_rows(xnat.experiment_rows(params), params.get('format', 'json'))
+
+        if part_list[:2] == ['data', 'projects'] and len(part_list) > 2:
+
+            if part_list[2] != xnat.project_id:
+                return self.send_body(404, 'text/plain', b'Project not found')
+
+            if len(part_list) == 3:
+                return self.send_body(200, 'text/xml', xnat.project_xml().encode('utf-8'))
+
+            if part_list[3:] == ['subjects']:
+                return self.send_rows(xnat.subject_list, params.get('format', 'json'))
+
+            if part_list[3:] == ['experiments']:
+                return self.send_rows(xnat.project_experiment_rows(), params.get('format', 'json'))
+
+            if part_list[3] == 'subjects' and len(part_list) == 5:
+                subject_xml = xnat.subject_xml(part_list[4])
+                if subject_xml is None:
+                    return self.send_body(404, 'text/plain', b'Subject not found')
+                return self.send_body(200, 'text/xml', subject_xml.encode('utf-8'))
+
+            # /data/projects/{project}/subjects/{subject}/experiments/{experiment}/scans/{scan}
+            if len(part_list) == 9 and part_list[5] == 'experiments' and part_list[7] == 'scans':
+                return self.send_json(xnat.scan_json(part_list[6], part_list[8]))
+
+        self.send_body(404, 'text/plain', b'Unknown endpoint')
+
+    def send_json(self, content) -> None:
+
+        if content is None:
+            return self.send_body(404, 'text/plain', b'Not found')
+
+        self.send_body(200, 'application/json', json.dumps(content).encode('utf-8'))
+
+    def send_rows(self, row_list: list, response_format: str) -> None:
+
+        if response_format == 'csv':
+
+            column_list = list(dict.fromkeys(column for row in row_list for column in row))
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=column_list, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(row_list)
+
+            return self.send_body(200, 'text/csv', buffer.getvalue().encode('utf-8'))
+
+        self.send_json({'ResultSet': {'Result': row_list, 'totalRecords': str(len(row_list))}})
+
+    def send_body(self, status_code: int, content_type: str, content: bytes) -> None:
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class FakeXnatServer(ThreadingHTTPServer):
+    """
+    A local stand-in for XNAT, to benchmark and test the extraction without a network.
+
+    Responses come from a snapshot recorded with XNAT_SNAPSHOT_MODE=record, or from a
+    synthetic project.  Every request waits latency +/- jitter seconds and fails with
+    error_status with probability error_rate.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int=8080, xnat: SyntheticXnat=None, snapshot_path: str=None, latency: float=0.0, jitter: float=0.0, error_rate: float=0.0, error_status: int=503, verbose: bool=False):
+
+        super().__init__(('127.0.0.1', port), FakeXnatRequestHandler)
+
+        self.xnat = xnat or SyntheticXnat()
+        self.snapshot = zipfile.ZipFile(snapshot_path, 'r') if snapshot_path else None
+        self.snapshot_lock = threading.Lock()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.verbose = verbose
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+
+    def count_request(self) -> None:
+
+        with self.request_count_lock:
+            self.request_count += 1
+
+
+if __name__ == "__main__":
+
+    # python FakeXnatServer.py --port 8080 --latency-ms 50 --jitter-ms 20 --error-rate 0.01
+    # then point sensitive/xnat_config.cfg (and the XNAT server in the config) at http://127.0.0.1:8080
+    parser = argparse.ArgumentParser(description='Local stand-in for the XNAT endpoints used by src_to_dw.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--snapshot', help='serve the responses of a recorded snapshot archive')
+    parser.add_argument('--project', default='nexus1', help='ID of the synthetic project')
+    parser.add_argument('--subjects', type=int, default=10)
+    parser.add_argument('--sessions-per-subject', type=int, default=2)
+    parser.add_argument('--scans-per-session', type=int, default=5)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with --error-status')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--write-archive', help='also write the DICOM scans as files below this archive root (needs pydicom)')
+    parser.add_argument('--archive-missing-fraction', type=float, default=0.0, help='fraction of scans left out of the archive')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    xnat = SyntheticXnat(args.project, args.subjects, args.sessions_per_subject, args.scans_per_session)
+
+    if args.write_archive:
+        scan_count = xnat.write_archive(args.write_archive, missing_fraction=args.archive_missing_fraction)
+        print(f"Wrote {scan_count} DICOM scans to {args.write_archive}")
+
+    server = FakeXnatServer(
+        port=args.port,
+        xnat=xnat,
+        snapshot_path=args.snapshot,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        verbose=args.verbose
+    )
+
+    print(f"Fake XNAT listening on http://127.0.0.1:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Answered {server.request_count} requests.")
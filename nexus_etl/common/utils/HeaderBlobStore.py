@@ -0,0 +1,268 @@
+import ast
+import json
+import zlib
+import hashlib
+from LoadInitialization import get_env_variables
+from DbConnection import connect_to_db
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Load the environment variables
+config = get_env_variables()
+
+blob_config = config.get('xnat', {}).get('header_blob', {})
+
+# zstd is used when configured and the zstandard package is installed, zlib otherwise
+blob_codec = 'zstd' if blob_config.get('codec', 'zstd') == 'zstd' and zstandard is not None else 'zlib'
+blob_level = blob_config.get('level', 9)
+
+reference_prefix = 'header_blob:'
+
+engine = connect_to_db()
+
+
+def create_blob_table() -> None:
+    """
+    Creates the header_blob table for databases that were initialized before it existed.
+    """
+
+    engine.execute("""
+        create table if not exists header_blob
+        (
+            blob_hash text primary key,
+            codec text not null,
+            size integer not null,
+            content blob not null
+        )
+    """)
+    engine.commit()
+
+
+def compress(content: bytes, codec: str) -> bytes:
+
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=blob_level).compress(content)
+
+    return zlib.compress(content, blob_level)
+
+
+def decompress(content: bytes, codec: str) -> bytes:
+
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("The zstandard package is needed to read header blobs stored with zstd.")
+        return zstandard.ZstdDecompressor().decompress(content)
+
+    return zlib.decompress(content)
+
+
+def split_header(header) -> list:
+    """
+    Splits a header into the parts stored as separate blobs.  A DICOM dump is split by tag
+    group, so e.g. the acquisition parameters (0018) shared by the scans of a protocol are
+    stored once even though the UIDs (0020) of every scan differ.  Other headers are one part.
+    """
+
+    if not isinstance(header, list):
+        return [header]
+
+    group_dict = {}
+
+    for row in header:
+        group = ''.join(char for char in str(row.get('tag1') or '') if char.isalnum())[:4].upper()
+        group_dict.setdefault(group, []).append(row)
+
+    return list(group_dict.values())
+
+
+def store_headers(header_list: list) -> list:
+    """
+    Description:
+    Stores headers in the content-addressed header_blob table and returns the references
+    kept in acquisition_object instead of the headers.  A blob is keyed by the SHA-256 of
+    its canonical JSON, so identical parts are stored once.
+
+    Keyword Arguments:
+    header_list -- DICOM dumps (lists of tag rows) or non-DICOM headers (dicts); None is kept
+
+    Returns:
+    The list of references, e.g. 'header_blob:<hash>,<hash>', in the order of header_list.
+    """
+
+    create_blob_table()
+
+    reference_list = []
+    blob_dict = {}
+
+    for header in header_list:
+
+        if header is None:
+            reference_list.append(None)
+            continue
+
+        hash_list = []
+
+        for part in split_header(header):
+
+            content = json.dumps(part, sort_keys=True, separators=(',', ':')).encode('utf-8')
+            blob_hash = hashlib.sha256(content).hexdigest()
+            hash_list.append(blob_hash)
+
+            if blob_hash not in blob_dict:
+                blob_dict[blob_hash] = content
+
+        # a DICOM dump is a list even if it has one part
+        kind = 'list' if isinstance(header, list) else 'object'
+        reference_list.append(f"{reference_prefix}{kind}:{','.join(hash_list)}")
+
+    cursor = engine.cursor()
+    cursor.executemany(
+        "insert or ignore into header_blob (blob_hash, codec, size, content) values (?, ?, ?, ?)",
+        [
+            (blob_hash, blob_codec, len(content), compress(content, blob_codec))
+            for blob_hash, content in blob_dict.items()
+        ]
+    )
+    engine.commit()
+
+    return reference_list
+
+
+def is_reference(value) -> bool:
+
+    return isinstance(value, str) and value.startswith(reference_prefix)
+
+
+def resolve_header(value, blob_cache: dict=None):
+    """
+    Description:
+    Returns the header a reference points to.  Headers stored before the blob table existed
+    (the string representation of the header) are parsed and returned as well.
+
+    Keyword Arguments:
+    value -- the dicom_header or non_dicom_header value of an acquisition_object row
+    blob_cache -- optional dict of decoded blobs shared between calls
+    """
+
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+
+    if not is_reference(value):
+        return ast.literal_eval(value) if isinstance(value, str) else value
+
+    kind, hash_string = value[len(reference_prefix):].split(':', 1)
+    blob_cache = {} if blob_cache is None else blob_cache
+    part_list = []
+
+    # an empty DICOM dump has no parts
+    for blob_hash in filter(None, hash_string.split(',')):
+
+        if blob_hash not in blob_cache:
+
+            row = engine.execute(
+                "select codec, content from header_blob where blob_hash = ?",
+                (blob_hash,)
+            ).fetchone()
+
+            if row is None:
+                raise ValueError(f"Header blob {blob_hash} does not exist.")
+
+            blob_cache[blob_hash] = json.loads(decompress(row[1], row[0]))
+
+        part_list.append(blob_cache[blob_hash])
+
+    if kind == 'list':
+        return [row for part in part_list for row in part]
+
+    return part_list[0]
+
+
+def resolve_header_column(series):
+    """
+    Resolves a column of header references, e.g. df['dicom_header'], to the string
+    representation of the headers that acquisition_object rows held before (str(header)).
+    """
+
+    blob_cache = {}
+
+    return series.apply(
+        lambda value: str(resolve_header(value, blob_cache)) if is_reference(value) else value
+    )
+
+
+def get_blob_hashes(value_list) -> set:
+    """
+    Returns the hashes of the blobs the header references in value_list point to; values
+    that are not references are ignored.
+    """
+
+    blob_hash_set = set()
+
+    for value in value_list:
+        if is_reference(value):
+            blob_hash_set.update(filter(None, value[len(reference_prefix):].split(':', 1)[1].split(',')))
+
+    return blob_hash_set
+
+
+def purge_unreferenced_blobs(blob_hash_list) -> int:
+    """
+    Description:
+    Deletes the given blobs if no acquisition_object row refers to them anymore.  The loader
+    passes the blobs of the headers it replaced or removed, so a load that drops no header
+    does not touch the table, and the references are split and compared inside SQLite.
+
+    Keyword Arguments:
+    blob_hash_list -- the hashes of the blobs that may have become unreferenced
+
+    Returns:
+    int: The number of blobs removed.
+    """
+
+    if not blob_hash_list:
+        return 0
+
+    create_blob_table()
+
+    cursor = engine.cursor()
+
+    cursor.execute("create temp table if not exists purge_candidate (blob_hash text primary key)")
+    cursor.execute("delete from purge_candidate")
+    cursor.executemany(
+        "insert or ignore into purge_candidate (blob_hash) values (?)",
+        [(blob_hash,) for blob_hash in blob_hash_list]
+    )
+
+    # a reference is 'header_blob:<kind>:<hash>,<hash>,...'; the recursive part splits off
+    # one hash at a time
+    cursor.execute(f"""
+        delete from header_blob
+        where blob_hash in (select blob_hash from purge_candidate)
+        and blob_hash not in (
+            with recursive reference_part(blob_hash, rest) as (
+                select
+                    null,
+                    substr(reference, {len(reference_prefix)} + instr(substr(reference, {len(reference_prefix) + 1}), ':') + 1) || ','
+                from (
+                    select dicom_header reference from acquisition_object
+                    union all
+                    select non_dicom_header from acquisition_object
+                )
+                where reference like '{reference_prefix}%'
+                union all
+                select
+                    substr(rest, 1, instr(rest, ',') - 1),
+                    substr(rest, instr(rest, ',') + 1)
+                from reference_part
+                where rest <> ''
+            )
+            select blob_hash from reference_part where blob_hash is not null
+        )
+    """)
+    removed_count = cursor.rowcount
+    engine.commit()
+
+    return removed_count
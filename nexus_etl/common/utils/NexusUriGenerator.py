@@ -32,12 +32,13 @@ def generate_uri_column(df: pd.DataFrame, uri_field_name: str, nexus_uri_base: s
     # Create a new column in the DataFrame for the URI. The URI is generated using the fields in uri_salt_field_list and a random salt.
     if len(df) > 0:
         df[uri_field_name] = df.assign(_salt=uri_salt).apply(lambda x: generate_uri(nexus_uri_base, uri_salt_delimiter.join(x[uri_salt_field_list].fillna('').astype('str'))), axis=1)
-
-        uri_salt_field_list.remove('_salt')
     
     else:
         df[uri_field_name] = None
 
+    # the list is usually the caller's primary key, which is used again after this
+    uri_salt_field_list.remove('_salt')
+
     return df
 
 def generate_uri(nexus_uri_base: str, seed_value: str) -> str:
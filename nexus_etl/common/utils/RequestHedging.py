@@ -0,0 +1,80 @@
+import math
+import threading
+from collections import deque
+
+
+class RequestHedger:
+    """
+    Decides when a slow, idempotent request to one class of endpoint is worth sending a
+    second time.
+
+    The latencies of recent requests are kept; once min_samples are known, a request that
+    has not answered within the given percentile of them (and at least min_delay seconds)
+    may be hedged.  Hedges are only allowed while they stay below budget_fraction of all
+    requests, which caps the extra load on XNAT.
+    """
+
+    def __init__(self, name: str, percentile: float=95.0, min_samples: int=20, budget_fraction: float=0.05, min_delay: float=0.5, sample_size: int=200):
+
+        self.name = name
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget_fraction = budget_fraction
+        self.min_delay = min_delay
+
+        self.latencies = deque(maxlen=sample_size)
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self.lock = threading.Lock()
+
+    def record_latency(self, latency: float) -> None:
+
+        with self.lock:
+            self.latencies.append(latency)
+
+    def hedge_delay(self) -> float:
+        """
+        Returns the number of seconds to wait for the first request before hedging it,
+        or None while there are not enough samples to tell what slow is.
+        """
+
+        with self.lock:
+
+            self.requests += 1
+
+            if len(self.latencies) < self.min_samples:
+                return None
+
+            sorted_latencies = sorted(self.latencies)
+            position = min(len(sorted_latencies) - 1, math.ceil(self.percentile / 100 * len(sorted_latencies)) - 1)
+
+            return max(self.min_delay, sorted_latencies[position])
+
+    def acquire_hedge(self) -> bool:
+        """
+        Takes a hedge from the budget.  Returns False if the budget is used up.
+        """
+
+        with self.lock:
+
+            if self.fired + 1 > self.budget_fraction * self.requests:
+                return False
+
+            self.fired += 1
+
+            return True
+
+    def record_win(self) -> None:
+
+        with self.lock:
+            self.won += 1
+
+    def metrics(self) -> dict:
+
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'hedges_fired': self.fired,
+                'hedges_won': self.won
+            }
@@ -0,0 +1,238 @@
+import sqlite3 as sl
+import numpy as np
+import pandas as pd
+from DeltaCalcUtils import hash_pk_fields, get_content_columns
+from WriteToDb import to_db_value
+from DatatypeConverter import convert_datatypes_based_on_table
+
+# The alternative to DeltaCalcUtils.calculate_delta for tables with large partitions: the
+# incoming records are staged in a temporary table and compared against the stored records
+# inside SQLite, on their primary key and their content hash ("_hash"), so the existing
+# partition is never read into pandas.  Only the records that changed come back.
+
+stage_table_name = 'delta_stage'
+
+
+def get_table_columns(con: sl.Connection, table_name: str) -> list:
+
+    return [row[1] for row in con.execute(f'pragma table_info("{table_name}")')]
+
+
+def get_partition_filter(partition: dict, alias: str) -> tuple:
+    """
+    Builds the where clause selecting a partition, e.g. one project or one session, of a
+    table.  Like the delete_existing_data functions of the loaders, a key whose value is
+    None does not restrict the partition.
+
+    Args:
+    partition (dict): The column names and values of the partition.
+    alias (str): The alias of the table in the query.
+
+    Returns:
+    tuple: The where clause and its named parameters.
+    """
+
+    condition_list = ['1 = 1']
+    params = {}
+
+    for position, (column, value) in enumerate(partition.items()):
+
+        if value is None:
+            continue
+
+        condition_list.append(f'{alias}."{column}" = :partition_{position}')
+        params[f'partition_{position}'] = value
+
+    return ' and '.join(condition_list), params
+
+
+def get_key_join(pk_fields: list, left_alias: str, right_alias: str) -> str:
+    # "is" instead of "=", so a null in a primary key field matches a null as it does in pandas
+
+    return ' and '.join(f'{left_alias}."{column}" is {right_alias}."{column}"' for column in pk_fields)
+
+
+def create_key_index(con: sl.Connection, table_name: str, partition: dict, pk_fields: list) -> None:
+    """
+    Creates the index the records of a table are looked up by, on the partition columns
+    followed by the rest of the primary key, for databases initialized before schema.sql
+    had it.
+    """
+
+    column_list = list(partition) + [column for column in pk_fields if column not in partition]
+
+    con.execute(f"""
+        create index if not exists "ix_{table_name}__delta_key"
+        on "{table_name}" ({', '.join(f'"{column}"' for column in column_list)})
+    """)
+    con.commit()
+
+
+def add_missing_hashes(con: sl.Connection, table_name: str, partition: dict, uri_field_name: str) -> int:
+    """
+    Stores the content hash of the records of the partition written before the "_hash"
+    column existed, as add_content_hash would have when they were written, so they can be
+    compared in the database.  This reads only those records, once.
+
+    Returns:
+    int: The number of records hashed.
+    """
+
+    filter_sql, params = get_partition_filter(partition, 't')
+
+    missing_df = pd.read_sql(
+        f'select t.rowid as delta_rowid, t.* from "{table_name}" t where {filter_sql} and t."_hash" is null',
+        con,
+        params=params
+    )
+
+    if len(missing_df) == 0:
+        return 0
+
+    rowid_list = missing_df.pop('delta_rowid').tolist()
+    missing_df = convert_datatypes_based_on_table(table_name, missing_df).replace({np.nan: None})
+    missing_df = hash_pk_fields(missing_df, get_content_columns(missing_df.columns, uri_field_name))
+
+    con.executemany(
+        f'update "{table_name}" set "_hash" = ? where rowid = ?',
+        [(int(row_hash), rowid) for row_hash, rowid in zip(missing_df['hash'], rowid_list)]
+    )
+    con.commit()
+
+    return len(rowid_list)
+
+
+def stage_new_data(con: sl.Connection, table_name: str, new_df: pd.DataFrame, uri_field_name: str, pk_fields: list) -> None:
+    """
+    Loads the primary key, the content hash and the position of the incoming records into
+    the temporary staging table.  The staging table is created from the target table, so
+    its columns have the same type affinity and compare the same way.
+    """
+
+    con.execute(f'drop table if exists temp."{stage_table_name}"')
+    con.execute(f"""
+        create temp table "{stage_table_name}" as
+        select {', '.join(f'"{column}"' for column in pk_fields)}, "_hash", 0 as delta_row
+        from "{table_name}"
+        where 0
+    """)
+
+    if len(new_df) > 0:
+
+        content_columns = get_content_columns(get_table_columns(con, table_name), uri_field_name)
+        new_hash = hash_pk_fields(new_df.reindex(columns=content_columns), content_columns)['hash'].values
+
+        key_df = new_df[pk_fields].astype(object)
+
+        con.executemany(
+            f'insert into temp."{stage_table_name}" values ({", ".join("?" * (len(pk_fields) + 2))})',
+            [
+                tuple(to_db_value(value) for value in key) + (int(row_hash), position)
+                for position, (key, row_hash) in enumerate(zip(key_df.itertuples(index=False, name=None), new_hash))
+            ]
+        )
+
+    con.execute(f"""
+        create index temp."ix_{stage_table_name}__key"
+        on "{stage_table_name}" ({', '.join(f'"{column}"' for column in pk_fields)})
+    """)
+
+
+def calculate_delta_in_db(con: sl.Connection, table_name: str, partition: dict, new_df: pd.DataFrame, uri_field_name: str, pk_fields: list) -> pd.DataFrame:
+    """
+    Calculates the delta between the stored records of a partition and the incoming records
+    inside SQLite.  The incoming records are staged with their content hash; the ones whose
+    primary key and hash are not stored (except) are updates if their primary key is stored
+    and inserts otherwise, stored records whose primary key was not staged are deletes.
+
+    Unlike calculate_delta, the unchanged records are not returned: they stay in the table
+    as they are, so the result has to be written with WriteToDb.apply_delta instead of
+    replacing the partition.
+
+    Args:
+    con (sl.Connection): The connection to the database.
+    table_name (str): The table the records are stored in.
+    partition (dict): The column names and values of the partition, see get_partition_filter.
+    new_df (pd.DataFrame): The incoming records, with the datatypes of the table.
+    uri_field_name (str): The field name used for the URI.
+    pk_fields (list): The primary key fields.
+
+    Returns:
+    pd.DataFrame: The INSERT, UPDATE and DELETE records in the layout of calculate_delta.
+    """
+
+    pk_fields = list(pk_fields)
+    new_df = new_df.replace({np.nan: None})
+
+    if len(new_df) > 0 and new_df.duplicated(subset=pk_fields).any():
+        print(pd.concat(g for _, g in new_df.groupby(pk_fields, dropna=False) if len(g) > 1))
+        raise ValueError("Duplicates found in dataframe after delta check.  Dataframe will not be inserted.")
+
+    create_key_index(con, table_name, partition, pk_fields)
+    add_missing_hashes(con, table_name, partition, uri_field_name)
+
+    filter_sql, params = get_partition_filter(partition, 't')
+    key_sql = ', '.join(f'"{column}"' for column in pk_fields)
+
+    duplicate_count = con.execute(f"""
+        select count(*)
+        from (select 1 from "{table_name}" t where {filter_sql} group by {key_sql} having count(*) > 1)
+    """, params).fetchone()[0]
+
+    if duplicate_count > 0:
+        raise ValueError(f"Duplicates found in {table_name} for {partition}.  Dataframe will not be inserted.")
+
+    stage_new_data(con, table_name, new_df, uri_field_name, pk_fields)
+
+    table_columns = get_table_columns(con, table_name)
+    nexus_fields = [uri_field_name, '_createdat', '_updatedat', '_rev', '_hash']
+    prev_nexus_columns = [column for column in sorted(table_columns) if column in nexus_fields]
+    content_columns = [
+        column for column in sorted(set(table_columns) | set(new_df.columns))
+        if column not in nexus_fields
+    ]
+
+    # the staged records that are not stored as they are, with the nexus fields of the stored
+    # record with the same primary key; delta_exists is null for an insert
+    changed_df = pd.read_sql(f"""
+        with changed as (
+            select {key_sql}, "_hash" from temp."{stage_table_name}"
+            except
+            select {key_sql}, "_hash" from "{table_name}" t where {filter_sql}
+        )
+        select
+            s.delta_row,
+            t.rowid as delta_exists,
+            {', '.join(f't."{column}"' for column in prev_nexus_columns)}
+        from changed c
+        join temp."{stage_table_name}" s on {get_key_join(pk_fields, 's', 'c')}
+        left join "{table_name}" t on {get_key_join(pk_fields, 't', 's')} and {filter_sql}
+    """, con, params=params)
+
+    delete_df = pd.read_sql(f"""
+        select {', '.join(f't."{column}"' for column in pk_fields + prev_nexus_columns)}
+        from "{table_name}" t
+        where {filter_sql}
+        and not exists (select 1 from temp."{stage_table_name}" s where {get_key_join(pk_fields, 's', 't')})
+    """, con, params=params)
+
+    con.execute(f'drop table temp."{stage_table_name}"')
+
+    # the content of the inserts and updates is taken from new_df, not read back
+    update_mask = changed_df['delta_exists'].notna().values
+    row_position = changed_df['delta_row'].values.astype('int64')
+
+    update_df = new_df.iloc[row_position[update_mask]].reindex(columns=content_columns)
+    for column in prev_nexus_columns:
+        update_df[column] = changed_df[column].values[update_mask]
+    update_df['delta_action'] = 'UPDATE'
+
+    insert_df = new_df.iloc[row_position[~update_mask]].reindex(columns=content_columns + prev_nexus_columns)
+    insert_df['delta_action'] = 'INSERT'
+
+    delete_df = convert_datatypes_based_on_table(table_name, delete_df)
+    delete_df = delete_df.reindex(columns=content_columns + prev_nexus_columns)
+    delete_df['delta_action'] = 'DELETE'
+
+    return pd.concat([update_df, insert_df, delete_df], ignore_index=True)
+
@@ -0,0 +1,285 @@
+import json
+import codecs
+
+whitespace = ' \t\n\r'
+scalar_end = ',]}' + whitespace
+
+# strings, objects and arrays end with their closing character; numbers and literals only
+# end where the next character does
+closed_value_start = '"{['
+
+# the consumed part of the buffer is dropped once it is this long
+compact_threshold = 65536
+
+
+class JsonStream:
+    """
+    Reads one JSON document from an iterator of byte chunks (e.g. Response.iter_content)
+    and extracts the values at a path without building the rest of the document.
+
+    Only the part of the body that is being looked at is kept in memory: values outside
+    the path are skipped character by character and values that are kept are decoded one
+    at a time, so memory stays bounded by the size of the largest single item instead of
+    the size of the response.
+    """
+
+    def __init__(self, chunk_iter):
+
+        self.chunk_iter = iter(chunk_iter)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+        self.peak_buffer_size = 0
+
+    def read_more(self) -> bool:
+        """
+        Appends the next chunk to the buffer.  What has been consumed is dropped once it
+        passes compact_threshold, not on every read.  Returns False once the input is
+        exhausted.
+        """
+
+        if self.exhausted:
+            return False
+
+        chunk = next(self.chunk_iter, None)
+
+        if chunk is None:
+            self.exhausted = True
+            decoded = self.decoder.decode(b'', final=True)
+        else:
+            decoded = self.decoder.decode(chunk)
+
+        if self.position >= compact_threshold:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+
+        self.buffer += decoded
+        self.peak_buffer_size = max(self.peak_buffer_size, len(self.buffer))
+
+        return True
+
+    def next_char(self) -> str:
+        """
+        Returns the next character that is not whitespace, without consuming it.
+        """
+
+        while True:
+
+            while self.position < len(self.buffer) and self.buffer[self.position] in whitespace:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self.read_more():
+                raise ValueError("Unexpected end of JSON document.")
+
+    def expect(self, char_set: str) -> str:
+
+        char = self.next_char()
+
+        if char not in char_set:
+            raise ValueError(f"Expected one of {char_set!r} in JSON document, found {char!r}.")
+
+        self.position += 1
+
+        return char
+
+    def parse_value(self):
+        """
+        Decodes the next value.  A number or literal is only accepted once the character
+        after it is known to end it, because it may continue in the next chunk; strings,
+        objects and arrays are complete as soon as they decode.
+        """
+
+        closed = self.next_char() in closed_value_start
+
+        while True:
+
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+
+                if closed or (end < len(self.buffer) and self.buffer[end] in scalar_end) or self.exhausted:
+                    self.position = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+
+            self.read_more()
+
+    def skip_value(self) -> None:
+        """
+        Moves past the next value without decoding it.
+        """
+
+        depth = 0
+        in_string = False
+        escaped = False
+        started = False
+
+        self.next_char()
+
+        while True:
+
+            while self.position < len(self.buffer):
+
+                char = self.buffer[self.position]
+
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == '\\':
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                        if depth == 0:
+                            self.position += 1
+                            return
+
+                elif char == '"':
+                    in_string = True
+
+                elif char in '[{':
+                    depth += 1
+
+                elif char in ']}':
+                    if depth == 0:
+                        # the end of the enclosing container ends a scalar
+                        return
+                    depth -= 1
+                    if depth == 0:
+                        self.position += 1
+                        return
+
+                elif depth == 0 and started and char in scalar_end:
+                    return
+
+                started = True
+                self.position += 1
+
+            if not self.read_more():
+                if depth == 0 and started:
+                    return
+                raise ValueError("Unexpected end of JSON document.")
+
+    def iter_object_members(self, key_filter=None):
+        """
+        Yields the (key, value) pairs of the object starting at the current position.
+        Members whose key does not pass key_filter are skipped without being decoded;
+        when key_filter returns 'descend' the value is left unread for the caller.
+        """
+
+        self.expect('{')
+
+        if self.next_char() == '}':
+            self.position += 1
+            return
+
+        while True:
+
+            key = self.parse_value()
+            self.expect(':')
+
+            keep = key_filter(key) if key_filter else True
+
+            if keep == 'descend':
+                yield key, None
+            elif keep:
+                yield key, self.parse_value()
+            else:
+                self.skip_value()
+
+            if self.expect(',}') == '}':
+                return
+
+    def iter_array_items(self):
+        """
+        Yields the items of the array starting at the current position, one at a time.
+        """
+
+        self.expect('[')
+
+        if self.next_char() == ']':
+            self.position += 1
+            return
+
+        while True:
+
+            yield self.parse_value()
+
+            if self.expect(',]') == ']':
+                return
+
+    def seek(self, path: list) -> bool:
+        """
+        Moves to the value at path, a list of object keys and array positions.  Returns
+        False if the path does not exist in the document.
+        """
+
+        for step in path:
+
+            if isinstance(step, int):
+
+                self.expect('[')
+
+                for position in range(step):
+
+                    if self.next_char() == ']':
+                        return False
+
+                    self.skip_value()
+
+                    if self.expect(',]') == ']':
+                        return False
+
+                if self.next_char() == ']':
+                    return False
+
+            else:
+
+                found = False
+
+                for key, value in self.iter_object_members(lambda key: 'descend' if key == step else False):
+                    found = True
+                    break
+
+                if not found:
+                    return False
+
+        return True
+
+
+def stream_array_items(chunk_iter, path: list):
+    """
+    Yields the items of the array at path, e.g. ['ResultSet', 'Result'], one at a time.
+
+    Args:
+    chunk_iter: An iterator of byte chunks holding a JSON document.
+    path (list): Object keys and array positions leading to the array.
+    """
+
+    stream = JsonStream(chunk_iter)
+
+    if stream.seek(path):
+        yield from stream.iter_array_items()
+
+
+def stream_object_members(chunk_iter, path: list, key_filter=None):
+    """
+    Yields the (key, value) pairs of the object at path, e.g. ['items', 0, 'data_fields'],
+    that pass key_filter; other members are skipped without being decoded.
+
+    Args:
+    chunk_iter: An iterator of byte chunks holding a JSON document.
+    path (list): Object keys and array positions leading to the object.
+    key_filter (function, optional): Returns True for the keys to keep.
+    """
+
+    stream = JsonStream(chunk_iter)
+
+    if stream.seek(path):
+        yield from stream.iter_object_members(key_filter)
@@ -1,8 +1,11 @@
 import numpy as np
 import pandas as pd
 import sys
+import sqlite3 as sl
 from io import StringIO
 import logging
+from DeltaCalcUtils import add_content_hash
+from ChangeOutbox import create_outbox_table, record_changes
 
 def replace_special_chars(df: pd.DataFrame, column_list_to_replace: list) -> pd.DataFrame:
     """
@@ -50,4 +53,175 @@ def replace_whitespace_chars(df: pd.DataFrame, column_list_to_replace: list) ->
                     df = df.replace({column_name:{r'\r': r'\\r'}}, regex=True)
                     df = df.replace({column_name:{r'\n': r'\\r'}}, regex=True)
 
-    return df
\ No newline at end of file
+    return df
+
+
+
+def to_db_value(value):
+    """
+    Converts a value of a DataFrame to one sqlite3 binds: missing values become None,
+    timestamps datetime and numpy scalars their Python counterpart, as in DataFrame.to_sql.
+    """
+
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+
+def create_uri_index(con: sl.Connection, table_name: str, uri_field_name: str) -> bool:
+    """
+    Creates the unique index on the URI of a table that apply_delta upserts on.  Records
+    without a URI (e.g. questions without answer options) are not affected by it.
+
+    Returns:
+    bool: False if the table holds duplicate URIs, so the index cannot be created.
+    """
+
+    try:
+        con.execute(f'create unique index if not exists "ux_{table_name}__uri" on "{table_name}" ("{uri_field_name}")')
+        con.commit()
+    except sl.IntegrityError:
+        print(f"{table_name} holds duplicate values of {uri_field_name}; its records are replaced instead of upserted.")
+        return False
+
+    return True
+
+
+
+def get_stored_hashes(con: sl.Connection, table_name: str, uri_field_name: str, uri_list: list) -> dict:
+    # the content hashes of the stored records with the given URIs, by URI
+
+    stored_hash_dict = {}
+
+    for start in range(0, len(uri_list), 500):
+        chunk = uri_list[start:start + 500]
+        stored_hash_dict.update(con.execute(
+            f'select "{uri_field_name}", "_hash" from "{table_name}" where "{uri_field_name}" in ({", ".join("?" * len(chunk))})',
+            chunk
+        ).fetchall())
+
+    return stored_hash_dict
+
+
+
+def apply_delta(con: sl.Connection, table_name: str, load_df: pd.DataFrame, delta_df: pd.DataFrame, uri_field_name: str, pk_fields: list) -> dict:
+    """
+    Writes the result of a delta calculation to a table, touching only the records that
+    changed instead of deleting and appending the whole partition.
+
+    The records of load_df are upserted on their URI (insert ... on conflict do update);
+    a stored record is only updated if its content hash (see add_content_hash) differs, so
+    unchanged records are not written, while unchanged records whose fields were filled in
+    again after parse_delta_results (e.g. group URIs) are.  Records without a URI (e.g.
+    questions without answer options) replace the stored record with the same primary key
+    under the same condition.  The DELETE records of delta_df are removed by their primary
+    key.  The records actually inserted, updated and deleted are recorded in the change
+    outbox (see ChangeOutbox), in the same transaction as the records themselves.
+
+    Args:
+    con (sl.Connection): The connection to the database.
+    table_name (str): The table to write to.
+    load_df (pd.DataFrame): The records from parse_delta_results, with the datatypes of the table.
+    delta_df (pd.DataFrame): The records from calculate_delta, for the DELETE actions.
+    uri_field_name (str): The field name used for the URI.
+    pk_fields (list): The primary key fields.
+
+    Returns:
+    dict: The number of records written and deleted.
+    """
+
+    create_outbox_table(con)
+
+    pk_fields = list(pk_fields)
+    key_filter_sql = ' and '.join(f'"{column}" is ?' for column in pk_fields)
+
+    if len(delta_df) > 0:
+        delete_df = delta_df.loc[delta_df['delta_action'] == 'DELETE'].reindex(columns=pk_fields + [uri_field_name, '_rev'])
+    else:
+        delete_df = pd.DataFrame(columns=pk_fields + [uri_field_name, '_rev'])
+
+    if len(load_df) > 0:
+        load_df = add_content_hash(load_df, uri_field_name)
+        upsert_mask = load_df[uri_field_name].notna().values
+    else:
+        upsert_mask = np.array([], dtype=bool)
+
+    if upsert_mask.any() and not create_uri_index(con, table_name, uri_field_name):
+        upsert_mask[:] = False
+
+    upsert_df = load_df[upsert_mask]
+    replace_df = load_df[~upsert_mask]
+
+    column_sql = ', '.join(f'"{column}"' for column in load_df.columns)
+    value_sql = ', '.join('?' * len(load_df.columns))
+    update_sql = ', '.join(f'"{column}" = excluded."{column}"' for column in load_df.columns if column != uri_field_name)
+
+    def get_rows(df: pd.DataFrame) -> list:
+        return [tuple(to_db_value(value) for value in row) for row in df.astype(object).itertuples(index=False, name=None)]
+
+    write_count = 0
+    delete_count = 0
+    cursor = con.cursor()
+
+    try:
+        if len(delete_df) > 0:
+            cursor.executemany(f'delete from "{table_name}" where {key_filter_sql}', get_rows(delete_df[pk_fields]))
+            delete_count = cursor.rowcount
+
+        change_list = [
+            (resource_uri, 'DELETE', rev)
+            for resource_uri, rev in get_rows(delete_df[[uri_field_name, '_rev']])
+        ]
+
+        # a record is inserted if its URI is not stored and updated if the stored hash differs
+        if len(load_df) > 0:
+            uri_row_list = get_rows(load_df.loc[load_df[uri_field_name].notna()].reindex(columns=[uri_field_name, '_hash', '_rev']))
+            stored_hash_dict = get_stored_hashes(con, table_name, uri_field_name, [row[0] for row in uri_row_list])
+
+            for resource_uri, row_hash, rev in uri_row_list:
+                if resource_uri not in stored_hash_dict:
+                    change_list.append((resource_uri, 'INSERT', rev))
+                elif stored_hash_dict[resource_uri] != row_hash:
+                    change_list.append((resource_uri, 'UPDATE', rev))
+
+        if len(upsert_df) > 0:
+            cursor.executemany(
+                f"""
+                    insert into "{table_name}" ({column_sql}) values ({value_sql})
+                    on conflict ("{uri_field_name}") do update set {update_sql}
+                    where "{table_name}"."_hash" is not excluded."_hash"
+                """,
+                get_rows(upsert_df)
+            )
+            write_count += cursor.rowcount
+
+        if len(replace_df) > 0:
+            key_list = get_rows(replace_df[pk_fields])
+
+            cursor.executemany(
+                f'delete from "{table_name}" where {key_filter_sql} and "_hash" is not ?',
+                [key + (row_hash,) for key, row_hash in zip(key_list, replace_df['_hash'].tolist())]
+            )
+            cursor.executemany(
+                f'insert into "{table_name}" ({column_sql}) select {value_sql} where not exists (select 1 from "{table_name}" where {key_filter_sql})',
+                [row + key for row, key in zip(get_rows(replace_df), key_list)]
+            )
+            write_count += cursor.rowcount
+
+        record_changes(cursor, table_name, change_list)
+
+        con.commit()
+
+    except Exception as error:
+        con.rollback()
+        raise error
+
+    return {'written': write_count, 'deleted': delete_count}
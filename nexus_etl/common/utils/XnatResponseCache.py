@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import zlib
+import json
+import hashlib
+import sqlite3 as sl
+import threading
+from LoadInitialization import get_env_variables
+
+# Load the environment variables
+config = get_env_variables()
+
+cache_config = config.get('xnat', {}).get('cache', {})
+
+# the cache can be switched off in the config file or for a single run with XNAT_CACHE_BYPASS=1
+cache_enabled = cache_config.get('enabled', False) and os.environ.get('XNAT_CACHE_BYPASS', '0') != '1'
+cache_path = os.path.expanduser(cache_config.get('path', '~/eln/nexus_etl/cache/xnat_response_cache.db'))
+cache_max_size = int(cache_config.get('max_size_mb', 2048)) * 1024 * 1024
+cache_ttl_dict = cache_config.get('ttl_seconds', {})
+
+# the header fetcher calls XNAT from several threads, so all access to the connection is serialized
+cache_lock = threading.Lock()
+cache_connection = None
+
+
+def get_cache_connection() -> sl.Connection:
+    """
+    Opens the SQLite file that holds the cached XNAT responses, creating it if needed.
+
+    Returns:
+    sqlite3.Connection: The connection to the cache database.
+    """
+
+    global cache_connection
+
+    if cache_connection is None:
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        # the cache is shared with other processes, e.g. the prefetch of run_src_to_dw.py
+        cache_connection = sl.connect(cache_path, check_same_thread=False, timeout=60)
+        cache_connection.execute("""
+            create table if not exists xnat_response_cache
+            (
+                cache_key text primary key,
+                endpoint text not null,
+                validator text null,
+                created_at real not null,
+                last_accessed real not null,
+                size integer not null,
+                content blob not null
+            )
+        """)
+        cache_connection.execute("""
+            create index if not exists xnat_response_cache_last_accessed
+            on xnat_response_cache (last_accessed)
+        """)
+        cache_connection.commit()
+
+    return cache_connection
+
+
+def generate_cache_key(endpoint: str, url: str, params: dict = None) -> str:
+    """
+    Generates the key of a cached response.  The key is the SHA-256 of the endpoint name,
+    the URL and the request parameters in a stable order, so the same request always
+    maps to the same entry.
+
+    Args:
+    endpoint (str): The endpoint class of the request, e.g. 'dicomdump'.
+    url (str): The requested URL.
+    params (dict, optional): The query parameters sent with the request.
+
+    Returns:
+    str: The hex digest identifying the request.
+    """
+
+    key_source = json.dumps([endpoint, url, params or {}], sort_keys=True)
+
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+def get_cached_response(endpoint: str, url: str, params: dict = None, validator: str = None) -> str:
+    """
+    Looks up a previously cached XNAT response.
+
+    An entry is only returned if it is younger than the TTL configured for the endpoint and,
+    when a validator is given (e.g. the scan's last_modified stamp), if it was stored with
+    the same validator.  Stale entries are removed.
+
+    Args:
+    endpoint (str): The endpoint class of the request, e.g. 'dicomdump'.
+    url (str): The requested URL.
+    params (dict, optional): The query parameters sent with the request.
+    validator (str, optional): Modification stamp the cached content must match.
+
+    Returns:
+    str: The cached response body, or None if there is no valid entry.
+    """
+
+    if not cache_enabled:
+        return None
+
+    cache_key = generate_cache_key(endpoint, url, params)
+    ttl = cache_ttl_dict.get(endpoint, 0)
+    now = time.time()
+
+    with cache_lock:
+
+        connection = get_cache_connection()
+
+        row = connection.execute(
+            "select validator, created_at, content from xnat_response_cache where cache_key = ?",
+            (cache_key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        stored_validator, created_at, content = row
+
+        if (now - created_at > ttl) or (validator is not None and stored_validator != str(validator)):
+            connection.execute("delete from xnat_response_cache where cache_key = ?", (cache_key,))
+            connection.commit()
+            return None
+
+        connection.execute(
+            "update xnat_response_cache set last_accessed = ? where cache_key = ?",
+            (now, cache_key)
+        )
+        connection.commit()
+
+    return zlib.decompress(content).decode('utf-8')
+
+
+def cache_response(endpoint: str, url: str, content: str, params: dict = None, validator: str = None) -> None:
+    """
+    Stores an XNAT response body, compressed, and evicts the least recently used entries
+    once the cache grows beyond its configured size.
+
+    Args:
+    endpoint (str): The endpoint class of the request, e.g. 'dicomdump'.
+    url (str): The requested URL.
+    content (str): The response body.
+    params (dict, optional): The query parameters sent with the request.
+    validator (str, optional): Modification stamp the content was fetched at.
+    """
+
+    if not cache_enabled or cache_ttl_dict.get(endpoint, 0) <= 0:
+        return
+
+    cache_key = generate_cache_key(endpoint, url, params)
+    compressed_content = zlib.compress(content.encode('utf-8'))
+    now = time.time()
+
+    with cache_lock:
+
+        connection = get_cache_connection()
+
+        connection.execute(
+            """
+                insert or replace into xnat_response_cache
+                    (cache_key, endpoint, validator, created_at, last_accessed, size, content)
+                values (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                cache_key,
+                endpoint,
+                None if validator is None else str(validator),
+                now,
+                now,
+                len(compressed_content),
+                compressed_content
+            )
+        )
+
+        evict_least_recently_used(connection)
+
+        connection.commit()
+
+
+def evict_least_recently_used(connection: sl.Connection) -> None:
+    """
+    Deletes the least recently used entries until the cache is back under 90% of its
+    configured size.  Must be called while holding cache_lock.
+    """
+
+    total_size = connection.execute("select coalesce(sum(size), 0) from xnat_response_cache").fetchone()[0]
+
+    if total_size <= cache_max_size:
+        return
+
+    target_size = cache_max_size * 0.9
+
+    for cache_key, size in connection.execute(
+        "select cache_key, size from xnat_response_cache order by last_accessed"
+    ).fetchall():
+
+        if total_size <= target_size:
+            break
+
+        connection.execute("delete from xnat_response_cache where cache_key = ?", (cache_key,))
+        total_size -= size
+
+
+def purge_cache(endpoint: str = None) -> int:
+    """
+    Removes cached responses.
+
+    Args:
+    endpoint (str, optional): Only remove responses of this endpoint class.  All responses
+                              are removed if not given.
+
+    Returns:
+    int: The number of entries removed.
+    """
+
+    with cache_lock:
+
+        connection = get_cache_connection()
+
+        if endpoint:
+            cursor = connection.execute("delete from xnat_response_cache where endpoint = ?", (endpoint,))
+        else:
+            cursor = connection.execute("delete from xnat_response_cache")
+
+        connection.commit()
+        connection.execute("vacuum")
+
+    return cursor.rowcount
+
+
+if __name__ == "__main__":
+
+    # python XnatResponseCache.py purge [endpoint]
+    if len(sys.argv) > 1 and sys.argv[1] == 'purge':
+
+        try:
+            endpoint = sys.argv[2]
+        except:
+            endpoint = None
+
+        print(f"Removed {purge_cache(endpoint)} cached XNAT responses.")
@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+import zipfile
+import threading
+import requests
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+def normalize_url(url: str) -> str:
+    """
+    Reduces a URL to its path and sorted query string.  The scheme and host are dropped so
+    that a snapshot recorded against one XNAT server can be replayed with any server
+    configured.
+
+    Args:
+    url (str): The requested URL.
+
+    Returns:
+    str: The normalized URL, e.g. '/data/experiments?columns=ID&format=csv'.
+    """
+
+    split_url = urlsplit(url)
+    path = '/' + '/'.join(part for part in split_url.path.split('/') if part)
+    query = urlencode(sorted(parse_qsl(split_url.query, keep_blank_values=True)))
+
+    return f"{path}?{query}" if query else path
+
+
+def generate_snapshot_key(method: str, url: str) -> str:
+    """
+    Generates the name of a recorded response in the archive: the SHA-256 of the request
+    method and the normalized URL.
+
+    Args:
+    method (str): The HTTP method.
+    url (str): The requested URL.
+
+    Returns:
+    str: The hex digest identifying the request.
+    """
+
+    return hashlib.sha256(f"{method.upper()} {normalize_url(url)}".encode('utf-8')).hexdigest()
+
+
+class XnatSnapshotAdapter(BaseAdapter):
+    """
+    A requests transport adapter that records XNAT responses into, or replays them from, a
+    zip archive (one deflate-compressed entry per response).
+
+    Mounted on the session of the XnatClient, it sees both the calls made by get_xnat_data.py
+    and the searches made by pyxnat.  In record mode requests go to XNAT through the wrapped
+    adapter and every response is added to the archive.  In replay mode no request leaves the
+    machine; a request that was not recorded raises a ConnectionError.
+    """
+
+    def __init__(self, mode: str, path: str, adapter: BaseAdapter=None):
+
+        super().__init__()
+
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown snapshot mode {mode}, expected record or replay.")
+
+        if mode == 'record' and adapter is None:
+            raise ValueError("Recording a snapshot requires the adapter that reaches XNAT.")
+
+        self.mode = mode
+        self.path = path
+        self.adapter = adapter
+        self.archive_lock = threading.Lock()
+
+        if mode == 'record':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.archive = zipfile.ZipFile(path, 'a', compression=zipfile.ZIP_DEFLATED)
+        else:
+            if not os.path.exists(path):
+                raise ValueError(f"Snapshot {path} does not exist.")
+            self.archive = zipfile.ZipFile(path, 'r')
+
+        self.recorded_key_set = {name.split('.')[0] for name in self.archive.namelist()}
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+
+        snapshot_key = generate_snapshot_key(request.method, request.url)
+
+        if self.mode == 'replay':
+            return self.replay(request, snapshot_key)
+
+        response = self.adapter.send(request, **kwargs)
+
+        # reading the body here means the caller gets a response that is already consumed;
+        # iter_content and .text work on it as usual
+        content = response.content
+
+        # the session token is never written to the archive
+        if response.status_code < 500 and response.status_code != 401 and not normalize_url(request.url).endswith('/data/JSESSION'):
+            self.record(request, snapshot_key, response, content)
+
+        return response
+
+    def record(self, request: requests.PreparedRequest, snapshot_key: str, response: requests.Response, content: bytes) -> None:
+        """
+        Adds a response to the archive.  The first response recorded for a request is kept.
+        """
+
+        metadata = {
+            'method': request.method,
+            'url': normalize_url(request.url),
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': {
+                key: value for key, value in response.headers.items()
+                if key.lower() in ('content-type', 'last-modified', 'etag')
+            }
+        }
+
+        with self.archive_lock:
+
+            if snapshot_key in self.recorded_key_set:
+                return
+
+            self.archive.writestr(f"{snapshot_key}.json", json.dumps(metadata))
+            self.archive.writestr(f"{snapshot_key}.body", content)
+            self.recorded_key_set.add(snapshot_key)
+
+    def replay(self, request: requests.PreparedRequest, snapshot_key: str) -> requests.Response:
+        """
+        Builds the response to a request from the archive.
+        """
+
+        if snapshot_key not in self.recorded_key_set:
+
+            # logging in and out is not needed to read a snapshot
+            if normalize_url(request.url).endswith('/data/JSESSION'):
+                return self.build_response(request, 200, 'OK', {'Content-Type': 'text/plain'}, b'snapshot')
+
+            raise requests.exceptions.ConnectionError(
+                f"No response for {request.method} {normalize_url(request.url)} in snapshot {self.path}.",
+                request=request
+            )
+
+        with self.archive_lock:
+            metadata = json.loads(self.archive.read(f"{snapshot_key}.json"))
+            content = self.archive.read(f"{snapshot_key}.body")
+
+        return self.build_response(request, metadata['status_code'], metadata['reason'], metadata['headers'], content)
+
+    def build_response(self, request: requests.PreparedRequest, status_code: int, reason: str, headers: dict, content: bytes) -> requests.Response:
+
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = content
+        response._content_consumed = True
+
+        return response
+
+    def close(self) -> None:
+
+        with self.archive_lock:
+            self.archive.close()
+
+        if self.adapter is not None:
+            self.adapter.close()
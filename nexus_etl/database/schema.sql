@@ -22,6 +22,7 @@ CREATE TABLE research_study
     "_createdat" DATETIME NULL,
     "_updatedat" DATETIME NULL,
     "_rev" INTEGER NULL,
+    "_hash" integer NULL,
     xnat_custom_fields TEXT NULL
 );
 
@@ -51,6 +52,7 @@ CREATE TABLE acquisition
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     accession_id text NULL,
     acquisition_start_date text NULL,
     acquisition_start_time text NULL,
@@ -86,6 +88,7 @@ CREATE TABLE acquisition_object
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     accession_id text NULL,
     acquisition_start_date text NULL,
     acquisition_start_time text NULL,
@@ -109,7 +112,8 @@ CREATE TABLE device
     device_name text NULL,
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
-    "_rev" integer NULL
+    "_rev" integer NULL,
+    "_hash" integer NULL
 );
 
 
@@ -120,6 +124,21 @@ CREATE TABLE nexus_etl_log
 );
 
 
+CREATE TABLE change_outbox
+(
+    change_id integer PRIMARY KEY AUTOINCREMENT,
+    run_id text NOT NULL,
+    table_name text NOT NULL,
+    resource_uri text NOT NULL,
+    delta_action text NOT NULL,
+    _rev integer NULL,
+    changed_at datetime NOT NULL,
+    drained_at datetime NULL
+);
+
+CREATE INDEX ix_change_outbox__pending ON change_outbox (table_name, resource_uri, change_id);
+
+
 
 CREATE TABLE questionnaire
 (
@@ -141,6 +160,7 @@ CREATE TABLE questionnaire
     questionnaire_item_answer_option_uri text NULL,
     "_createdat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     "_updatedat" datetime NULL,
     question_description text NULL,
     group_id text NULL,
@@ -170,6 +190,7 @@ CREATE TABLE questionnaire_item_list
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     question_description text NULL,
     group_id text NULL,
     group_uri text NULL,
@@ -197,6 +218,7 @@ CREATE TABLE questionnaire_list
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     subject_type text NULL,
     questionnaire_uuid text NULL,
     xnat_data_type text NULL
@@ -227,6 +249,7 @@ CREATE TABLE questionnaire_response
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     question_group_id text NULL,
     question_group_uri text NULL,
     response_group_uri text NULL,
@@ -255,6 +278,7 @@ CREATE TABLE questionnaire_response_list
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     questionnaire_response_uri text NULL,
     src_system text NULL,
     questionnaire_uuid text NULL,
@@ -277,6 +301,7 @@ CREATE TABLE research_subject
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     xnat_custom_fields text NULL
 );
 
@@ -298,6 +323,89 @@ CREATE TABLE "session"
     "_createdat" datetime NULL,
     "_updatedat" datetime NULL,
     "_rev" integer NULL,
+    "_hash" integer NULL,
     accession_id text NULL,
     xnat_custom_fields text NULL
-);
\ No newline at end of file
+);
+
+
+
+CREATE TABLE raw_xnat_project
+(
+    research_study_id text NULL,
+    xnat_experiment_type text NULL,
+    raw_data text NULL,
+    "_extractedat" datetime NULL
+);
+
+
+
+CREATE TABLE raw_xnat_subject
+(
+    research_study_id text NULL,
+    xnat_experiment_type text NULL,
+    raw_data text NULL,
+    "_extractedat" datetime NULL
+);
+
+
+
+CREATE TABLE raw_xnat_session
+(
+    research_study_id text NULL,
+    xnat_experiment_type text NULL,
+    raw_data text NULL,
+    "_extractedat" datetime NULL
+);
+
+
+
+CREATE TABLE raw_xnat_scan
+(
+    research_study_id text NULL,
+    xnat_experiment_type text NULL,
+    raw_data text NULL,
+    "_extractedat" datetime NULL
+);
+
+
+
+CREATE TABLE header_blob
+(
+    blob_hash text PRIMARY KEY,
+    codec text NOT NULL,
+    size integer NOT NULL,
+    content blob NOT NULL
+);
+
+
+
+CREATE INDEX ix_research_study__hash ON "research_study" ("_hash");
+CREATE INDEX ix_acquisition__hash ON "acquisition" ("_hash");
+CREATE INDEX ix_acquisition_object__hash ON "acquisition_object" ("_hash");
+CREATE INDEX ix_device__hash ON "device" ("_hash");
+CREATE INDEX ix_questionnaire__hash ON "questionnaire" ("_hash");
+CREATE INDEX ix_questionnaire_item_list__hash ON "questionnaire_item_list" ("_hash");
+CREATE INDEX ix_questionnaire_list__hash ON "questionnaire_list" ("_hash");
+CREATE INDEX ix_questionnaire_response__hash ON "questionnaire_response" ("_hash");
+CREATE INDEX ix_questionnaire_response_list__hash ON "questionnaire_response_list" ("_hash");
+CREATE INDEX ix_research_subject__hash ON "research_subject" ("_hash");
+CREATE INDEX ix_session__hash ON "session" ("_hash");
+CREATE INDEX ix_questionnaire_response__partition ON "questionnaire_response" ("research_study_id", "response_subject_type", "response_subject_uri");
+CREATE INDEX ix_research_subject__delta_key ON "research_subject" ("research_study_id", "research_study_id_type", "research_subject_id", "src_system");
+CREATE INDEX ix_session__delta_key ON "session" ("research_study_id", "research_study_id_type", "research_subject_id", "session_id", "src_system", "accession_id");
+CREATE INDEX ix_acquisition__delta_key ON "acquisition" ("research_study_id", "research_study_id_type", "research_subject_id", "session_id", "src_system", "acquisition_id");
+CREATE UNIQUE INDEX ux_research_study__uri ON "research_study" ("research_study_uri");
+CREATE UNIQUE INDEX ux_research_subject__uri ON "research_subject" ("research_subject_uri");
+CREATE UNIQUE INDEX ux_device__uri ON "device" ("device_uri");
+CREATE UNIQUE INDEX ux_session__uri ON "session" ("session_uri");
+CREATE UNIQUE INDEX ux_acquisition__uri ON "acquisition" ("acquisition_uri");
+CREATE UNIQUE INDEX ux_acquisition_object__uri ON "acquisition_object" ("acquisition_object_uri");
+CREATE UNIQUE INDEX ux_questionnaire_list__uri ON "questionnaire_list" ("questionnaire_uri");
+CREATE UNIQUE INDEX ux_questionnaire_item_list__uri ON "questionnaire_item_list" ("questionnaire_item_uri");
+CREATE UNIQUE INDEX ux_questionnaire__uri ON "questionnaire" ("questionnaire_item_answer_option_uri");
+CREATE UNIQUE INDEX ux_questionnaire_response_list__uri ON "questionnaire_response_list" ("questionnaire_response_uri");
+CREATE UNIQUE INDEX ux_questionnaire_response__uri ON "questionnaire_response" ("questionnaire_response_item_uri");
+
+-- see add_hash_columns in common/utils/DbConnection.py
+PRAGMA user_version = 1;
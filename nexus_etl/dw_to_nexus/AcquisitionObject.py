@@ -10,9 +10,11 @@ config = setup.config
 import datetime
 from DbConnection import connect_to_db
 from DatatypeConverter import convert_datatypes_based_on_table
+from ChangeOutbox import get_change_filter, mark_changes_drained
 from dataclasses import fields
 import NexusSparqlQuery as qns
 from dw_dataclasses.acquisition_object import acquisition_object
+from HeaderBlobStore import resolve_header_column
 
 engine = connect_to_db()
 
@@ -48,15 +50,14 @@ postgres_table_name = 'acquisition_object'
 resource_type = 'nidm:AcquisitionObject'
 last_processed_date = '1990-01-01 00:00:00'
 
+# the records to publish: the ones with pending changes in the change outbox, or the ones
+# updated since the last load, depending on nexus.change_source
+change_filter, last_change_id = get_change_filter(engine, postgres_table_name, 'acquisition_object_uri', resource_type, last_processed_date)
+
 # get the postgres data
 query = f"""
             select * from {postgres_table_name}
-            where "_updatedat" > 
-                coalesce (
-                    (select max(last_success_load_ts) from nexus_etl_log
-                    where resource_type = '{resource_type}'),
-                    '{last_processed_date}'
-            )
+            where {change_filter}
             and (
                 dicom_header is not null
 	            or non_dicom_header is not null
@@ -65,6 +66,9 @@ query = f"""
 
 df = pd.read_sql(query, engine)
 df = convert_datatypes_based_on_table(postgres_table_name, df) 
+# the headers are stored in header_blob, acquisition_object only references them
+df['dicom_header'] = resolve_header_column(df['dicom_header'])
+df['non_dicom_header'] = resolve_header_column(df['non_dicom_header'])
 df = df.replace({np.nan:None})
 current_ts = datetime.datetime.now()
 
@@ -77,6 +81,8 @@ response = urlopen(url)
 metadata_dict = json.loads(response.read())
 
 
+published_uri_list = []
+
 for index, row in df.iterrows():
     
     dc = acquisition_object()
@@ -103,7 +109,12 @@ for index, row in df.iterrows():
         print("Inserting")
         nexus.resources.create(org, project, dc_dict)
 
+    published_uri_list.append(row.acquisition_object_uri)
+
 
 # updating the nexus_etl_log table
 df = pd.DataFrame([[resource_type, current_ts]], columns=['resource_type', 'last_success_load_ts'])
-df.to_sql('nexus_etl_log', engine, if_exists='append', index=False)
\ No newline at end of file
+df.to_sql('nexus_etl_log', engine, if_exists='append', index=False)
+
+# the changes of the published records are drained from the outbox
+mark_changes_drained(engine, postgres_table_name, published_uri_list, last_change_id)
@@ -5,6 +5,7 @@ import json
 config = setup.config
 
 from DbConnection import connect_to_db
+from ChangeOutbox import get_last_change_id, get_pending_uri_query, mark_changes_drained, deprecate_action_list, change_source
 import NexusSparqlQuery as qns
 
 engine = connect_to_db()
@@ -20,6 +21,10 @@ sparqlview_wrapper = setup.sparqlview_wrapper
 # create nexus connection
 nexus = setup.nexus
 
+# 'outbox' deprecates the records deleted from the tables since the last run, see
+# ChangeOutbox; otherwise every table is reconciled against Nexus with SPARQL.  Either way
+# only the deletes whose resources were deprecated (or never published) are drained.
+
 # Opening JSON file
 f = open('resource_deprecation_mapping.json')
 resource_mapping_dict = json.load(f)
@@ -28,6 +33,45 @@ resource_mapping_dict
 for resource_mapping in resource_mapping_dict:
     
     print(resource_mapping['postgres_table_name'])
+
+    # the changes this run reads from (and drains of) the change outbox
+    last_change_id = get_last_change_id(engine, resource_mapping['postgres_table_name'])
+    deprecated_uri_list = []
+
+    if change_source == 'outbox':
+
+        deleted_df = pd.read_sql(
+            get_pending_uri_query(resource_mapping['postgres_table_name'], deprecate_action_list, last_change_id),
+            engine
+        )
+        print(f"Resources to delete: {len(deleted_df)}")
+
+        for resource_uri in deleted_df['resource_uri']:
+
+            try:
+                resource = nexus.resources.fetch(org, project, resource_uri)
+            except Exception as error:
+                # a record deleted before it was ever published has no resource
+                if getattr(getattr(error, 'response', None), 'status_code', None) == 404:
+                    deprecated_uri_list.append(resource_uri)
+                print(f"Could not fetch {resource_uri}")
+                continue
+
+            print(resource["@id"])
+
+            if resource.get('_deprecated'):
+                deprecated_uri_list.append(resource_uri)
+                continue
+
+            try:
+                nexus.resources.deprecate(resource)
+                deprecated_uri_list.append(resource_uri)
+            except:
+                print("Could not deprecate")
+
+        # only the deletes that were handled are drained, the others are retried next run
+        mark_changes_drained(engine, resource_mapping['postgres_table_name'], deprecated_uri_list, last_change_id)
+        continue
     
     # let's get a list of all research studies from postgres
     query = f"""
@@ -98,6 +142,10 @@ for resource_mapping in resource_mapping_dict:
         
         try:
             nexus.resources.deprecate(resource)      
+            deprecated_uri_list.append(row['resource_uri'])
         except:
             print("Could not deprecate")
+
+    # the outbox is drained of the deletes reconciled here as well
+    mark_changes_drained(engine, resource_mapping['postgres_table_name'], deprecated_uri_list, last_change_id)
         
\ No newline at end of file
@@ -10,6 +10,7 @@ config = setup.config
 import datetime
 from DbConnection import connect_to_db
 from DatatypeConverter import convert_datatypes_based_on_table
+from ChangeOutbox import get_change_filter, mark_changes_drained
 from dataclasses import fields
 import NexusSparqlQuery as qns
 from dw_dataclasses.questionnaire_response import questionnaire_response
@@ -48,15 +49,14 @@ postgres_table_name = 'questionnaire_response'
 resource_type = 'fhir:QuestionnaireResponseItemComponent'
 last_processed_date = '1990-01-01 00:00:00'
 
+# the records to publish: the ones with pending changes in the change outbox, or the ones
+# updated since the last load, depending on nexus.change_source
+change_filter, last_change_id = get_change_filter(engine, postgres_table_name, 'questionnaire_response_item_uri', resource_type, last_processed_date)
+
 # get the postgres data
 query = f"""
             select * from {postgres_table_name}
-            where "_updatedat" > 
-                coalesce (
-                    (select max(last_success_load_ts) from nexus_etl_log
-                    where resource_type = '{resource_type}'),
-                    '{last_processed_date}'
-                )
+            where {change_filter}
             and questionnaire_response_uri is not null
             order by response_index_in_list
         """
@@ -81,6 +81,8 @@ url = "https://bluebrainnexus.io/contexts/metadata.json"
 response = urlopen(url)
 metadata_dict = json.loads(response.read())
 
+published_uri_list = []
+
 for index, row in df.iterrows():
     
     dc = questionnaire_response()
@@ -104,8 +106,12 @@ for index, row in df.iterrows():
     else:
         print("Inserting")
         nexus.resources.create(org, project, dc_dict)
+
+    published_uri_list.append(row.questionnaire_response_item_uri)
     
 # updating the nexus_etl_log table
 df = pd.DataFrame([[resource_type, current_ts]], columns=['resource_type', 'last_success_load_ts'])
 df.to_sql('nexus_etl_log', engine, if_exists='append', index=False)
 
+# the changes of the published records are drained from the outbox
+mark_changes_drained(engine, postgres_table_name, published_uri_list, last_change_id)
@@ -1,7 +1,15 @@
 import os
+import sys
 import json
-import xmltodict, json
+import time
+import atexit
+import threading
+import xmltodict
 import requests
+import pandas as pd
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import setup
 import html
@@ -9,6 +17,14 @@ import html
 config = setup.config
 
 from DbConnection import connect_to_db
+import XnatResponseCache
+from XnatResponseCache import get_cached_response, cache_response
+from XnatSnapshot import XnatSnapshotAdapter
+from AdaptiveConcurrency import AdaptiveConcurrencyLimiter
+from RequestHedging import RequestHedger
+from StreamingJson import stream_array_items, stream_object_members
+from DicomArchiveReader import DicomArchiveReader
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 
 # define postgres connection
 datamart_engine = connect_to_db()
@@ -16,11 +32,547 @@ datamart_engine = connect_to_db()
 basedir = os.path.join(os.path.dirname(__file__), '..')
 
 from pyxnat import Interface
-interface = Interface(config=os.path.join(basedir, 'sensitive/xnat_config.cfg'))
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
-def get_project_data(xnat_project_id: str) -> dict:
+class XnatSessionAuth(requests.auth.AuthBase):
+    """
+    Authenticates requests with an XNAT JSESSIONID instead of sending the username and
+    password with every call, which makes XNAT re-authenticate (e.g. against LDAP) each time.
+
+    The token is requested once from /data/JSESSION and reused for the whole run.  When a
+    token_file is given the token is also shared with other processes for up to
+    token_max_age seconds; the process that replaces an older token ends its session.  A 401
+    response refreshes the token and resends the request once.
+    """
+
+    def __init__(self, server: str, username: str, password: str, token_file: str=None, token_max_age: int=600):
+
+        self.server = server
+        self.username = username
+        self.password = password
+        self.token_file = token_file
+        self.token_max_age = token_max_age
+        self.token = None
+        self.token_lock = threading.Lock()
+
+    def read_token_file(self) -> tuple:
+        """
+        Returns the token stored by another process for this server, if any, and whether it
+        is too old to be reused.
+        """
+
+        if not self.token_file or not os.path.exists(self.token_file):
+            return None, False
+
+        try:
+            with open(self.token_file) as fp:
+                token_dict = json.load(fp)
+        except (OSError, ValueError):
+            return None, False
+
+        if token_dict.get('server') != self.server:
+            return None, False
+
+        return token_dict.get('jsessionid'), time.time() - token_dict.get('created_at', 0) > self.token_max_age
+
+    def write_token_file(self) -> None:
+
+        if not self.token_file:
+            return
+
+        os.makedirs(os.path.dirname(self.token_file), exist_ok=True)
+
+        # the token grants access to XNAT, so only the owner may read it
+        with open(os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+            json.dump({'server': self.server, 'jsessionid': self.token, 'created_at': time.time()}, fp)
+
+    def login(self) -> str:
+        """
+        Opens a new XNAT session with the username and password.  Must be called while
+        holding token_lock.
+        """
+
+        r = requests.post(
+            f"{self.server}/data/JSESSION",
+            auth=(self.username, self.password),
+            verify=False
+        )
+
+        if r.status_code != 200:
+            raise ValueError(f"Could not open an XNAT session: {r.status_code}")
+
+        self.token = r.text.strip()
+        self.write_token_file()
+
+        return self.token
+
+    def end_session(self, token: str) -> None:
+
+        requests.delete(
+            f"{self.server}/data/JSESSION",
+            headers={'Cookie': f'JSESSIONID={token}'},
+            verify=False
+        )
+
+    def get_token(self) -> str:
+
+        with self.token_lock:
+            if self.token is None:
+
+                stored_token, expired = self.read_token_file()
+
+                if stored_token and not expired:
+                    self.token = stored_token
+                else:
+                    self.login()
+
+                    # the replaced session would otherwise stay open on XNAT until it times out;
+                    # a process still using it gets a 401 and refreshes its token
+                    if stored_token:
+                        try:
+                            self.end_session(stored_token)
+                        except requests.RequestException:
+                            print("Could not end the replaced XNAT session")
+
+            return self.token
+
+    def refresh_token(self, expired_token: str) -> str:
+
+        with self.token_lock:
+            # another thread may have refreshed the token already
+            if self.token == expired_token:
+                self.login()
+
+            return self.token
+
+    def invalidate(self) -> None:
+        """
+        Ends the XNAT session and removes the shared token file.
+        """
+
+        with self.token_lock:
+
+            token = self.token or self.read_token_file()[0]
+
+            if token:
+                self.end_session(token)
+
+            self.token = None
+
+            if self.token_file and os.path.exists(self.token_file):
+                os.remove(self.token_file)
+
+    def handle_401(self, r: requests.Response, **kwargs) -> requests.Response:
+
+        if r.status_code != 401 or getattr(r.request, 'xnat_token_refreshed', False):
+            return r
+
+        token = self.refresh_token(r.request.headers['Cookie'].split('=', 1)[1])
+
+        # consume the content so the connection can be reused, then resend once with the new token
+        r.content
+        r.close()
+
+        prepared_request = r.request.copy()
+        prepared_request.headers['Cookie'] = f'JSESSIONID={token}'
+        prepared_request.xnat_token_refreshed = True
+
+        retried_response = r.connection.send(prepared_request, **kwargs)
+        retried_response.history.append(r)
+        retried_response.request = prepared_request
+
+        return retried_response
+
+    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
+
+        r.headers['Cookie'] = f'JSESSIONID={self.get_token()}'
+        r.register_hook('response', self.handle_401)
+
+        return r
+
+
+class LimitedStream:
+    """
+    A streamed response that holds its slot of the AdaptiveConcurrencyLimiter until the
+    body has been read or the response is closed, so the transfers in flight are bounded
+    by the limit and the latency recorded for the limiter includes the body, not just the
+    time to the headers.  Everything else is taken from the wrapped response.
+    """
+
+    def __init__(self, response: requests.Response, limiter: AdaptiveConcurrencyLimiter, start_time: float, overloaded: bool):
+
+        self.response = response
+        self.limiter = limiter
+        self.start_time = start_time
+        self.overloaded = overloaded
+        self.released = False
+        self.release_lock = threading.Lock()
+
+    def release(self) -> None:
+
+        with self.release_lock:
+            if self.released:
+                return
+            self.released = True
+
+        self.limiter.release(self.start_time, self.overloaded)
+
+    def iter_content(self, *args, **kwargs):
+
+        try:
+            yield from self.response.iter_content(*args, **kwargs)
+        except Exception:
+            self.overloaded = True
+            raise
+        finally:
+            self.close()
+
+    @property
+    def content(self) -> bytes:
+
+        try:
+            return self.response.content
+        finally:
+            self.release()
+
+    @property
+    def text(self) -> str:
+
+        try:
+            return self.response.text
+        finally:
+            self.release()
+
+    def close(self) -> None:
+
+        try:
+            self.response.close()
+        finally:
+            self.release()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args) -> None:
+
+        self.close()
+
+    def __getattr__(self, name: str):
+
+        return getattr(self.response, name)
+
+
+class XnatInterfaceHttp:
+    """
+    Takes the place of the requests.Session of a pyxnat Interface, so its listings and
+    searches go through XnatClient.request and wait for the concurrency limit of their
+    endpoint class like the other calls.
+    """
+
+    def __init__(self, client):
+
+        self.client = client
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.client.request('GET', url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.client.request('PUT', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.client.request('POST', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.client.request('DELETE', url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.client.request('HEAD', url, **kwargs)
+
+    def __getattr__(self, name: str):
+
+        return getattr(self.client.session, name)
+
+
+class XnatClient:
+    """
+    The single connection to XNAT used by all extraction functions and loaders.
+
+    It owns one requests.Session with a keep-alive connection pool, gzip transfer
+    encoding, retry with exponential backoff on connection errors, 429 and 5xx
+    responses, and JSESSIONID authentication (see XnatSessionAuth).  The pyxnat
+    Interface is pointed at the same session so that searches and REST calls share
+    connections and the XNAT session.
+
+    Requests, including the ones of the attached pyxnat Interface, wait for a slot of the
+    AdaptiveConcurrencyLimiter of their endpoint class (see classify_endpoint) when limits
+    are configured, so the number of requests in flight follows XNAT's latency and 429/5xx
+    responses.  A streamed response keeps its slot until its body is read (see
+    LimitedStream).  For endpoint classes with a RequestHedger, a GET that is slow compared
+    to recent ones is sent a second time and the first answer is used.
+    """
+
+    def __init__(self, server: str, username: str, password: str, pool_size: int=16, max_retries: int=3, backoff_factor: float=0.5, token_file: str=None, token_max_age: int=600, concurrency_limits: dict=None, hedging_settings: dict=None):
+
+        self.server = server.rstrip('/')
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        self.session.auth = XnatSessionAuth(self.server, username, password, token_file, token_max_age)
+        self.session.verify = False
+
+        self.limiter_dict = {
+            endpoint: AdaptiveConcurrencyLimiter(endpoint, **limit_settings)
+            for endpoint, limit_settings in (concurrency_limits or {}).items()
+        }
+
+        self.hedger_dict = {
+            endpoint: RequestHedger(endpoint, **hedge_settings)
+            for endpoint, hedge_settings in (hedging_settings or {}).items()
+        }
+
+        # a hedged request and its duplicate are sent from these threads while the caller waits
+        self.hedge_executor = ThreadPoolExecutor(max_workers=2 * pool_size) if self.hedger_dict else None
+
+    @staticmethod
+    def classify_endpoint(url: str) -> str:
+        """
+        Returns the endpoint class of a URL: dicomdump, scan, search or default.
+        """
+
+        path = url.split('?')[0]
+
+        if path.endswith('/services/dicomdump'):
+            return 'dicomdump'
+        if '/scans/' in path:
+            return 'scan'
+        if path.endswith('/experiments') or path.endswith('/subjects'):
+            return 'search'
+
+        return 'default'
+
+    @staticmethod
+    def is_overloaded(response: requests.Response) -> bool:
+        """
+        True if XNAT answered with 429 or 5xx, or did so before the adapter's retry succeeded.
+        """
+
+        status_list = [response.status_code]
+
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None:
+            status_list.extend(request_history.status for request_history in retries.history)
+
+        return any(status == 429 or (status or 0) >= 500 for status in status_list)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a GET request through the pooled session.  url may be absolute or relative
+        to the XNAT server.
+        """
+
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request through the pooled session within the concurrency limit of its
+        endpoint class.  With stream=True the response is a LimitedStream, which has to be
+        read to the end or closed to give the slot back.
+        """
+
+        if not url.startswith('http'):
+            url = f"{self.server}{url}"
+
+        endpoint = self.classify_endpoint(url)
+        limiter = self.limiter_dict.get(endpoint) or self.limiter_dict.get('default')
+        hedger = self.hedger_dict.get(endpoint) if method == 'GET' else None
+
+        if limiter is None:
+            return self.send(hedger, method, url, **kwargs)
+
+        if kwargs.get('stream'):
+
+            start_time = limiter.acquire()
+
+            try:
+                response = self.send(hedger, method, url, **kwargs)
+            except Exception:
+                limiter.release(start_time, True)
+                raise
+
+            return LimitedStream(response, limiter, start_time, self.is_overloaded(response))
+
+        with limiter.slot() as outcome:
+            response = self.send(hedger, method, url, **kwargs)
+            outcome['overloaded'] = self.is_overloaded(response)
+
+        return response
+
+    def send(self, hedger: RequestHedger, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request, hedged if the endpoint class has a hedger.  The duplicate of a
+        hedged request shares the limiter slot of the original; the hedging budget caps the
+        extra load.
+        """
+
+        start_time = time.monotonic()
+        hedge_delay = hedger.hedge_delay() if hedger else None
+
+        if hedge_delay is None:
+            response = self.session.request(method, url, **kwargs)
+            if hedger:
+                hedger.record_latency(time.monotonic() - start_time)
+            return response
+
+        primary_future = self.hedge_executor.submit(self.session.request, method, url, **kwargs)
+
+        try:
+            response = primary_future.result(timeout=hedge_delay)
+            hedger.record_latency(time.monotonic() - start_time)
+            return response
+        except FutureTimeoutError:
+            pass
+
+        if not hedger.acquire_hedge():
+            response = primary_future.result()
+            hedger.record_latency(time.monotonic() - start_time)
+            return response
+
+        hedge_future = self.hedge_executor.submit(self.session.request, method, url, **kwargs)
+        pending_future_set = {primary_future, hedge_future}
+
+        while pending_future_set:
+
+            done_future_set, pending_future_set = wait(pending_future_set, return_when=FIRST_COMPLETED)
+
+            for future in done_future_set:
+
+                if future.exception() is not None:
+                    continue
+
+                hedger.record_latency(time.monotonic() - start_time)
+
+                if future is hedge_future:
+                    hedger.record_win()
+
+                # the slower request cannot be cancelled; its connection is released when it answers
+                for loser_future in pending_future_set:
+                    loser_future.add_done_callback(lambda f: f.exception() is None and f.result().close())
+
+                return future.result()
+
+        # both requests failed
+        return primary_future.result()
+
+    def metrics(self) -> dict:
+        """
+        Returns the current limit and throughput of every endpoint class.
+        """
+
+        return {
+            endpoint: dict(
+                self.limiter_dict[endpoint].metrics() if endpoint in self.limiter_dict else {},
+                **(self.hedger_dict[endpoint].metrics() if endpoint in self.hedger_dict else {})
+            )
+            for endpoint in dict.fromkeys(list(self.limiter_dict) + list(self.hedger_dict))
+        }
+
+    def attach(self, xnat_interface: Interface) -> Interface:
+        """
+        Makes a pyxnat Interface send its requests through this client, see XnatInterfaceHttp.
+        """
+
+        xnat_interface._http = XnatInterfaceHttp(self)
+
+        return xnat_interface
+
+    def use_snapshot(self, mode: str, path: str) -> XnatSnapshotAdapter:
+        """
+        Records the responses of all requests made through this client into a snapshot
+        archive (mode 'record'), or answers them from one without contacting XNAT
+        (mode 'replay').
+        """
+
+        snapshot_adapter = XnatSnapshotAdapter(mode, path, self.session.get_adapter(self.server))
+        self.session.mount('http://', snapshot_adapter)
+        self.session.mount('https://', snapshot_adapter)
+
+        # a replayed run does not log in to XNAT
+        if mode == 'replay':
+            self.session.auth = None
+
+        return snapshot_adapter
+
+    def close(self) -> None:
+        """
+        Invalidates the XNAT session and closes the pooled connections.
+        """
+
+        if self.session.auth is not None:
+            self.session.auth.invalidate()
+
+        self.session.close()
+
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False)
+
+
+xnat_http_config = config.get('xnat', {}).get('http', {})
+xnat_jsession_config = config.get('xnat', {}).get('jsession', {})
+xnat_concurrency_config = config.get('xnat', {}).get('concurrency', {})
+xnat_hedging_config = config.get('xnat', {}).get('hedging', {})
+
+xnat_client = XnatClient(
+    setup.xnat_server,
+    setup.xnat_username,
+    setup.xnat_password,
+    pool_size=xnat_http_config.get('pool_size', 16),
+    max_retries=xnat_http_config.get('max_retries', 3),
+    backoff_factor=xnat_http_config.get('backoff_factor', 0.5),
+    token_file=os.path.expanduser(xnat_jsession_config['token_file']) if xnat_jsession_config.get('token_file') else None,
+    token_max_age=xnat_jsession_config.get('token_max_age_seconds', 600),
+    concurrency_limits=xnat_concurrency_config.get('limits', {}) if xnat_concurrency_config.get('enabled', False) else None,
+    hedging_settings=xnat_hedging_config.get('endpoints', {}) if xnat_hedging_config.get('enabled', False) else None
+)
+
+# a session private to this process is ended when the process exits; a shared one is
+# left for the next script and ended with `python get_xnat_data.py logout`
+if not xnat_client.session.auth.token_file:
+    atexit.register(xnat_client.close)
+
+# record or replay an offline snapshot of XNAT, e.g. XNAT_SNAPSHOT_MODE=replay make src_to_dw
+xnat_snapshot_config = config.get('xnat', {}).get('snapshot', {})
+snapshot_mode = os.environ.get('XNAT_SNAPSHOT_MODE', xnat_snapshot_config.get('mode'))
+
+if snapshot_mode:
+
+    snapshot_path = os.path.expanduser(os.environ.get('XNAT_SNAPSHOT_PATH', xnat_snapshot_config.get('path', '')))
+    atexit.register(xnat_client.use_snapshot(snapshot_mode, snapshot_path).close)
+
+    # every response has to go through the snapshot, so the response cache is not used
+    XnatResponseCache.cache_enabled = False
+
+# read DICOM headers from the archive filesystem when the ETL runs next to XNAT storage;
+# a snapshot has to see every header request, so the archive is not read then
+dicom_archive_reader = None if snapshot_mode else DicomArchiveReader.from_config(config)
+
+interface = xnat_client.attach(Interface(config=os.path.join(basedir, 'sensitive/xnat_config.cfg')))
+
+
+def get_project_data(xnat_project_id: str, use_staging: bool=True) -> dict:
     """
     Description:
     Get the project metadata from XNAT.  Fetches the XML project metadata and parses it into a Python dictionary.
@@ -33,7 +585,10 @@ def get_project_data(xnat_project_id: str) -> dict:
     """
     
     # get the project metadata
-    project_resource = interface.select.project(xnat_project_id).get()
+    if use_staging and is_project_staged(xnat_project_id):
+        project_resource = get_staged_rows('raw_xnat_project', xnat_project_id)[0]
+    else:
+        project_resource = interface.select.project(xnat_project_id).get()
     project_resource = xmltodict.parse(project_resource)
 
     return project_resource
@@ -54,12 +609,57 @@ def get_subject_data(xnat_project_id: str, xnat_subject_id: str) -> dict:
 
     return subject_resource
 
+
+def get_subject_data_all(xnat_project_id: str, use_staging: bool=True) -> list:
+    """
+    Description:
+    Get the label, project and custom fields of every subject of a project with a single
+    search request, instead of one XML download per subject.
     
-def get_session_data(project_id: str, xnat_experiment_type: str, subject_id: str=None, experiment_id: str=None) -> list:
+    Keyword Arguments:
+    xnat_project_id -- the XNAT project ID
+    
+    Returns:
+    A list of dictionaries, one per subject, with lower-cased column names as keys.
+    """
+
+    if use_staging and is_project_staged(xnat_project_id):
+        return get_staged_rows('raw_xnat_subject', xnat_project_id)
+
+    r = xnat_client.get(
+        f"/data/projects/{xnat_project_id}/subjects",
+        headers = {
+            "accept": "application/json;charset=UTF-8",
+        },
+        params = {
+            'format': 'json',
+            'columns': 'ID,label,project,xnat:subjectData/custom_fields'
+        }
+    )
+
+    if r.status_code != 200:
+        raise ValueError(f"Could not fetch subjects of project {xnat_project_id}.")
+
+    subject_data_list = [
+        {key.lower(): value for key, value in row.items()}
+        for row in json.loads(r.text)['ResultSet']['Result']
+    ]
+
+    return subject_data_list
+
+    
+def get_session_data(project_id: str, xnat_experiment_type: str, subject_id: str=None, experiment_id: str=None, use_staging: bool=True) -> list:
     
     # get session data
     session_data_list = []
 
+    if use_staging and is_project_staged(project_id):
+        return [
+            session_data for session_data in get_staged_rows('raw_xnat_session', project_id, xnat_experiment_type)
+            if (subject_id is None or session_data['subject_label'] == subject_id)
+            and (experiment_id is None or session_data[f'{xnat_experiment_type}/label'.lower()] == experiment_id)
+        ]
+
     session_data_list = interface.array.experiments(
         project_id = project_id,
         subject_label = subject_id,
@@ -91,11 +691,17 @@ def get_session_data_all(project_id: str, xnat_experiment_type: str, subject_id:
     return session_data_list
 
 
-def get_acquisition_data(project_id: str, xnat_experiment_type: str, subject_id: str=None, experiment_id: str=None) -> list:
+def get_acquisition_data(project_id: str, xnat_experiment_type: str, subject_id: str=None, experiment_id: str=None, use_staging: bool=True) -> list:
 
     # construct the acquisition resource
     scan_data_list = []
 
+    if use_staging and is_project_staged(project_id):
+        return [
+            scan_data for scan_data in get_staged_rows('raw_xnat_scan', project_id, xnat_experiment_type)
+            if subject_id is None or scan_data['subject_label'] == subject_id
+        ]
+
     scan_data_list.extend(
         interface.array.scans(
             project_id = project_id,
@@ -123,41 +729,124 @@ def get_acquisition_data(project_id: str, xnat_experiment_type: str, subject_id:
     
     return scan_data_list
 
-def get_dicom_header(api_session, project_id: str, experiment_id: str, scan_id: str) -> list:
+def is_cacheable_scan(last_modified) -> bool:
+    """
+    Whether the header of a scan may be served from the response cache.  A scan without a
+    modification stamp is always refetched, as its changes could not be noticed.
+    """
+
+    return not pd.isna(last_modified) and last_modified != ''
+
+
+def get_dicom_header(project_id: str, experiment_id: str, scan_id: str, last_modified: str=None) -> list:
     
-    r = api_session.get(f"{setup.xnat_server}/REST/services/dicomdump?src=/archive/projects/{project_id}/experiments/{experiment_id}/scans/{scan_id}&format=json&requested_screen=DicomScanTable.vm",
+    # the first DICOM file of the scan in the archive, if there is one, saves the dicomdump request
+    if dicom_archive_reader:
+        archive_header = dicom_archive_reader.read_header(project_id, experiment_id, scan_id)
+        if archive_header is not None:
+            return archive_header
+
+    url = f"{setup.xnat_server}/REST/services/dicomdump?src=/archive/projects/{project_id}/experiments/{experiment_id}/scans/{scan_id}&format=json&requested_screen=DicomScanTable.vm"
+
+    # a cached dump is only reused if the scan has not been modified since it was fetched
+    use_cache = is_cacheable_scan(last_modified)
+    cached_text = get_cached_response('dicomdump', url, validator=last_modified) if use_cache else None
+    if cached_text is not None:
+        return json.loads(cached_text)
+
+    r = xnat_client.get(url,
         headers = {
             "accept": "application/json;charset=UTF-8",
         },
-        auth=(setup.xnat_username, setup.xnat_password),
-        verify=False
+        stream = True
     )
     
     if r.status_code == 200:
         
-        #print(r.text)
-        #result = json.loads(html.unescape(r.text))
-        result = json.loads(r.text)
+        # enhanced multi-frame dumps can be hundreds of MB; only the tag rows are kept,
+        # parsed one at a time while the body is streamed
+        # closing the response gives its concurrency slot back, also if parsing fails
+        with r:
+            result = {
+                'ResultSet': {
+                    'Result': list(stream_array_items(r.iter_content(chunk_size=65536), ['ResultSet', 'Result']))
+                }
+            }
+        if use_cache:
+            cache_response('dicomdump', url, json.dumps(result), validator=last_modified)
         return result
     else:
+        r.close()
         print(r.status_code)
         raise ValueError("Could not fetch DICOM header information.")
         
 
-def get_header(api_session, project_id: str, subject_id: str, experiment_id: str, scan_id: str) -> list:
+def unescape_json_value(value):
+    """
+    Applies html.unescape to the strings of a parsed JSON value.
+    """
+
+    if isinstance(value, str):
+        return html.unescape(value)
+    if isinstance(value, list):
+        return [unescape_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {html.unescape(key): unescape_json_value(item) for key, item in value.items()}
+
+    return value
+
+
+def get_header(project_id: str, subject_id: str, experiment_id: str, scan_id: str, last_modified: str=None, field_prefix_list: list=None) -> list:
+    """
+    Description:
+    Get the JSON of a scan.  When field_prefix_list is given, the response is streamed and
+    only the data_fields of the scan starting with one of the prefixes are kept, e.g.
+    ['parameters/bids_', 'parameters/gnmd_'], so memory does not grow with the response.
     
-    r = api_session.get(
-        f"{setup.xnat_server}/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}/scans/{scan_id}?format=json",
+    Returns:
+    The scan as {'items': [{'data_fields': ...}, ...]}.
+    """
+    
+    url = f"{setup.xnat_server}/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}/scans/{scan_id}?format=json"
+    params = {'fields': field_prefix_list} if field_prefix_list else None
+
+    # a cached scan is only reused if it has not been modified since it was fetched
+    use_cache = is_cacheable_scan(last_modified)
+    cached_text = get_cached_response('scan', url, params=params, validator=last_modified) if use_cache else None
+    if cached_text is not None:
+        return json.loads(cached_text) if field_prefix_list else json.loads(html.unescape(cached_text))
+
+    r = xnat_client.get(
+        url,
         headers = {
             "accept": "*/*",
         },
-        auth=(setup.xnat_username, setup.xnat_password),
-        verify=False
+        stream = field_prefix_list is not None
     )
     
+    if r.status_code == 200 and field_prefix_list:
+
+        # the strings are unescaped after parsing, as an unescaped quote would break the JSON;
+        # the rest of the scan is not read, closing the response gives its concurrency slot back
+        with r:
+            data_field_dict = {
+                html.unescape(key): unescape_json_value(value)
+                for key, value in stream_object_members(
+                    r.iter_content(chunk_size=65536),
+                    ['items', 0, 'data_fields'],
+                    lambda key: html.unescape(key).startswith(tuple(field_prefix_list))
+                )
+            }
+        result = {'items': [{'data_fields': data_field_dict}]}
+        if use_cache:
+            cache_response('scan', url, json.dumps(result), params=params, validator=last_modified)
+        return result
+
     if r.status_code == 200:
         
         result = json.loads(html.unescape(r.text))
+        if use_cache:
+            cache_response('scan', url, r.text, validator=last_modified)
         return result
     
     else:
@@ -183,7 +872,6 @@ def get_form_schema(datatype: str, project_id: str) -> dict:
     headers = {
         "accept": "application/json;charset=UTF-8",
     }
-    auth=(setup.xnat_username, setup.xnat_password)
     
     params = {
         'xsiType': datatype,
@@ -191,11 +879,16 @@ def get_form_schema(datatype: str, project_id: str) -> dict:
         'id': project_id,
         'appendPrevNextButtons': 'false'
     }
+
+    cached_text = get_cached_response('form_schema', url, params=params)
+    if cached_text is not None:
+        return json.loads(cached_text)
     
-    r = requests.request('GET', url, headers=headers, params=params, auth=auth, verify=False) 
+    r = xnat_client.get(url, headers=headers, params=params)
 
     if r.status_code == 200:
         form_dict = json.loads(r.text)
+        cache_response('form_schema', url, r.text, params=params)
         return form_dict
     else:
         raise ValueError("Could not fetch form schema.")
@@ -216,15 +909,21 @@ def get_session_datatypes() -> list:
     headers = {
         "accept": "application/json;charset=UTF-8",
     }
-    auth=(setup.xnat_username, setup.xnat_password)
 
     params = {
         'appendPrevNextButtons': 'false'
     }
 
-    r = requests.request('GET', url, headers=headers, params=params, auth=auth, verify=False) 
+    response_text = get_cached_response('datatypes', url, params=params)
+
+    if response_text is None:
+        r = xnat_client.get(url, headers=headers, params=params)
+        response_text = r.text
+
+        if r.status_code == 200:
+            cache_response('datatypes', url, r.text, params=params)
     
-    xnat_datatype_list = json.loads(r.text)
+    xnat_datatype_list = json.loads(response_text)
     xnat_session_list = []
 
     for item in xnat_datatype_list:
@@ -233,4 +932,220 @@ def get_session_datatypes() -> list:
     
     xnat_session_list.remove('xnat:imageSessionData')
     
-    return xnat_session_list
\ No newline at end of file
+    return xnat_session_list
+
+
+
+def get_project_session_datatypes(project_id: str, use_staging: bool=True) -> list:
+    
+    '''
+        Returns the session data types (see get_session_datatypes) that the project has at
+        least one experiment of.
+        
+        The experiment types of the project are read from a single experiment listing, so
+        the loaders no longer run an empty search for every data type configured in XNAT.
+    '''
+
+    if use_staging and is_project_staged(project_id):
+        staged_df = pd.read_sql(
+            "select distinct xnat_experiment_type from raw_xnat_session where research_study_id = ?",
+            datamart_engine,
+            params=(project_id,)
+        )
+        project_datatype_set = set(staged_df['xnat_experiment_type'])
+        return [datatype for datatype in get_session_datatypes() if datatype in project_datatype_set]
+
+    r = xnat_client.get(
+        f"/data/projects/{project_id}/experiments",
+        headers = {
+            "accept": "application/json;charset=UTF-8",
+        },
+        params = {
+            'format': 'json',
+            'columns': 'ID,xsiType'
+        }
+    )
+
+    if r.status_code != 200:
+        raise ValueError(f"Could not fetch experiments of project {project_id}.")
+
+    project_datatype_set = set(
+        row['xsiType'] for row in json.loads(r.text)['ResultSet']['Result']
+    )
+
+    return [datatype for datatype in get_session_datatypes() if datatype in project_datatype_set]
+
+
+
+raw_table_list = ['raw_xnat_project', 'raw_xnat_subject', 'raw_xnat_session', 'raw_xnat_scan']
+staging_max_age = timedelta(minutes=config.get('xnat', {}).get('staging', {}).get('max_age_minutes', 720))
+# set by use_live_data for reloads of a single subject or session
+staging_bypassed = False
+reported_staged_project_set = set()
+
+
+def use_live_data() -> None:
+    """
+    Description:
+    Makes the loader read XNAT instead of the staged project data. Loaders started for a single
+    subject or session call it, since such a reload is usually run because that data just changed.
+    """
+
+    global staging_bypassed
+    staging_bypassed = True
+
+
+def create_staging_tables() -> None:
+    """
+    Creates the raw landing tables for databases that were initialized before they existed.
+    """
+
+    cursor = datamart_engine.cursor()
+
+    for raw_table in raw_table_list:
+        cursor.execute(f"""
+            create table if not exists {raw_table}
+            (
+                research_study_id text NULL,
+                xnat_experiment_type text NULL,
+                raw_data text NULL,
+                "_extractedat" datetime NULL
+            )
+        """)
+
+    datamart_engine.commit()
+
+
+def is_project_staged(project_id: str) -> bool:
+    """
+    Description:
+    Checks whether stage_xnat_data.py has landed the project's raw XNAT data recently enough
+    (xnat.staging.max_age_minutes) for the loaders to read it instead of calling XNAT.
+    
+    Keyword Arguments:
+    project_id -- the XNAT project ID
+    """
+
+    if staging_bypassed:
+        return False
+
+    try:
+        staged_df = pd.read_sql(
+            'select max("_extractedat") extracted_at from raw_xnat_project where research_study_id = ?',
+            datamart_engine,
+            params=(project_id,)
+        )
+    except Exception as error:
+        if "no such table" in str(error):
+            return False
+        raise error
+
+    extracted_at = staged_df['extracted_at'][0]
+
+    if extracted_at is None:
+        return False
+
+    if datetime.now() - datetime.strptime(extracted_at, "%Y-%m-%d %H:%M:%S") > staging_max_age:
+        return False
+
+    if project_id not in reported_staged_project_set:
+        reported_staged_project_set.add(project_id)
+        print(f"Reading the XNAT data of project {project_id} staged at {extracted_at}")
+
+    return True
+
+
+def get_staged_rows(raw_table: str, project_id: str, xnat_experiment_type: str=None) -> list:
+    """
+    Description:
+    Reads the raw XNAT results of a project from a landing table.
+    
+    Keyword Arguments:
+    raw_table -- one of raw_table_list
+    project_id -- the XNAT project ID
+    xnat_experiment_type -- only return rows of this session data type
+    
+    Returns:
+    The list of raw results, as they were returned by XNAT.
+    """
+
+    query = f"select raw_data from {raw_table} where research_study_id = ?"
+    params = [project_id]
+
+    if xnat_experiment_type:
+        query += " and xnat_experiment_type = ?"
+        params.append(xnat_experiment_type)
+
+    staged_df = pd.read_sql(query, datamart_engine, params=params)
+
+    return [json.loads(raw_data) for raw_data in staged_df['raw_data']]
+
+
+def stage_project_data(project_id: str) -> None:
+    """
+    Description:
+    Fetches the project XML, the subject list and the session and scan searches of every
+    session data type of the project from XNAT once, and lands the raw results in the
+    raw_xnat_* tables.  The loaders then read these tables instead of calling XNAT, so the
+    extraction cost no longer grows with the number of loaders.
+    
+    Keyword Arguments:
+    project_id -- the XNAT project ID
+    """
+
+    extracted_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # pyxnat returns the project XML as bytes
+    project_resource = interface.select.project(project_id).get()
+    if isinstance(project_resource, bytes):
+        project_resource = project_resource.decode('utf-8')
+
+    staged_row_dict = {
+        'raw_xnat_project': [(None, project_resource)],
+        'raw_xnat_subject': [(None, subject_data) for subject_data in get_subject_data_all(project_id, use_staging=False)],
+        'raw_xnat_session': [],
+        'raw_xnat_scan': []
+    }
+
+    for xnat_experiment_type in get_project_session_datatypes(project_id, use_staging=False):
+
+        staged_row_dict['raw_xnat_session'].extend(
+            (xnat_experiment_type, session_data)
+            for session_data in get_session_data(project_id, xnat_experiment_type, use_staging=False)
+        )
+        staged_row_dict['raw_xnat_scan'].extend(
+            (xnat_experiment_type, scan_data)
+            for scan_data in get_acquisition_data(project_id, xnat_experiment_type, use_staging=False)
+        )
+
+    create_staging_tables()
+
+    cursor = datamart_engine.cursor()
+
+    try:
+        for raw_table, staged_row_list in staged_row_dict.items():
+
+            cursor.execute(f"delete from {raw_table} where research_study_id = ?", (project_id,))
+
+            cursor.executemany(
+                f'''insert into {raw_table} (research_study_id, xnat_experiment_type, raw_data, "_extractedat") values (?, ?, ?, ?)''',
+                [
+                    (project_id, xnat_experiment_type, json.dumps(raw_data), extracted_at)
+                    for xnat_experiment_type, raw_data in staged_row_list
+                ]
+            )
+
+        datamart_engine.commit()
+
+    except Exception as error:
+        datamart_engine.rollback()
+        raise error
+
+    print(f"Staged {', '.join(f'{len(row_list)} {table}' for table, row_list in staged_row_dict.items())} rows for project {project_id}.")
+
+
+if __name__ == "__main__":
+
+    # python get_xnat_data.py logout
+    if len(sys.argv) > 1 and sys.argv[1] == 'logout':
+        xnat_client.close()
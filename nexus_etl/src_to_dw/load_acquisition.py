@@ -3,14 +3,17 @@ import sys
 import setup
 import json
 from datetime import datetime
-from get_xnat_data import get_acquisition_data, get_session_datatypes
+from get_xnat_data import get_acquisition_data, get_project_session_datatypes, use_live_data
 config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from SqlDeltaCalc import calculate_delta_in_db
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
+delta_backend = config.get('xnat', {}).get('delta_backend', 'pandas')
 pk_fields = [
             'src_system',
             'research_subject_id',
@@ -20,37 +23,6 @@ pk_fields = [
             'acquisition_id'
         ]
 
-def delete_existing_data(project_id: str, subject_id: str, session_id: str):
-
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        acquisition
-                    where research_study_id = '{project_id}'
-                    and research_study_id_type = 'xnat_project_id'
-                """
-
-    if subject_id:
-        delete_stmt += f" and research_subject_id = '{subject_id}'"
-
-    if session_id:
-        delete_stmt += f" and session_id = '{session_id}'"
-
-    cursor = engine.cursor()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-
-
 def get_existing_data(project_id: str, subject_id: str, session_id: str) -> pd.DataFrame:
 
     # get the existing data
@@ -228,8 +200,13 @@ def main():
     except:
         experiment_type = None
 
+    if subject_id or session_id:
+        # a single subject or session reload reads XNAT, not the staged project data
+        use_live_data()
+
     if not experiment_type:
-        experiment_type_list = get_session_datatypes()
+        # only the session data types the project has experiments of
+        experiment_type_list = get_project_session_datatypes(project_id)
     else:
         experiment_type_list = [experiment_type]
 
@@ -297,15 +274,30 @@ def main():
         scan_df = convert_datatypes_based_on_table('acquisition', scan_df)
         
 
-    existing_df = get_existing_data(project_id, subject_id, session_id)
-    existing_df = convert_datatypes_based_on_table('acquisition', existing_df)
-
-    delta_df = calculate_delta(
-        existing_df, 
-        scan_df, 
-        'acquisition_uri', 
-        pk_fields
-    )
+    if delta_backend == 'sqlite':
+        delta_df = calculate_delta_in_db(
+            engine,
+            'acquisition',
+            {
+                'research_study_id': project_id,
+                'research_study_id_type': 'xnat_project_id',
+                'research_subject_id': subject_id,
+                'session_id': session_id
+            },
+            scan_df,
+            'acquisition_uri',
+            pk_fields
+        )
+    else:
+        existing_df = get_existing_data(project_id, subject_id, session_id)
+        existing_df = convert_datatypes_based_on_table('acquisition', existing_df)
+
+        delta_df = calculate_delta(
+            existing_df, 
+            scan_df, 
+            'acquisition_uri', 
+            pk_fields
+        )
 
     load_df = parse_delta_results(
         nexus_base = config['nexus']['uri_base'], 
@@ -317,17 +309,9 @@ def main():
 
     load_df = convert_datatypes_based_on_table('acquisition', load_df)
 
-    if len(load_df) > 0:
-
-        delete_existing_data(project_id, subject_id, session_id)
-
-        # insert to postgres
-        load_df.to_sql(
-            'acquisition', 
-            engine, 
-            if_exists='append', 
-            index=False
-        )
+    # nothing is removed when XNAT returned no scans
+    if len(scan_df) > 0:
+        apply_delta(engine, 'acquisition', load_df, delta_df, 'acquisition_uri', pk_fields)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,18 @@
 import pandas as pd
 import sys
 import setup
-from get_xnat_data import get_dicom_header, get_header
+from get_xnat_data import get_dicom_header, get_header, snapshot_mode, xnat_client, dicom_archive_reader
 config = setup.config
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from DbConnection import connect_to_db
 from datetime import datetime
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 from dw_dataclasses.acquisition import acquisition
+from DicomTagProjection import DicomTagProjection
+from HeaderBlobStore import store_headers, resolve_header, get_blob_hashes, purge_unreferenced_blobs
 
 engine = connect_to_db()
 pk_fields = [
@@ -44,29 +47,148 @@ def get_existing_data(project_id: str, subject_id: str, session_id: str) -> pd.D
     return existing_df
 
 
-def delete_existing_data(project_id: str):
+# DICOM tags kept in dicom_header; None keeps the whole dump
+dicom_projection = DicomTagProjection.from_config(config)
 
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        acquisition_object
-                    where research_study_id = '{project_id}'
-                    and research_study_id_type = 'xnat_project_id'
-                """
+non_dicom_session_types = ['fif:megEegSessionData', 'edf:ecogSessionData', 'et:eyetrackerSessionData']
+
+# the data fields of a non-DICOM scan that are kept
+header_field_prefix_list = ['parameters/bids_', 'parameters/gnmd_']
+
+
+def fetch_acquisition_header(project_id: str, acquisition: pd.Series) -> tuple:
+    """
+    Fetches the header of a single scan from XNAT.  DICOM scans are read through the
+    dicomdump service; other scans (MEG/EEG, ECoG, eyetracker) only keep the bids and
+    gnmd parameters of the scan JSON.
+
+    Returns:
+    A (dicom_header, non_dicom_header) tuple; one of the two is always None.
+    """
+
+    if acquisition['session_type'] in non_dicom_session_types:
+
+        header_json = get_header(
+            project_id, 
+            acquisition['research_subject_id'], 
+            acquisition['session_id'], 
+            acquisition['acquisition_id'],
+            acquisition['acquisition_last_modified'],
+            field_prefix_list=header_field_prefix_list
+        )
+        
+        header_json = header_json['items'][0]['data_fields']
+        
+        filtered_header_json = {}
+        
+        for key in header_json:
+            
+            if 'parameters/bids_' in key:
+                
+                new_key = key.replace('parameters/bids_', 'bids:')
+                # remove the key from the dict
+                filtered_header_json[new_key] = header_json[key]
+
+            if 'parameters/gnmd_' in key:
+                
+                new_key = key.replace('parameters/gnmd_', 'gnmd:')
+                # remove the key from the dict
+                filtered_header_json[new_key] = header_json[key]
+
+        return None, filtered_header_json
+        
+    dicom_json = get_dicom_header(
+        project_id,
+        acquisition['session_id'],
+        acquisition['acquisition_id'],
+        acquisition['acquisition_last_modified']
+    )
     
-    cursor = engine.cursor()
+    dicom_header = dicom_json['ResultSet']['Result']
 
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
+    if dicom_projection:
+        dicom_header = dicom_projection.apply(dicom_header)
+
+    return dicom_header, None
+
+
+def fetch_acquisition_headers(project_id: str, acquisition_df: pd.DataFrame, max_workers: int) -> pd.DataFrame:
+    """
+    Fetches the headers of all scans in acquisition_df from XNAT with up to max_workers
+    requests in flight, and writes them to the dicom_header and non_dicom_header columns.
+
+    Every scan is attempted.  Scans that fail are reported individually and a ValueError
+    is raised once all requests have finished so that a partial result is never loaded.
+    """
+
+    dicom_header_list = [None] * len(acquisition_df)
+    non_dicom_header_list = [None] * len(acquisition_df)
+    error_list = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        future_dict = {
+            executor.submit(fetch_acquisition_header, project_id, acquisition): position
+            for position, (index, acquisition) in enumerate(acquisition_df.iterrows())
+        }
+
+        for future in as_completed(future_dict):
+
+            position = future_dict[future]
+
+            try:
+                dicom_header_list[position], non_dicom_header_list[position] = future.result()
+
+            except Exception as error:
+                acquisition = acquisition_df.iloc[position]
+                print(f"Could not fetch header for session {acquisition['session_id']}, scan {acquisition['acquisition_id']}: {error}")
+                error_list.append((acquisition['session_id'], acquisition['acquisition_id']))
+
+    if error_list:
+        raise ValueError(f"Could not fetch headers for {len(error_list)} of {len(acquisition_df)} scans.")
 
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
+    acquisition_df['dicom_header'] = dicom_header_list
+    acquisition_df['non_dicom_header'] = non_dicom_header_list
+
+    return acquisition_df
+
+
+def split_unchanged_acquisitions(acquisition_df: pd.DataFrame, existing_df: pd.DataFrame) -> tuple:
+    """
+    Splits the acquisitions into the ones whose stored acquisition_object row was built from
+    the same scan at the same acquisition_last_modified stamp, and the ones that are new or
+    were modified in XNAT since then.
+
+    Returns:
+    An (unchanged_df, changed_df) tuple.  unchanged_df carries the stored dicom_header and
+    non_dicom_header forward; changed_df still needs its headers fetched from XNAT.
+    """
+
+    key_fields = ['research_subject_id', 'session_id', 'acquisition_id']
+
+    if len(existing_df) == 0 or len(acquisition_df) == 0:
+        return pd.DataFrame(columns=list(acquisition_df.columns) + ['dicom_header', 'non_dicom_header']), acquisition_df
+
+    stored_df = existing_df[key_fields + ['acquisition_last_modified', 'dicom_header', 'non_dicom_header']].rename(
+        columns={'acquisition_last_modified': 'stored_last_modified'}
+    )
+
+    merged_df = acquisition_df.merge(
+        stored_df,
+        on=key_fields,
+        how='left'
+    )
+
+    # a scan without a modification stamp is always refetched
+    unchanged_mask = (
+        pd.to_datetime(merged_df['acquisition_last_modified'], errors='coerce')
+        == pd.to_datetime(merged_df['stored_last_modified'], errors='coerce')
+    )
+
+    unchanged_df = merged_df.loc[unchanged_mask].drop(columns=['stored_last_modified'])
+    changed_df = merged_df.loc[~unchanged_mask, acquisition_df.columns]
+
+    return unchanged_df, changed_df
 
             
 def main():
@@ -126,54 +248,47 @@ def main():
             research_study_id = '{project_id}'"""
     acquisition_object_df = pd.read_sql(query, engine)
 
-    api_session = requests.Session()
+    existing_df = get_existing_data(project_id, None, None)
+    existing_df = convert_datatypes_based_on_table('acquisition_object', existing_df)
 
-    acquisition_object_df['dicom_header'] = None
-    acquisition_object_df['non_dicom_header'] = None
-    
-    for index, acquisition in acquisition_object_df.iterrows():
+    # only scans that are new or were modified in XNAT since the last load need their headers fetched;
+    # a snapshot being recorded needs the headers of every scan
+    if config.get('xnat', {}).get('incremental_header_fetch', True) and snapshot_mode != 'record':
+        unchanged_df, acquisition_object_df = split_unchanged_acquisitions(acquisition_object_df, existing_df)
+    else:
+        unchanged_df = pd.DataFrame()
+
+    # headers carried forward are projected again, so a changed projection applies to every scan,
+    # and stored again, which moves headers saved before the header_blob table into it
+    if len(unchanged_df) > 0:
+        dicom_header_list = [resolve_header(dicom_header) for dicom_header in unchanged_df['dicom_header']]
+        if dicom_projection:
+            dicom_header_list = [dicom_projection.apply(dicom_header) for dicom_header in dicom_header_list]
+        unchanged_df['dicom_header'] = store_headers(dicom_header_list)
+        unchanged_df['non_dicom_header'] = store_headers([resolve_header(non_dicom_header) for non_dicom_header in unchanged_df['non_dicom_header']])
+
+    print(f"Fetching headers for {len(acquisition_object_df)} scans; {len(unchanged_df)} unchanged scans carried forward.")
+
+    acquisition_object_df = fetch_acquisition_headers(
+        project_id,
+        acquisition_object_df,
+        config.get('xnat', {}).get('header_fetch_workers', 16)
+    )
 
-        if acquisition['session_type'] in ['fif:megEegSessionData', 'edf:ecogSessionData', 'et:eyetrackerSessionData']:
-            
-            header_json = get_header(
-                api_session, 
-                project_id, 
-                acquisition['research_subject_id'], 
-                acquisition['session_id'], 
-                acquisition['acquisition_id']
-            )
-            
-            header_json = header_json['items'][0]['data_fields']
-            
-            filtered_header_json = {}
-            
-            for key in header_json:
-                
-                if 'parameters/bids_' in key:
-                    
-                    new_key = key.replace('parameters/bids_', 'bids:')
-                    # remove the key from the dict
-                    filtered_header_json[new_key] = header_json[key]
-
-                if 'parameters/gnmd_' in key:
-                    
-                    new_key = key.replace('parameters/gnmd_', 'gnmd:')
-                    # remove the key from the dict
-                    filtered_header_json[new_key] = header_json[key]
-
-            acquisition_object_df.at[index, 'non_dicom_header'] = filtered_header_json
-            
-        else:
-            dicom_json = get_dicom_header(api_session, project_id, acquisition['session_id'], acquisition['acquisition_id'])
-            dicom_header_json = dicom_json['ResultSet']['Result']
-            acquisition_object_df.at[index, 'dicom_header'] = dicom_header_json
-        
+    for endpoint, endpoint_metrics in xnat_client.metrics().items():
+        print(f"XNAT {endpoint} requests: {endpoint_metrics}")
 
-    acquisition_object_df = convert_datatypes_based_on_table('acquisition_object', acquisition_object_df)
+    if dicom_archive_reader:
+        print(f"DICOM archive: {dicom_archive_reader.metrics()}")
 
+    # the rows keep references to the content-addressed header_blob table instead of the headers
+    if len(acquisition_object_df) > 0:
+        acquisition_object_df['dicom_header'] = store_headers(list(acquisition_object_df['dicom_header']))
+        acquisition_object_df['non_dicom_header'] = store_headers(list(acquisition_object_df['non_dicom_header']))
 
-    existing_df = get_existing_data(project_id, None, None)
-    existing_df = convert_datatypes_based_on_table('acquisition_object', existing_df)
+    acquisition_object_df = pd.concat([acquisition_object_df, unchanged_df], ignore_index=True)
+
+    acquisition_object_df = convert_datatypes_based_on_table('acquisition_object', acquisition_object_df)
 
     existing_df['dummy_field'] = 'Acquisition_object_salt'
     acquisition_object_df['dummy_field'] = 'Acquisition_object_salt'
@@ -197,16 +312,16 @@ def main():
 
         load_df = convert_datatypes_based_on_table('acquisition_object', load_df)
 
-        delete_existing_data(project_id)
+        apply_delta(engine, 'acquisition_object', load_df, delta_df, 'acquisition_object_uri', pk_fields)
 
-        # insert to postgres
-        load_df.to_sql(
-            'acquisition_object', 
-            engine, 
-            if_exists='append', 
-            index=False
+        # only the blobs of the headers this load replaced or removed can have become unreferenced
+        dropped_hash_set = (
+            get_blob_hashes(list(existing_df['dicom_header']) + list(existing_df['non_dicom_header']))
+            - get_blob_hashes(list(acquisition_object_df['dicom_header']) + list(acquisition_object_df['non_dicom_header']))
         )
 
+        print(f"Removed {purge_unreferenced_blobs(list(dropped_hash_set))} unreferenced header blobs.")
+
 
 if __name__ == "__main__":
     main()
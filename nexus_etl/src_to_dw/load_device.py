@@ -1,131 +1,197 @@
 import pandas as pd
-import os
 import sys
-from pyxnat import Interface
-from get_xnat_data import get_acquisition_data, get_session_datatypes
+from get_xnat_data import get_acquisition_data, get_project_session_datatypes, create_staging_tables, is_project_staged
 import setup
 from datetime import datetime
 config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
-basedir = os.path.join(os.path.dirname(__file__), '..')
-
-# Establishing database and xnat connections
+# Establishing database connection; XNAT is reached through the shared client in get_xnat_data
 engine = connect_to_db()
-interface = Interface(config = os.path.join(basedir, 'sensitive/xnat_config.cfg'))
-# interface = Interface(config = '../sensitive/xnat_config.cfg')
+pk_fields = [
+            'src_system',
+            'device_manufacturer',
+            'device_name'
+        ]
 
 nifi_proc_dt = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-experiment_type = None
-# Fetching the types of session data available
-experiment_type_list = get_session_datatypes()
 
-# Initialize list to store device data
-data_list = []
+def extract_devices_from_xnat() -> pd.DataFrame:
+    """
+    Builds the list of devices by searching the scans of every session data type of every
+    project in xnat_config.
 
-def delete_existing_data() -> None:
+    Returns:
+        pd.DataFrame: The distinct devices.
     """
-    Truncates the 'device' table in the database.
 
-    Raises:
-        error: If the SQL execution fails for a reason other than the table not existing.
+    # Initialize list to store device data
+    data_list = []
+
+    # Prepare the SQL statement to fetch project IDs
+    query = f"""select xnat_project_id from xnat_config"""
+    # Execute the SQL statement and convert the results to a list
+    project_list = pd.read_sql(query, engine)['xnat_project_id'].to_list()
+
+    for project_id in project_list:
+
+        # Fetching the types of session data the project has experiments of
+        experiment_type_list = get_project_session_datatypes(project_id)
+
+        for xnat_experiment_type in experiment_type_list:
+            
+            # Fetch acquisition data for the current project and experiment type
+            acquisition_list = get_acquisition_data(project_id=project_id, xnat_experiment_type=xnat_experiment_type)
+
+            for scan_data in acquisition_list:
+                # Prepare a dictionary of device details for each scan
+                scan_dict = {
+                    'src_system': "MPG XNAT",
+                    'device_manufacturer': scan_data['xnat:imagescandata/scanner/manufacturer'],
+                    'device_name': scan_data['xnat:imagescandata/scanner/model']
+                }
+                # Add the dictionary to the data list
+                data_list.append(scan_dict)
+
+    # Transform the list of dictionaries into a DataFrame
+    return pd.DataFrame.from_dict(data_list, dtype=object)
+
+
+def extract_devices_from_dw(project_id: str=None) -> pd.DataFrame:
+    """
+    Builds the list of devices with a distinct select over the scans already in the local db:
+    the acquisition table and the scans of the project being loaded that stage_xnat_data.py
+    landed in this run.  The staged scans are needed because load_acquisition.py looks up the
+    device of each scan, so a device has to exist before the first acquisition using it is
+    loaded.  Older staged scans, and those of other projects, are left out: they are only
+    replaced when their project is staged again, so a scan removed from XNAT would keep its
+    device alive until then.
+
+    Args:
+        project_id (str, optional): The XNAT project being loaded.
+
+    Returns:
+        pd.DataFrame: The distinct devices.
     """
-    # Prepare the SQL statement to truncate the 'device' table
-    delete_stmt = f"""
-                    delete from device
-                """
 
-    cursor = engine.cursor()
+    create_staging_tables()
+
+    query = f"""
+                select distinct
+                    src_system,
+                    device_manufacturer,
+                    device_name
+                from
+                    acquisition
+                where
+                    src_system = 'MPG XNAT'
+            """
+    params = ()
+
+    if project_id and is_project_staged(project_id):
+        query += f"""
+                union
+                select distinct
+                    'MPG XNAT' src_system,
+                    json_extract(raw_data, '$."xnat:imagescandata/scanner/manufacturer"') device_manufacturer,
+                    json_extract(raw_data, '$."xnat:imagescandata/scanner/model"') device_name
+                from
+                    raw_xnat_scan
+                where
+                    research_study_id = ?
+            """
+        params = (project_id,)
+
+    return pd.read_sql(query, engine, params=params)
+
+
+def main():
+
+    # python load_device.py [xnat project id] -- devices are loaded for all projects, the
+    # project only adds the devices of its freshly staged scans
+    device_source = config.get('xnat', {}).get('device_source', 'dw')
 
     try:
-        # Attempt to execute the SQL statement
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        # Ignore errors related to the table not existing
-        if "no such table" not in error_string:
-            raise error
-
-
-# Prepare the SQL statement to fetch project IDs
-query = f"""select xnat_project_id from xnat_config"""
-# Execute the SQL statement and convert the results to a list
-project_list = pd.read_sql(query, engine)['xnat_project_id'].to_list()
-
-for project_id in project_list:
-
-    for xnat_experiment_type in experiment_type_list:
-        
-        # Fetch acquisition data for the current project and experiment type
-        acquisition_list = get_acquisition_data(project_id=project_id, xnat_experiment_type=xnat_experiment_type)
-
-        for scan_data in acquisition_list:
-            # Prepare a dictionary of device details for each scan
-            scan_dict = {
-                'src_system': "MPG XNAT",
-                'device_manufacturer': scan_data['xnat:imagescandata/scanner/manufacturer'],
-                'device_name': scan_data['xnat:imagescandata/scanner/model']
-            }
-            # Add the dictionary to the data list
-            data_list.append(scan_dict)
-
-# Transform the list of dictionaries into a DataFrame
-scan_df = pd.DataFrame.from_dict(data_list)
-# Replace empty strings in the DataFrame with None
-scan_df = scan_df.replace({"": None})  
-# Remove duplicate rows from the DataFrame
-scan_df = scan_df.drop_duplicates()
-
-# Prepare the SQL statement to fetch existing device data
-query = f"""
-            select * 
-            from 
-                device
-        """
-# Execute the SQL statement and store the results in a DataFrame
-existing_df = pd.read_sql(query, engine)
-
-# Convert data types in the scan and existing DataFrames based on the 'device' table schema
-scan_df = convert_datatypes_based_on_table('device', scan_df)
-existing_df = convert_datatypes_based_on_table('device', existing_df)
-
-# Calculate the delta between the existing and new data
-delta_df = calculate_delta(
-    existing_df, 
-    scan_df, 
-    'device_uri', 
-    [
-        'src_system',
-        'device_manufacturer',
-        'device_name'
-    ]
-)
-
-# Parse the results of the delta calculation
-load_df = parse_delta_results(
-    nexus_base = config['nexus']['uri_base'], 
-    proc_dt = nifi_proc_dt, 
-    uri_field_name = 'device_uri', 
-    delta_df = delta_df,
-    uri_salt_field_list = [
-        'src_system',
-        'device_manufacturer',
-        'device_name'
-    ]
-)
-
-# If there is data to load, delete the existing data and insert the new data
-if len(load_df) > 0:
-
-    delete_existing_data()
-
-    # Convert data types in the load DataFrame based on the 'device' table schema
-    load_df = convert_datatypes_based_on_table('device', load_df)
-
-    # Insert the new data into the 'device' table
-    load_df.to_sql('device', engine, if_exists='append', index=False)
+        project_id = sys.argv[1]
+    except:
+        project_id = None
+
+    if device_source == 'dw':
+        scan_df = extract_devices_from_dw(project_id)
+    elif device_source == 'xnat':
+        scan_df = extract_devices_from_xnat()
+    else:
+        raise ValueError(f"Unknown device_source {device_source}, expected dw or xnat.")
+
+    # Replace empty strings in the DataFrame with None
+    scan_df = scan_df.replace({"": None})  
+    # Remove duplicate rows from the DataFrame
+    scan_df = scan_df.drop_duplicates()
+
+    # Prepare the SQL statement to fetch existing device data
+    query = f"""
+                select * 
+                from 
+                    device
+            """
+    # Execute the SQL statement and store the results in a DataFrame
+    existing_df = pd.read_sql(query, engine)
+
+    # Convert data types in the scan and existing DataFrames based on the 'device' table schema
+    scan_df = convert_datatypes_based_on_table('device', scan_df)
+    existing_df = convert_datatypes_based_on_table('device', existing_df)
+
+    # Calculate the delta between the existing and new data
+    delta_df = calculate_delta(
+        existing_df, 
+        scan_df, 
+        'device_uri', 
+        pk_fields
+    )
+
+    if device_source == 'dw':
+
+        # the dw source is incremental: devices seen for the first time are inserted and
+        # devices no scan refers to anymore are removed, the rest of the table is left alone
+        insert_df = delta_df.loc[delta_df['delta_action'] == 'INSERT']
+        stale_df = delta_df.loc[delta_df['delta_action'] == 'DELETE']
+
+        load_df = parse_delta_results(
+            nexus_base = config['nexus']['uri_base'], 
+            proc_dt = nifi_proc_dt, 
+            uri_field_name = 'device_uri', 
+            delta_df = insert_df,
+            uri_salt_field_list = pk_fields
+        )
+
+        print(f"Inserted {len(load_df)} and removed {len(stale_df)} devices.")
+
+        load_df = convert_datatypes_based_on_table('device', load_df)
+        apply_delta(engine, 'device', load_df, stale_df, 'device_uri', pk_fields)
+
+        return
+
+    # Parse the results of the delta calculation
+    load_df = parse_delta_results(
+        nexus_base = config['nexus']['uri_base'], 
+        proc_dt = nifi_proc_dt, 
+        uri_field_name = 'device_uri', 
+        delta_df = delta_df,
+        uri_salt_field_list = pk_fields
+    )
+
+    # If there is data to load, write the changed devices
+    if len(load_df) > 0:
+
+        # Convert data types in the load DataFrame based on the 'device' table schema
+        load_df = convert_datatypes_based_on_table('device', load_df)
+
+        apply_delta(engine, 'device', load_df, delta_df, 'device_uri', pk_fields)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
@@ -113,32 +114,6 @@ def get_existing_data(research_study_id: str) -> None:
 
 
 
-def delete_existing_data(research_study_id: str) -> None:
-    
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        questionnaire_item_list
-                    where 
-                        research_study_id = '{research_study_id}'
-                        and research_study_id_type = 'xnat_project_id'
-                """
-
-    cursor = engine.cursor()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-            
-
 '''
 These two functions work together to construct question dictionaries from form data. 
 Each question is represented by a dictionary, and all questions are stored in a list. 
@@ -374,17 +349,9 @@ def main():
             how='left'
         ).replace({np.nan:None})
 
-        delete_existing_data(project_id)
-
         load_df = convert_datatypes_based_on_table('questionnaire_item_list', load_df)
 
-        # load to postgres
-        load_df.to_sql(
-            'questionnaire_item_list',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'questionnaire_item_list', load_df, delta_df, 'questionnaire_item_uri', pk_fields)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_questionnaire_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
@@ -129,32 +130,6 @@ def get_existing_data(research_study_id: str) -> None:
     return existing_df
 
 
-def delete_existing_data(research_study_id: str) -> None:
-    
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        questionnaire
-                    where 
-                        research_study_id = '{research_study_id}'
-                        and research_study_id_type = 'xnat_project_id'
-                """
-
-    cursor = engine.cursor()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-            
-
 '''
 These two functions work together to construct option dictionaries from form data. 
 Each option is represented by a dictionary, and all options are stored in a list. 
@@ -341,15 +316,7 @@ def main():
 
         load_df = convert_datatypes_based_on_table('questionnaire', load_df)
 
-        delete_existing_data(project_id)
-
-        # load to postgres
-        load_df.to_sql(
-            'questionnaire',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'questionnaire', load_df, delta_df, 'questionnaire_item_answer_option_uri', pk_fields)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
@@ -71,32 +72,6 @@ def get_existing_data(research_study_id: str) -> None:
     return existing_df
 
 
-def delete_existing_data(research_study_id: str) -> None:
-    
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        questionnaire_list
-                    where 
-                        research_study_id = '{research_study_id}'
-                        and research_study_id_type = 'xnat_project_id'
-                """
-
-    cursor = engine.cursor()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-            
-
 def main():
     
     project_id = sys.argv[1]
@@ -165,15 +140,7 @@ def main():
 
         load_df = convert_datatypes_based_on_table('questionnaire_list', load_df)
 
-        delete_existing_data(project_id)
-
-        # load to postgres
-        load_df.to_sql(
-            'questionnaire_list',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'questionnaire_list', load_df, delta_df, 'questionnaire_uri', pk_fields)
 
 
 if __name__ == "__main__":
@@ -22,10 +22,6 @@ get_existing_data:
 This function retrieves existing questionnaire response 
 data from a database for a given research study id and response subject type.
 
-delete_existing_data: 
-This function deletes existing questionnaire response 
-data from a database for a given research study id and response subject type.
-
 assign_group_uri: 
 This function is used to assign a group URI to the 
 DataFrame's rows based on existing data.
@@ -37,15 +33,36 @@ the existing DataFrame. It's used by assign_list_uri.
 assign_list_uri: 
 This function assigns list URIs to rows of the DataFrame 
 based on the existing data.
+
+prepare_response_df: 
+This function turns the parsed responses into questionnaire_response 
+rows: it adds the questionnaire response list details and the group 
+and list URIs of the existing data.
+
+iter_existing_partitions: 
+This function reads the existing questionnaire response data of a 
+project with one cursor and yields it one response subject at a time.
+
+iter_response_partitions: 
+This function parses the custom fields of the response subjects 
+one response subject at a time.
+
+load_response_partitions: 
+This function compares and writes the questionnaire responses one 
+response subject (partition) at a time, so that memory is bounded by 
+the largest partition instead of the project.
 '''
 import pandas as pd
 import setup
 config = setup.config
 import numpy as np
 import uuid
+import json
 
 from DbConnection import connect_to_db
 from DatatypeConverter import convert_datatypes_based_on_table
+from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from NexusUriGenerator import generate_uri
 
 engine = connect_to_db()
@@ -357,33 +374,6 @@ def get_existing_data(research_study_id: str, response_subject_type: str) -> Non
     return existing_df
 
 
-def delete_existing_data(research_study_id: str, response_subject_type: str) -> None:
-    
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        questionnaire_response
-                    where 
-                        research_study_id = '{research_study_id}'
-                        and research_study_id_type = 'xnat_project_id'
-                        and response_subject_type = '{response_subject_type}'
-                """
-
-    cursor = engine.cursor()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-            
-
 def assign_group_uri(existing_df, df):
 
     group_uri_df = existing_df.loc[
@@ -490,3 +480,291 @@ def assign_list_uri(existing_df, df):
     return df
 
 
+def prepare_response_df(questionnaire_response_df, questionnaire_response_metadata_df, existing_df, resource_type):
+    """
+    Turns the responses parsed from the custom fields of the response subjects into
+    questionnaire_response rows, ready to be compared with existing_df.
+
+    Parameters:
+        questionnaire_response_df (DataFrame): The output of recursive_creation_of_response_df.
+        questionnaire_response_metadata_df (DataFrame): The questionnaire response list details.
+        existing_df (DataFrame): The existing responses the group and list URIs are taken from.
+        resource_type (str): The response subject type, e.g. 'nidm:Session'.
+
+    Returns:
+        questionnaire_response_df (DataFrame): The rows to compare with existing_df.
+    """
+
+    # remove rows for questionnaires that aren't active anymore
+    questionnaire_response_df = questionnaire_response_df.loc[~questionnaire_response_df['src_system'].isna()]
+
+    questionnaire_response_df = questionnaire_response_metadata_df.merge(
+        questionnaire_response_df,
+        on = ['research_study_id','questionnaire_label','response_subject_uri'],
+        how = 'right'
+    ).replace({np.nan:None})
+
+    questionnaire_response_df.drop(
+        questionnaire_response_df[
+            (questionnaire_response_df.question_type=='xnatSelect')
+            & (questionnaire_response_df.response_code_display != questionnaire_response_df.response_text)
+        ].index, inplace=True)
+
+    questionnaire_response_df = convert_datatypes_based_on_table(
+        'questionnaire_response', 
+        questionnaire_response_df
+    ) 
+
+    # replace empty values in response_text column with None
+    questionnaire_response_df = questionnaire_response_df.replace({'':None})
+    questionnaire_response_df = questionnaire_response_df.replace({"['']":None})
+    questionnaire_response_df = questionnaire_response_df.replace({"[]":None})
+
+    # assign the group uri
+    questionnaire_response_df = assign_group_uri(existing_df, questionnaire_response_df)
+
+    # assign the list uri; "_hash" is left out, its integer column cannot hold the placeholder
+    existing_df = existing_df.drop(columns=['_hash'], errors='ignore').replace({None:"$"})
+    questionnaire_response_df = questionnaire_response_df.replace({None:"$"})
+
+    questionnaire_response_df = assign_list_uri(existing_df, questionnaire_response_df)
+
+    questionnaire_response_df = questionnaire_response_df.replace({"$":None})
+
+    # set the subject_response_type
+    questionnaire_response_df['response_subject_type'] = resource_type
+
+    # convert the datatype to make the delta comparison easier
+    questionnaire_response_df = convert_datatypes_based_on_table(
+        'questionnaire_response', 
+        questionnaire_response_df
+    )
+
+    return questionnaire_response_df
+
+
+def create_partition_index() -> None:
+    """
+    Creates the index the partitions are read in order with, for databases that were
+    initialized before it existed.
+    """
+
+    engine.execute("""
+        create index if not exists ix_questionnaire_response__partition 
+        on questionnaire_response (research_study_id, response_subject_type, response_subject_uri)
+    """)
+    engine.commit()
+
+
+def iter_existing_partitions(research_study_id: str, response_subject_type: str, fetch_size: int = 10000):
+    """
+    Reads the existing questionnaire responses of a project with one cursor, ordered by
+    response_subject_uri, and yields them one response subject (partition) at a time.  Only
+    one fetch and the partition being collected are held in memory.
+
+    Parameters:
+        research_study_id (str): The XNAT project ID.
+        response_subject_type (str): The response subject type, e.g. 'nidm:Session'.
+        fetch_size (int): The number of rows fetched from the cursor at a time.
+
+    Yields:
+        (response_subject_uri, existing_df) for every response subject with stored responses.
+    """
+
+    create_partition_index()
+
+    query = f"""
+                select * 
+                from 
+                    questionnaire_response
+                where 
+                    research_study_id = '{research_study_id}'
+                    and research_study_id_type = 'xnat_project_id'
+                    and response_subject_type = '{response_subject_type}'
+                order by
+                    response_subject_uri
+            """
+
+    partition_key = None
+    partition_df_list = []
+
+    for chunk_df in pd.read_sql(query, engine, chunksize=fetch_size):
+
+        # a fetch with rows without "_hash" reads the column as float, which cannot hold the
+        # hashes of the other rows exactly; these are hashed again by calculate_delta
+        if '_hash' in chunk_df.columns and chunk_df['_hash'].isna().any():
+            chunk_df['_hash'] = None
+
+        # a partition may continue in the next fetch, so it is only handed out once the
+        # cursor has moved on to the next response subject
+        for key, partition_df in chunk_df.groupby('response_subject_uri', sort=False, dropna=False):
+
+            key = None if pd.isna(key) else key
+
+            if partition_df_list and key != partition_key:
+                yield partition_key, convert_datatypes_based_on_table(
+                    'questionnaire_response',
+                    pd.concat(partition_df_list, ignore_index=True)
+                )
+                partition_df_list = []
+
+            partition_key = key
+            partition_df_list.append(partition_df)
+
+    if partition_df_list:
+        yield partition_key, convert_datatypes_based_on_table(
+            'questionnaire_response',
+            pd.concat(partition_df_list, ignore_index=True)
+        )
+
+
+def partition_sort_key(response_subject_uri):
+    # the order of the cursor: SQLite sorts nulls first and text by its bytes, i.e. code points
+    return (response_subject_uri is not None, response_subject_uri or '')
+
+
+def iter_response_partitions(subject_df, schema_df, datamap_schema_df, subject_uri_field, subject_id_field):
+    """
+    Parses the custom fields of the response subjects one at a time.
+
+    Parameters:
+        subject_df (DataFrame): The response subjects with their xnat_custom_fields.
+        schema_df (DataFrame): The questionnaire metadata.
+        datamap_schema_df (DataFrame): The questionnaire metadata for datamaps.
+        subject_uri_field (str): The column of subject_df with the response subject URI.
+        subject_id_field (str): The column of subject_df with the response subject ID.
+
+    Yields:
+        (response_subject_uri, questionnaire_response_df) in the order of iter_existing_partitions.
+    """
+
+    subject_df = subject_df.sort_values(
+        subject_uri_field,
+        key=lambda uri_series: uri_series.map(partition_sort_key)
+    )
+
+    for index, subject in subject_df.iterrows():
+
+        if subject['xnat_custom_fields']:
+
+            response_dict = json.loads(subject['xnat_custom_fields'])
+
+            df = create_first_iteration_of_response_df(response_dict)
+
+            df = recursive_creation_of_response_df(df, schema_df, datamap_schema_df, subject[subject_uri_field], subject[subject_id_field])
+
+            yield subject[subject_uri_field], df
+
+
+def load_response_partitions(project_id, resource_type, response_partition_iter, questionnaire_response_metadata_df, pk_fields, proc_dt, fetch_size = 10000):
+    """
+    Compares and writes the questionnaire responses of a project one response subject
+    (partition) at a time.  The existing partitions come from one ordered cursor
+    (iter_existing_partitions) and are matched with the parsed responses of the response
+    subjects, so only the partition being compared is held in memory.  A partition is only
+    rewritten when something in it changed; the partitions of response subjects without
+    responses are deleted.
+
+    Parameters:
+        project_id (str): The XNAT project ID.
+        resource_type (str): The response subject type, e.g. 'nidm:Session'.
+        response_partition_iter (iterator): Yields (response_subject_uri, questionnaire_response_df)
+            with the output of recursive_creation_of_response_df, ordered by response_subject_uri.
+        questionnaire_response_metadata_df (DataFrame): The questionnaire response list details.
+        pk_fields (list): The primary key fields of the delta comparison.
+        proc_dt (str): The processing datetime.
+        fetch_size (int): The number of existing rows fetched from the cursor at a time.
+
+    Returns:
+        action_count_dict (dict): The number of rows per delta action.
+    """
+
+    action_count_dict = {}
+
+    # the existing data of a response subject without stored responses: no rows, all columns
+    empty_existing_df = convert_datatypes_based_on_table(
+        'questionnaire_response',
+        pd.read_sql("select * from questionnaire_response where 1 = 0", engine)
+    )
+
+    existing_partition_iter = iter_existing_partitions(project_id, resource_type, fetch_size)
+    response_partition_iter = iter(response_partition_iter)
+
+    existing_partition = next(existing_partition_iter, None)
+    response_partition = next(response_partition_iter, None)
+
+    while existing_partition is not None or response_partition is not None:
+
+        # merge the two ordered streams on response_subject_uri
+        if response_partition is None or (
+            existing_partition is not None
+            and partition_sort_key(existing_partition[0]) < partition_sort_key(response_partition[0])
+        ):
+            response_subject_uri, existing_df = existing_partition
+            questionnaire_response_df = pd.DataFrame()
+            existing_partition = next(existing_partition_iter, None)
+
+        elif existing_partition is None or partition_sort_key(response_partition[0]) < partition_sort_key(existing_partition[0]):
+            response_subject_uri, questionnaire_response_df = response_partition
+            existing_df = empty_existing_df
+            response_partition = next(response_partition_iter, None)
+
+        else:
+            response_subject_uri, existing_df = existing_partition
+            questionnaire_response_df = response_partition[1]
+            existing_partition = next(existing_partition_iter, None)
+            response_partition = next(response_partition_iter, None)
+
+        if len(questionnaire_response_df) > 0:
+            questionnaire_response_df = prepare_response_df(
+                questionnaire_response_df,
+                questionnaire_response_metadata_df,
+                existing_df,
+                resource_type
+            )
+
+        if len(questionnaire_response_df) == 0:
+            # the response subject has no (active) responses anymore
+            if len(existing_df) > 0:
+                apply_delta(
+                    engine,
+                    'questionnaire_response',
+                    existing_df.iloc[0:0],
+                    existing_df.assign(delta_action='DELETE'),
+                    'questionnaire_response_item_uri',
+                    pk_fields
+                )
+                action_count_dict['DELETE'] = action_count_dict.get('DELETE', 0) + len(existing_df)
+            continue
+
+        delta_df = calculate_delta(
+            existing_df, 
+            questionnaire_response_df, 
+            'questionnaire_response_item_uri', 
+            pk_fields
+        )
+
+        for action, count in delta_df['delta_action'].value_counts().items():
+            action_count_dict[action] = action_count_dict.get(action, 0) + count
+
+        if (delta_df['delta_action'] == 'NOCHANGE').all():
+            continue
+
+        load_df = parse_delta_results(
+            nexus_base = config['nexus']['uri_base'], 
+            proc_dt = proc_dt, 
+            uri_field_name = 'questionnaire_response_item_uri', 
+            delta_df = delta_df,
+            uri_salt_field_list = pk_fields
+        )
+
+        if len(load_df) > 0:
+
+            load_df = assign_group_uri(load_df, load_df)
+
+            load_df = convert_datatypes_based_on_table('questionnaire_response', load_df)
+
+            # the cursor has moved past this response subject, so it does not see the written rows
+            apply_delta(engine, 'questionnaire_response', load_df, delta_df, 'questionnaire_response_item_uri', pk_fields)
+
+    return action_count_dict
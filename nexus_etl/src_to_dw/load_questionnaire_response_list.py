@@ -8,6 +8,7 @@ from get_xnat_data import get_session_datatypes
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
@@ -18,34 +19,6 @@ pk_fields = [
             'response_subject_uri'
         ]
 
-def delete_existing_data(resource_type: str, research_study_id: str) -> None:
-    
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        questionnaire_response_list
-                    where 
-                        research_study_id = '{research_study_id}'
-                        and research_study_id_type = 'xnat_project_id'
-                """
-
-    cursor = engine.cursor()
-    cursor.execute(delete_stmt)
-    engine.commit()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-            
-
 def get_existing_data(resource_type: str, research_study_id: str) -> None:
     
     # get the existing data
@@ -197,15 +170,7 @@ def main():
 
         load_df = convert_datatypes_based_on_table('questionnaire_response_list', load_df)
 
-        delete_existing_data(resource_type, project_id)
-
-        # load to postgres
-        load_df.to_sql(
-            'questionnaire_response_list',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'questionnaire_response_list', load_df, delta_df, 'questionnaire_response_uri', pk_fields)
 
 
 if __name__ == "__main__":
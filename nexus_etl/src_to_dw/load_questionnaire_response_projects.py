@@ -8,6 +8,7 @@ from datetime import datetime
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
@@ -25,7 +26,8 @@ pk_fields = [
         ]
 
 from load_questionnaire_response_functions import recursive_creation_of_response_df, get_questionnaire_metadata, get_questionnaire_metadata_for_datamaps, create_first_iteration_of_response_df, parse_response_with_dict
-from load_questionnaire_response_functions import assign_list_uri, get_existing_data, delete_existing_data, assign_group_uri
+from load_questionnaire_response_functions import assign_list_uri, get_existing_data, assign_group_uri
+from load_questionnaire_response_functions import prepare_response_df
 
 
 def main():
@@ -64,9 +66,6 @@ def main():
         questionnaire_response_df = questionnaire_response_df.append(df)
         
 
-    # remove rows for questionnaires that aren't active anymore
-    questionnaire_response_df = questionnaire_response_df.loc[~questionnaire_response_df['src_system'].isna()]
-
     # get the questionnaire response list details
     query = f"""
                 select
@@ -83,56 +82,15 @@ def main():
             """
     questionnaire_response_metadata_df = pd.read_sql(query, engine)
 
-
-    questionnaire_response_df = questionnaire_response_metadata_df.merge(
-        questionnaire_response_df,
-        on = ['research_study_id','questionnaire_label','response_subject_uri'],
-        how = 'right'
-    ).replace({np.nan:None})
-
-
-    questionnaire_response_df.drop(
-        questionnaire_response_df[
-            (questionnaire_response_df.question_type=='xnatSelect')
-            & (questionnaire_response_df.response_code_display != questionnaire_response_df.response_text)
-        ].index, inplace=True)
-
-
-    questionnaire_response_df = convert_datatypes_based_on_table(
-        'questionnaire_response', 
-        questionnaire_response_df
-    ) 
-
-    # replace empty values in response_text column with None
-    #df['range'] = df['range'].str.replace(',','-')
-    questionnaire_response_df = questionnaire_response_df.replace({'':None})
-    questionnaire_response_df = questionnaire_response_df.replace({"['']":None})
-    questionnaire_response_df = questionnaire_response_df.replace({"[]":None})
-
     # get existing data for comparison
     existing_df = get_existing_data(project_id, resource_type)
 
-    # assign the group uri
-    questionnaire_response_df = assign_group_uri(existing_df, questionnaire_response_df)
-
-    # assign the list uri
-    existing_df = existing_df.replace({None:"$"})
-    questionnaire_response_df = questionnaire_response_df.replace({None:"$"})
-
-    questionnaire_response_df = assign_list_uri(existing_df, questionnaire_response_df)
-
-    existing_df = existing_df.replace({"$":None})
-    questionnaire_response_df = questionnaire_response_df.replace({"$":None})
-
-
-    # set the subject_response_type
-    questionnaire_response_df['response_subject_type'] = resource_type
-
-    # convert the datatype to make the delta comparison easier
-    questionnaire_response_df = convert_datatypes_based_on_table(
-        'questionnaire_response', 
-        questionnaire_response_df
-    ) 
+    questionnaire_response_df = prepare_response_df(
+        questionnaire_response_df,
+        questionnaire_response_metadata_df,
+        existing_df,
+        resource_type
+    )
 
 
     delta_df = calculate_delta(
@@ -158,15 +116,7 @@ def main():
 
         load_df = convert_datatypes_based_on_table('questionnaire_response', load_df)
 
-        delete_existing_data(project_id, resource_type)
-
-        # load to postgres
-        load_df.to_sql(
-            'questionnaire_response',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'questionnaire_response', load_df, delta_df, 'questionnaire_response_item_uri', pk_fields)
 
 
 if __name__ == "__main__":
@@ -9,6 +9,7 @@ from datetime import datetime
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 
 engine = connect_to_db()
@@ -26,7 +27,11 @@ pk_fields = [
             ]
 
 from load_questionnaire_response_functions import recursive_creation_of_response_df, get_questionnaire_metadata, get_questionnaire_metadata_for_datamaps, create_first_iteration_of_response_df, parse_response_with_dict
-from load_questionnaire_response_functions import assign_list_uri, get_existing_data, delete_existing_data, assign_group_uri
+from load_questionnaire_response_functions import assign_list_uri, get_existing_data, assign_group_uri
+from load_questionnaire_response_functions import prepare_response_df, iter_response_partitions, load_response_partitions
+
+# compare and write the responses one session at a time (see load_response_partitions)
+partition_config = config.get('xnat', {}).get('questionnaire_response_delta', {})
 
         
 def main():
@@ -48,6 +53,55 @@ def main():
     # get the questionnaire metadata for this particular resource type
     schema_df = get_questionnaire_metadata(resource_type, project_id)
     datamap_schema_df = get_questionnaire_metadata_for_datamaps(resource_type, project_id)
+
+
+    if partition_config.get('partitioned', False):
+
+        session_type_string = "', '".join(session_type_list)
+
+        # get subject (the subject of the form) details of all session types
+        query = f"""
+                select
+                    {field_list}
+                from
+                    {postgres_table}
+                where 
+                    research_study_id = '{project_id}'
+                    and session_type in ('{session_type_string}')
+                    and xnat_custom_fields <> '{{}}'
+                """
+        subject_df = pd.read_sql(query, engine)
+
+        # get the questionnaire response list details
+        query = f"""
+                    select
+                        ql.research_study_id,
+                        ql.questionnaire_label,
+                        ql.response_subject_uri,
+                        ql.questionnaire_response_uri,
+                        ql.subject_type,
+                        ql.xnat_data_type
+                    from
+                        questionnaire_response_list ql
+                    inner join {postgres_table} rs 
+                        on ql.response_subject_uri = rs.{subject_uri_field}
+                        and ql.xnat_data_type = rs.session_type
+                """
+        questionnaire_response_metadata_df = pd.read_sql(query, engine)
+
+        action_count_dict = load_response_partitions(
+            project_id,
+            resource_type,
+            iter_response_partitions(subject_df, schema_df, datamap_schema_df, subject_uri_field, subject_id_field),
+            questionnaire_response_metadata_df,
+            pk_fields,
+            nifi_proc_dt,
+            partition_config.get('fetch_size', 10000)
+        )
+        print(f"Questionnaire responses of {resource_type} in project {project_id}: {action_count_dict}")
+
+        return
+
     
     # get existing data for comparison
     existing_df = get_existing_data(project_id, resource_type)
@@ -90,9 +144,6 @@ def main():
 
         if len(questionnaire_response_df) > 0:
 
-            # remove rows for questionnaires that aren't active anymore
-            questionnaire_response_df = questionnaire_response_df.loc[~questionnaire_response_df['src_system'].isna()]
-
             # get the questionnaire response list details
             query = f"""
                         select
@@ -110,52 +161,11 @@ def main():
                     """
             questionnaire_response_metadata_df = pd.read_sql(query, engine)
 
-
-            questionnaire_response_df = questionnaire_response_metadata_df.merge(
+            questionnaire_response_df = prepare_response_df(
                 questionnaire_response_df,
-                on = ['research_study_id','questionnaire_label','response_subject_uri'],
-                how = 'right'
-            ).replace({np.nan:None})
-
-
-            questionnaire_response_df.drop(
-                questionnaire_response_df[
-                    (questionnaire_response_df.question_type=='xnatSelect')
-                    & (questionnaire_response_df.response_code_display != questionnaire_response_df.response_text)
-                ].index, inplace=True)
-
-
-            questionnaire_response_df = convert_datatypes_based_on_table(
-                'questionnaire_response', 
-                questionnaire_response_df
-            ) 
-
-            # replace empty values in response_text column with None
-            #df['range'] = df['range'].str.replace(',','-')
-            questionnaire_response_df = questionnaire_response_df.replace({'':None})
-            questionnaire_response_df = questionnaire_response_df.replace({"['']":None})
-            questionnaire_response_df = questionnaire_response_df.replace({"[]":None})
-
-            
-            # assign the group uri
-            questionnaire_response_df = assign_group_uri(existing_df, questionnaire_response_df)
-
-            # assign the list uri
-            existing_df = existing_df.replace({None:"$"})
-            questionnaire_response_df = questionnaire_response_df.replace({None:"$"})
-
-            questionnaire_response_df = assign_list_uri(existing_df, questionnaire_response_df)
-
-            existing_df = existing_df.replace({"$":None})
-            questionnaire_response_df = questionnaire_response_df.replace({"$":None})
-
-            # set the subject_response_type
-            questionnaire_response_df['response_subject_type'] = resource_type
-
-            # convert the datatype to make the delta comparison easier
-            questionnaire_response_df = convert_datatypes_based_on_table(
-                'questionnaire_response', 
-                questionnaire_response_df
+                questionnaire_response_metadata_df,
+                existing_df,
+                resource_type
             )
 
             response_df_list.append(questionnaire_response_df)
@@ -186,15 +196,7 @@ def main():
 
             load_df = convert_datatypes_based_on_table('questionnaire_response', load_df)
 
-            delete_existing_data(project_id, resource_type)
-
-            # load to postgres
-            load_df.to_sql(
-                'questionnaire_response',
-                engine,
-                if_exists='append',
-                index=False
-            )
+            apply_delta(engine, 'questionnaire_response', load_df, delta_df, 'questionnaire_response_item_uri', pk_fields)
 
 
 
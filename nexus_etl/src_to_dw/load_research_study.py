@@ -9,10 +9,15 @@ config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 from research_study import research_study
 
 engine = connect_to_db()
+pk_fields = [
+            'research_study_id',
+            'research_study_id_type'
+        ]
 
 def extract_project_data(project_resource: dict) -> pd.DataFrame:
     """
@@ -53,42 +58,6 @@ def extract_project_data(project_resource: dict) -> pd.DataFrame:
     return project_df
 
 
-def delete_existing_data(research_study_id: str) -> None:
-    """
-    Deletes existing project data from the research_study table.
-
-    This function deletes rows from the research_study table that have the same research_study_id as the input.
-
-    Args:
-    research_study_id (str): The id of the research study to be deleted.
-
-    Returns:
-    None
-    """
-
-    # SQL statement to delete the data from research_study table
-    delete_stmt = f"""
-                    delete
-                    from 
-                        research_study
-                    where 
-                        research_study_id_type = 'xnat_project_id'
-                        and research_study_id = '{research_study_id}'
-                """
-    
-    # Execute the delete statement
-    cursor = engine.cursor()
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-
-
 def get_existing_data(research_study_id: str) -> pd.DataFrame:
     """
     Gets existing project data from the research_study table.
@@ -150,10 +119,7 @@ def main():
         existing_df, 
         project_df, 
         'research_study_uri', 
-        [
-            'research_study_id',
-            'research_study_id_type'
-        ]
+        pk_fields
     )
 
     # parse the delta results
@@ -170,16 +136,7 @@ def main():
 
         load_df = convert_datatypes_based_on_table('research_study', load_df)
 
-        # delete the existing data
-        delete_existing_data(project_id)
-
-        # load the new data to Postgres
-        load_df.to_sql(
-            'research_study',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'research_study', load_df, delta_df, 'research_study_uri', pk_fields)
     
 
 if __name__ == "__main__":
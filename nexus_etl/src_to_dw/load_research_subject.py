@@ -1,6 +1,6 @@
 import pandas as pd
 import sys
-from get_xnat_data import get_subject_data, get_subject_list
+from get_xnat_data import get_subject_data, get_subject_data_all, use_live_data
 import setup
 import json
 from datetime import datetime
@@ -8,10 +8,13 @@ config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from SqlDeltaCalc import calculate_delta_in_db
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 from dw_dataclasses.research_subject import research_subject
 
 engine = connect_to_db()
+delta_backend = config.get('xnat', {}).get('delta_backend', 'pandas')
 pk_fields = [
             'src_system',
             'research_subject_id',
@@ -19,54 +22,6 @@ pk_fields = [
             'research_study_id_type'
         ]
 
-def delete_existing_data(project_id: str, subject_id: str) -> None:
-    """
-    Deletes existing data from the research_subject table. The deletion is based on the given project_id and
-    (optionally) the subject_id.
-
-    Args:
-        project_id (str): The project identifier. Corresponds to 'research_study_id' in the table.
-        subject_id (str): The subject identifier. Corresponds to 'research_subject_id' in the table.
-                           This parameter is optional. If not given, all subjects for the provided project_id will be deleted.
-
-    Raises:
-        Exception: An error occurred when executing the delete statement, other than "no such table" error.
-
-    Returns:
-        None
-    """
-    # Prepare the SQL delete statement for removing data related to the given project_id
-    delete_stmt = f"""
-                    delete
-                    from 
-                        research_subject
-                    where research_study_id_type = 'xnat_project_id'
-                    and research_study_id = '{project_id}'
-                """
-    
-    # Add condition for subject_id to the delete statement if provided
-    if subject_id:
-        delete_stmt += f" and research_subject_id = '{subject_id}'"
-    
-    # Create a cursor for executing the delete statement
-    cursor = engine.cursor()
-
-    try:
-        # Execute the delete statement
-        cursor.execute(delete_stmt)
-        # Commit changes to the database
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        # If the error is due to "no such table", silently ignore it. Otherwise, propagate the error.
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-
-
-
 def get_existing_data(project_id: str, subject_id: str) -> pd.DataFrame:
     """
     Retrieves existing data from the 'research_subject' table based on the provided project_id and (optionally) subject_id.
@@ -182,6 +137,47 @@ def transform_subject(project_id: str, subject_list: list) -> pd.DataFrame:
             )
         )
 
+    return finalize_subject_df(project_id, participant_list)
+
+
+def transform_project_subjects(project_id: str) -> pd.DataFrame:
+    """
+    Fetches all subjects of the project, including their custom fields, with one search
+    request and transforms them into a DataFrame with study attributes set.
+
+    Args:
+        project_id (str): The project identifier.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the transformed subject data.
+    """
+    participant_list = []
+
+    for subject_data in get_subject_data_all(project_id):
+
+        participant_list.append(
+            research_subject(
+                src_system='MPG XNAT',
+                research_subject_id=subject_data['label'],
+                research_study_id=subject_data.get('project') or project_id,
+                xnat_custom_fields=json.dumps(json.loads(subject_data.get('xnat:subjectdata/custom_fields') or '{}'))
+            )
+        )
+
+    return finalize_subject_df(project_id, participant_list)
+
+
+def finalize_subject_df(project_id: str, participant_list: list) -> pd.DataFrame:
+    """
+    Transforms the list of research_subject dataclasses into a DataFrame and sets study attributes.
+
+    Args:
+        project_id (str): The project identifier.
+        participant_list (list): List of research_subject dataclasses.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the transformed subject data.
+    """
     # Transform the list of dictionaries into a DataFrame
     subject_df = pd.DataFrame.from_dict(participant_list)
 
@@ -202,21 +198,35 @@ def transform_subject(project_id: str, subject_list: list) -> pd.DataFrame:
 def main(project_id, subject_id, processing_date):
 
     if subject_id is None:
-        subject_list = get_subject_list(project_id)
+        # all subjects of the project are fetched in bulk
+        subject_df = transform_project_subjects(project_id)
     else:
-        subject_list = [subject_id]
+        subject_df = transform_subject(project_id, [subject_id])
 
-    subject_df = transform_subject(project_id, subject_list)
-
-    # get the existing data
-    existing_df = get_existing_data(project_id, subject_id)
-
-    delta_df = calculate_delta(
-        existing_df, 
-        subject_df, 
-        'research_subject_uri', 
-        pk_fields
-    )
+    if delta_backend == 'sqlite':
+        # the existing data is compared inside the database
+        delta_df = calculate_delta_in_db(
+            engine,
+            'research_subject',
+            {
+                'research_study_id': project_id,
+                'research_study_id_type': 'xnat_project_id',
+                'research_subject_id': subject_id
+            },
+            subject_df,
+            'research_subject_uri',
+            pk_fields
+        )
+    else:
+        # get the existing data
+        existing_df = get_existing_data(project_id, subject_id)
+
+        delta_df = calculate_delta(
+            existing_df, 
+            subject_df, 
+            'research_subject_uri', 
+            pk_fields
+        )
 
     load_df = parse_delta_results(
         nexus_base=config['nexus']['uri_base'],
@@ -226,18 +236,12 @@ def main(project_id, subject_id, processing_date):
         uri_salt_field_list = pk_fields
     )
 
-    if len(load_df) > 0:
+    # nothing is removed when XNAT returned no subjects
+    if len(subject_df) > 0:
 
         load_df = convert_datatypes_based_on_table('research_subject', load_df)
 
-        delete_existing_data(project_id, subject_id)
-
-        load_df.to_sql(
-            'research_subject',
-            engine,
-            if_exists='append',
-            index=False
-        )
+        apply_delta(engine, 'research_subject', load_df, delta_df, 'research_subject_uri', pk_fields)
 
 
 if __name__ == '__main__':
@@ -250,4 +254,8 @@ if __name__ == '__main__':
     except:
         subject_id = None
 
+    if subject_id:
+        # a single subject reload reads XNAT, not the staged project data
+        use_live_data()
+
     main(project_id, subject_id, processing_date)
@@ -1,6 +1,6 @@
 import pandas as pd
 import sys
-from get_xnat_data import get_session_data, get_session_datatypes
+from get_xnat_data import get_session_data, get_project_session_datatypes, use_live_data
 import setup
 from datetime import datetime
 import json
@@ -8,10 +8,13 @@ config = setup.config
 
 from DbConnection import connect_to_db
 from DeltaCalcUtils import calculate_delta, parse_delta_results
+from SqlDeltaCalc import calculate_delta_in_db
+from WriteToDb import apply_delta
 from DatatypeConverter import convert_datatypes_based_on_table
 from dw_dataclasses.session import session
 
 engine = connect_to_db()
+delta_backend = config.get('xnat', {}).get('delta_backend', 'pandas')
 pk_fields = [
             'src_system',
             'research_subject_id',
@@ -20,36 +23,6 @@ pk_fields = [
             'accession_id',
         ]
 
-def delete_existing_data(project_id: str, subject_id: str, session_id: str):
-
-    # get the existing data
-    delete_stmt = f"""
-                    delete
-                    from 
-                        session
-                    where research_study_id = '{project_id}'
-                    and research_study_id_type = 'xnat_project_id'
-                """
-
-    if subject_id:
-        delete_stmt += f" and research_subject_id = '{subject_id}'"
-
-    if session_id:
-        delete_stmt += f" and session_id = '{session_id}'"
-
-    cursor = engine.cursor()
-
-    try:
-        cursor.execute(delete_stmt)
-        engine.commit()
-
-    except Exception as error:
-        error_string = str(error)
-        if "no such table" in error_string:
-            None
-        else:
-            raise error
-
 def get_existing_data(project_id: str, subject_id: str, session_id: str) -> pd.DataFrame:
 
     # get the existing data
@@ -157,10 +130,15 @@ def main():
         experiment_type = sys.argv[4]
     except:
         experiment_type = None
+
+    if subject_id or session_id:
+        # a single subject or session reload reads XNAT, not the staged project data
+        use_live_data()
         
     
     if not experiment_type:
-        experiment_type_list = get_session_datatypes()
+        # only the session data types the project has experiments of
+        experiment_type_list = get_project_session_datatypes(project_id)
     else:
         experiment_type_list = [experiment_type]
 
@@ -207,16 +185,30 @@ def main():
         session_df = set_subject_attributes(session_df, project_id, subject_id)
         session_df = convert_datatypes_based_on_table('session', session_df)
     
-    existing_df = get_existing_data(project_id, subject_id, session_id)
-    existing_df = convert_datatypes_based_on_table('session', existing_df)
-
-
-    delta_df = calculate_delta(
-        existing_df, 
-        session_df, 
-        'session_uri', 
-        pk_fields
-    )
+    if delta_backend == 'sqlite':
+        delta_df = calculate_delta_in_db(
+            engine,
+            'session',
+            {
+                'research_study_id': project_id,
+                'research_study_id_type': 'xnat_project_id',
+                'research_subject_id': subject_id,
+                'session_id': session_id
+            },
+            session_df,
+            'session_uri',
+            pk_fields
+        )
+    else:
+        existing_df = get_existing_data(project_id, subject_id, session_id)
+        existing_df = convert_datatypes_based_on_table('session', existing_df)
+
+        delta_df = calculate_delta(
+            existing_df, 
+            session_df, 
+            'session_uri', 
+            pk_fields
+        )
 
     load_df = parse_delta_results(
         nexus_base = config['nexus']['uri_base'], 
@@ -228,17 +220,9 @@ def main():
 
     load_df = convert_datatypes_based_on_table('session', load_df)
 
-    if len(load_df) > 0:
-        
-        delete_existing_data(project_id, subject_id, session_id)
-
-        # insert to postgres
-        load_df.to_sql(
-            'session', 
-            engine, 
-            if_exists='append', 
-            index=False
-        )
+    # nothing is removed when XNAT returned no sessions
+    if len(session_df) > 0:
+        apply_delta(engine, 'session', load_df, delta_df, 'session_uri', pk_fields)
     
 
 if __name__ == "__main__":
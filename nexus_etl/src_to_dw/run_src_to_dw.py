@@ -0,0 +1,297 @@
+import os
+import sys
+import time
+import queue
+import threading
+import subprocess
+import setup
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import XnatResponseCache
+from ChangeOutbox import get_run_id
+from get_xnat_data import (
+    stage_project_data,
+    get_project_session_datatypes,
+    get_acquisition_data,
+    get_dicom_header,
+    get_header,
+    is_cacheable_scan,
+    snapshot_mode,
+    dicom_archive_reader
+)
+from load_acquisition_object import (
+    engine,
+    non_dicom_session_types,
+    header_field_prefix_list,
+    split_unchanged_acquisitions
+)
+config = setup.config
+
+pipeline_config = config.get('xnat', {}).get('pipeline', {})
+
+# the loaders run for every project once its XNAT data is staged, in this order
+loader_script_list = [
+    'load_research_study.py',
+    'load_research_subject.py',
+    'load_device.py',
+    'load_session.py',
+    'load_acquisition.py',
+    'load_acquisition_object.py',
+    'load_questionnaire_list.py',
+    'load_questionnaire_item_list.py',
+    'load_questionnaire_item_options.py',
+    'load_questionnaire_response_list.py',
+    'load_questionnaire_response_projects.py',
+    'load_questionnaire_response_subjects.py',
+    'load_questionnaire_response_sessions.py'
+]
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def prefetch_headers(project_id: str) -> tuple:
+    """
+    Description:
+    Fetches the DICOM and non-DICOM headers of the staged scans of the project that
+    load_acquisition_object.py will fetch, i.e. the new ones and the ones modified since the
+    last load (see split_unchanged_acquisitions), into the XNAT response cache, so the loader
+    finds them there instead of waiting for XNAT.  Headers that fail are reported and left
+    for the loader, which fetches them again.
+
+    Keyword Arguments:
+    project_id -- the XNAT project ID
+
+    Returns:
+    A (fetched, failed) tuple with the number of headers.
+    """
+
+    scan_list = []
+
+    for xnat_experiment_type in get_project_session_datatypes(project_id):
+
+        # DICOM headers read from the archive are not cached, so there is nothing to prefetch
+        if xnat_experiment_type not in non_dicom_session_types and dicom_archive_reader:
+            continue
+
+        for scan_data in get_acquisition_data(project_id, xnat_experiment_type):
+
+            last_modified = scan_data['xnat:imagescandata/meta/last_modified']
+
+            # scans without a modification stamp are not cached, see is_cacheable_scan
+            if not is_cacheable_scan(last_modified):
+                continue
+
+            scan_list.append({
+                'research_subject_id': scan_data['subject_label'],
+                'session_id': scan_data[f'{xnat_experiment_type}/label'.lower()],
+                'acquisition_id': scan_data['xnat:imagescandata/id'],
+                'acquisition_last_modified': last_modified,
+                'session_type': xnat_experiment_type
+            })
+
+    scan_df = pd.DataFrame(
+        scan_list,
+        columns=['research_subject_id', 'session_id', 'acquisition_id', 'acquisition_last_modified', 'session_type']
+    )
+
+    # the scans whose headers the loader carries forward are not fetched
+    if config.get('xnat', {}).get('incremental_header_fetch', True):
+        stored_df = pd.read_sql(
+            """
+                select
+                    research_subject_id,
+                    session_id,
+                    acquisition_id,
+                    acquisition_last_modified,
+                    null dicom_header,
+                    null non_dicom_header
+                from acquisition_object
+                where research_study_id = ?
+            """,
+            engine,
+            params=(project_id,)
+        )
+        scan_df = split_unchanged_acquisitions(scan_df, stored_df)[1]
+
+    fetched_count = 0
+    error_count = 0
+
+    with ThreadPoolExecutor(max_workers=config.get('xnat', {}).get('header_fetch_workers', 16)) as executor:
+
+        future_dict = {}
+
+        for index, scan in scan_df.iterrows():
+
+            if scan['session_type'] in non_dicom_session_types:
+                future = executor.submit(
+                    get_header,
+                    project_id, scan['research_subject_id'], scan['session_id'], scan['acquisition_id'],
+                    scan['acquisition_last_modified'], header_field_prefix_list
+                )
+            else:
+                future = executor.submit(
+                    get_dicom_header,
+                    project_id, scan['session_id'], scan['acquisition_id'], scan['acquisition_last_modified']
+                )
+
+            future_dict[future] = scan
+
+        for future in as_completed(future_dict):
+
+            scan = future_dict[future]
+
+            try:
+                future.result()
+                fetched_count += 1
+            except Exception as error:
+                print(f"Could not prefetch header for session {scan['session_id']}, scan {scan['acquisition_id']}: {error}")
+                error_count += 1
+
+    return fetched_count, error_count
+
+
+def extract_project(project_id: str) -> None:
+    """
+    Stages the XNAT data of the project and, if enabled, prefetches its headers.
+    """
+
+    start_time = time.time()
+
+    stage_project_data(project_id)
+
+    # the cache is off while a snapshot is recorded or replayed, prefetching would not help
+    if pipeline_config.get('prefetch_headers', True) and XnatResponseCache.cache_enabled:
+        fetched_count, error_count = prefetch_headers(project_id)
+        print(f"Prefetched {fetched_count} headers for project {project_id}; {error_count} failed.")
+
+    print(f"Extracted project {project_id} in {time.time() - start_time:.1f}s.")
+
+
+def load_project(project_id: str) -> list:
+    """
+    Runs the loader scripts for the project, each in its own process as the makefile does.
+    Like the makefile, the remaining scripts still run after one fails.
+
+    Returns:
+    The names of the scripts that failed.
+    """
+
+    start_time = time.time()
+    failed_script_list = []
+
+    for script_name in loader_script_list:
+
+        result = subprocess.run([sys.executable, os.path.join(script_dir, script_name), project_id])
+
+        if result.returncode != 0:
+            print(f"{script_name} failed for project {project_id}.")
+            failed_script_list.append(script_name)
+
+    print(f"Loaded project {project_id} in {time.time() - start_time:.1f}s.")
+
+    return failed_script_list
+
+
+def extract_projects(project_list: list, project_queue: queue.Queue, stop_event: threading.Event) -> None:
+    """
+    Producer: extracts the projects one after the other and hands each to the loader
+    through project_queue.  The queue is bounded, so extraction runs at most its maxsize
+    projects ahead of loading.  An error is handed over instead of the project.
+    """
+
+    for project_id in project_list:
+
+        if stop_event.is_set():
+            return
+
+        try:
+            extract_project(project_id)
+            project_queue.put((project_id, None))
+        except Exception as error:
+            project_queue.put((project_id, error))
+            return
+
+    project_queue.put(None)
+
+
+def run_pipeline(project_list: list, prefetch_depth: int) -> None:
+    """
+    Description:
+    Runs src_to_dw for the projects with extraction and loading overlapped: while the
+    loaders of one project transform and write its data, a background thread already
+    stages the next project and prefetches its headers.
+
+    Keyword Arguments:
+    project_list -- the XNAT project IDs, loaded in this order
+    prefetch_depth -- the number of extracted projects that may wait for the loader;
+                      0 extracts and loads one project at a time
+    """
+
+    failure_list = []
+
+    # every process appends to the snapshot archive it records, so they must not overlap
+    if prefetch_depth < 1 or snapshot_mode == 'record':
+
+        for project_id in project_list:
+            extract_project(project_id)
+            failure_list.extend((project_id, script_name) for script_name in load_project(project_id))
+
+        report_failures(failure_list)
+        return
+
+    project_queue = queue.Queue(maxsize=prefetch_depth)
+    stop_event = threading.Event()
+
+    producer = threading.Thread(
+        target=extract_projects,
+        args=(project_list, project_queue, stop_event),
+        daemon=True
+    )
+    producer.start()
+
+    try:
+        while True:
+
+            item = project_queue.get()
+
+            if item is None:
+                break
+
+            project_id, error = item
+
+            if error is not None:
+                raise ValueError(f"Could not extract project {project_id}: {error}")
+
+            failure_list.extend((project_id, script_name) for script_name in load_project(project_id))
+
+    finally:
+        stop_event.set()
+
+    report_failures(failure_list)
+
+
+def report_failures(failure_list: list) -> None:
+
+    if failure_list:
+        raise ValueError(
+            f"{len(failure_list)} loader runs failed: "
+            + ', '.join(f"{script_name} ({project_id})" for project_id, script_name in failure_list)
+        )
+
+
+def main():
+
+    # python run_src_to_dw.py nexus1 nexus2 nexus3
+    project_list = sys.argv[1:]
+
+    if not project_list:
+        raise ValueError("At least one XNAT project ID is required.")
+
+    # set in the environment, so the loader processes record their changes under one run id
+    print(f"Run {get_run_id()}")
+
+    run_pipeline(project_list, pipeline_config.get('prefetch_depth', 1))
+
+
+if __name__ == "__main__":
+    main()
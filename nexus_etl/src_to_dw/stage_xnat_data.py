@@ -0,0 +1,16 @@
+import sys
+from get_xnat_data import stage_project_data
+
+
+def main():
+
+    try:
+        project_id = sys.argv[1]
+    except:
+        raise ValueError("The XNAT project ID is required.")
+
+    stage_project_data(project_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common', 'utils'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src_to_dw'))
+
+pydicom = pytest.importorskip('pydicom')
+
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from DicomArchiveReader import DicomArchiveReader
+
+scan_path = '{project}/arc*/{session}/SCANS/{scan}/DICOM'
+dicomdump_field_set = {'tag1', 'tag2', 'vr', 'desc', 'value'}
+
+
+def write_scan(archive_root, project_id: str, session_id: str, scan_id: str) -> str:
+    """
+    Writes a small MR image with pixel data into the scan's DICOM directory of an XNAT archive.
+    """
+
+    scan_directory = archive_root / project_id / 'arc001' / session_id / 'SCANS' / scan_id / 'DICOM'
+    scan_directory.mkdir(parents=True)
+    path = str(scan_directory / '1.dcm')
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+
+    # pydicom 3 takes the encoding from the transfer syntax, pydicom 2 has to be told
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+
+    dataset.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    dataset.Modality = 'MR'
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY']
+    dataset.SeriesDescription = 't1_mprage'
+
+    code_item = Dataset()
+    code_item.CodeValue = 'MRBRAIN'
+    dataset.ProcedureCodeSequence = Sequence([code_item])
+
+    # binary data, which the dump leaves out
+    dataset.add_new(0x00291010, 'OB', b'\x01\x02\x03\x04')
+    dataset.Rows = 2
+    dataset.Columns = 2
+    dataset.BitsAllocated = 16
+    dataset.PixelData = b'\0' * 8
+
+    dataset.save_as(path)
+
+    return path
+
+
+def test_read_header_returns_dicomdump_rows(tmp_path):
+
+    write_scan(tmp_path, 'nexus1', 'SUB001_MR1', '1')
+    reader = DicomArchiveReader(str(tmp_path), scan_path)
+
+    header = reader.read_header('nexus1', 'SUB001_MR1', '1')
+    row_list = header['ResultSet']['Result']
+
+    assert all(set(row) == dicomdump_field_set for row in row_list)
+    assert {'tag1': '(0008,103E)', 'tag2': '', 'vr': 'LO', 'desc': 'Series Description', 'value': 't1_mprage'} in row_list
+    assert {'tag1': '(0008,0008)', 'tag2': '', 'vr': 'CS', 'desc': 'Image Type', 'value': 'ORIGINAL\\PRIMARY'} in row_list
+
+    # the elements of a sequence item are listed under the sequence tag
+    assert {'tag1': '(0008,1032)', 'tag2': '(0008,0100)', 'vr': 'SH', 'desc': 'Code Value', 'value': 'MRBRAIN'} in row_list
+
+    # neither the pixel data nor other binary elements are dumped
+    tag_set = {row['tag1'] for row in row_list}
+    assert '(7FE0,0010)' not in tag_set
+    assert '(0029,1010)' not in tag_set
+
+    assert reader.metrics() == {'archive_reads': 1, 'fallbacks_to_dicomdump': 0}
+
+
+def test_missing_scan_is_not_read(tmp_path):
+
+    write_scan(tmp_path, 'nexus1', 'SUB001_MR1', '1')
+    reader = DicomArchiveReader(str(tmp_path), scan_path)
+
+    assert reader.read_header('nexus1', 'SUB001_MR1', '2') is None
+    assert reader.metrics() == {'archive_reads': 0, 'fallbacks_to_dicomdump': 1}
+
+
+class FakeResponse:
+
+    status_code = 200
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size: int):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeXnatClient:
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.url_list = []
+
+    def get(self, url, **kwargs):
+        self.url_list.append(url)
+        return FakeResponse(self.body)
+
+
+def test_missing_file_falls_back_to_dicomdump(tmp_path, monkeypatch):
+
+    # get_xnat_data reads the configuration and XNAT credentials when it is imported
+    try:
+        import get_xnat_data
+    except Exception as error:
+        pytest.skip(f"get_xnat_data cannot be imported here: {error}")
+
+    write_scan(tmp_path, 'nexus1', 'SUB001_MR1', '1')
+    reader = DicomArchiveReader(str(tmp_path), scan_path)
+
+    dicomdump_row = {'tag1': '(0008,103E)', 'tag2': '', 'vr': 'LO', 'desc': 'Series Description', 'value': 'localizer'}
+    xnat_client = FakeXnatClient(json.dumps({'ResultSet': {'Result': [dicomdump_row]}}).encode('utf-8'))
+
+    monkeypatch.setattr(get_xnat_data, 'dicom_archive_reader', reader)
+    monkeypatch.setattr(get_xnat_data, 'xnat_client', xnat_client)
+    monkeypatch.setattr(get_xnat_data, 'get_cached_response', lambda *args, **kwargs: None)
+    monkeypatch.setattr(get_xnat_data, 'cache_response', lambda *args, **kwargs: None)
+
+    archive_header = get_xnat_data.get_dicom_header('nexus1', 'SUB001_MR1', '1', '2023-07-02 12:00:00')
+    assert xnat_client.url_list == []
+    assert archive_header == reader.read_header('nexus1', 'SUB001_MR1', '1')
+
+    rest_header = get_xnat_data.get_dicom_header('nexus1', 'SUB001_MR1', '2', '2023-07-02 12:00:00')
+    assert rest_header == {'ResultSet': {'Result': [dicomdump_row]}}
+    assert len(xnat_client.url_list) == 1
+    assert 'services/dicomdump' in xnat_client.url_list[0]
@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common', 'utils'))
+
+from StreamingJson import JsonStream, stream_array_items, stream_object_members
+
+
+def iter_chunks(body: bytes, chunk_size: int):
+
+    for start in range(0, len(body), chunk_size):
+        yield body[start:start + chunk_size]
+
+
+def test_result_set_buffer_stays_bounded():
+
+    row_list = [
+        {'tag1': f'(0008,{position:04X})', 'tag2': '', 'vr': 'LO', 'desc': f'Description {position}', 'value': 'x' * 64}
+        for position in range(50000)
+    ]
+    body = json.dumps({'ResultSet': {'Result': row_list, 'totalRecords': len(row_list)}}).encode('utf-8')
+
+    stream = JsonStream(iter_chunks(body, 65536))
+
+    assert stream.seek(['ResultSet', 'Result'])
+    assert list(stream.iter_array_items()) == row_list
+
+    # the body is several MB; the buffer holds the unconsumed rest of the last compaction
+    # and a chunk, not the response
+    assert len(body) > 5_000_000
+    assert stream.peak_buffer_size < 4 * 65536
+
+
+def test_values_split_across_chunks():
+
+    body = b'{"a": [1234567, 2.5e3, true, null, "x y", {"k": [1]}], "b": {"k": 1, "l": "m"}}'
+
+    for chunk_size in range(1, len(body) + 1):
+
+        assert list(stream_array_items(iter_chunks(body, chunk_size), ['a'])) == [1234567, 2500.0, True, None, 'x y', {'k': [1]}]
+        assert list(stream_object_members(iter_chunks(body, chunk_size), ['b'], lambda key: key == 'l')) == [('l', 'm')]